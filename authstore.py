@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+
+Redis storage for IndieAuth login state and issued tokens.
+
+Every operation is a single round trip to redis, the ones that touch
+more than one key are small Lua scripts which redis runs atomically.
+
+Verified tokens are also kept in a short lived in-process cache. Any
+script that removes a token publishes it on the token-revoked channel
+and every process drops it from its cache when it hears about it.
+The ids of revoked signed tokens are published on jti-revoked and
+kept in memory so that checking a signed token never touches redis.
+
+Keys used:
+    login-<me>          hash of the pending or completed login
+    token-<token>       the key (login-... or app-...) the token belongs to
+    app-<me>-<client>-<scope>  the access token issued to a client
+    revoked-tokens      sorted set of revoked signed token ids, scored by expiry
+    sweep-state         cursor and counters of the sweep in progress
+    sweep-stats         counters of the last complete sweep
+    sweep-lease         held by the process running the current sweep
+
+Session tokens live for sessionLifetime and access tokens for
+accessLifetime seconds, both are pushed back every time the token is
+used. sweep() walks the token-* and then the app-* keys a few at a time
+with SCAN, removing token keys whose data is gone and giving an expiry to any
+token keys written before lifetimes existed. Every process can run a
+sweeper(), the sweep lease makes sure only one of them sweeps at a time.
+"""
+
+import os
+import time
+import logging
+import threading
+
+import redis
+
+from ttlcache import TTLCache
+
+
+log           = logging.getLogger('indieweb.authstore')
+revokeChannel = 'token-revoked'
+jtiChannel    = 'jti-revoked'
+revokedKey    = 'revoked-tokens'
+sweepKey      = 'sweep-state'
+statsKey      = 'sweep-stats'
+leaseKey      = 'sweep-lease'
+sweepPrefixes = ('token-', 'app-')
+
+# clear any token left from an earlier login and store the new login request
+#   KEYS[1] login key
+#   ARGV[1] timeout, ARGV[2..] field, value pairs
+_startLogin = """
+local unpack = unpack or table.unpack
+local old = redis.call('hget', KEYS[1], 'token')
+if old then
+    redis.call('del', 'token-' .. old)
+    redis.call('hdel', KEYS[1], 'token')
+    redis.call('publish', '%(channel)s', old)
+end
+redis.call('hmset', KEYS[1], unpack(ARGV, 2))
+redis.call('expire', KEYS[1], ARGV[1])
+return old
+"""
+
+# replace any token of the login with the new one
+#   KEYS[1] login key
+#   ARGV[1] session lifetime, ARGV[2] code, ARGV[3] new token
+_completeLogin = """
+local old = redis.call('hget', KEYS[1], 'token')
+if old then
+    redis.call('del', 'token-' .. old)
+    redis.call('publish', '%(channel)s', old)
+end
+redis.call('hmset', KEYS[1], 'code', ARGV[2], 'token', ARGV[3])
+redis.call('expire', KEYS[1], ARGV[1])
+redis.call('set', 'token-' .. ARGV[3], KEYS[1])
+redis.call('expire', 'token-' .. ARGV[3], ARGV[1])
+return old
+"""
+
+# return the key a token belongs to if that key still holds the token,
+# pushing back the expiry of both
+#   KEYS[1] token key
+#   ARGV[1] token, ARGV[2] session lifetime
+_checkToken = """
+local key = redis.call('get', KEYS[1])
+if key and redis.call('hget', key, 'token') == ARGV[1] then
+    if tonumber(ARGV[2]) > 0 then
+        redis.call('expire', KEYS[1], ARGV[2])
+        redis.call('expire', key, ARGV[2])
+    end
+    return key
+end
+return false
+"""
+
+# return the key a token belongs to, pushing back the expiry of both
+#   KEYS[1] token key
+#   ARGV[1] access lifetime
+_touchToken = """
+local key = redis.call('get', KEYS[1])
+if key and tonumber(ARGV[1]) > 0 then
+    redis.call('expire', KEYS[1], ARGV[1])
+    redis.call('expire', key, ARGV[1])
+end
+return key
+"""
+
+# remove a token and the data it points to
+#   KEYS[1] token key
+#   ARGV[1] token
+_revokeToken = """
+local key = redis.call('get', KEYS[1])
+if key then
+    redis.call('del', key)
+end
+redis.call('del', KEYS[1])
+redis.call('publish', '%(channel)s', ARGV[1])
+return key
+"""
+
+# return the existing access token for a client or store the new one
+#   KEYS[1] app key, KEYS[2] new token key
+#   ARGV[1] new token, ARGV[2] access lifetime
+_accessToken = """
+local token = redis.call('get', KEYS[1])
+local key   = 'token-' .. ARGV[1]
+if token then
+    key = 'token-' .. token
+else
+    token = ARGV[1]
+    redis.call('set', KEYS[1], token)
+    redis.call('set', KEYS[2], KEYS[1])
+end
+if tonumber(ARGV[2]) > 0 then
+    redis.call('expire', KEYS[1], ARGV[2])
+    redis.call('expire', key, ARGV[2])
+end
+return token
+"""
+
+
+class AuthStore(object):
+    def __init__(self, db, cacheTTL=60, cacheSize=4096, sessionLifetime=300, accessLifetime=0):
+        scripts             = { 'channel': revokeChannel }
+        self.db             = db
+        self._startLogin    = db.register_script(_startLogin % scripts)
+        self._completeLogin = db.register_script(_completeLogin % scripts)
+        self._checkToken    = db.register_script(_checkToken)
+        self._revokeToken   = db.register_script(_revokeToken % scripts)
+        self._accessToken   = db.register_script(_accessToken)
+        self._touchToken    = db.register_script(_touchToken)
+        self.sessionLife    = sessionLifetime
+        self.accessLife     = accessLifetime
+        self.memoryUsage    = True
+        self.cacheTTL       = cacheTTL
+        self.verified       = TTLCache(cacheSize)
+        self.lookups        = TTLCache(cacheSize)
+        self.stopped        = threading.Event()
+        self.revoked        = {}
+        self.listener       = None
+        if cacheTTL > 0:
+            self.listener        = threading.Thread(target=self.listen)
+            self.listener.daemon = True
+            self.listener.start()
+
+    def listen(self):
+        """Drop revoked tokens from the cache as they are published.
+
+        If the subscription is lost the whole cache is cleared as any
+        revocations sent while we were away have been missed.
+        """
+        while True:
+            try:
+                pubsub = self.db.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(revokeChannel, jtiChannel)
+                self.clearCache()
+                self.loadRevoked()
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        if message['channel'] == jtiChannel:
+                            jti, expires = message['data'].split(' ', 1)
+                            self.revoked[jti] = float(expires)
+                        else:
+                            self.verified.pop(message['data'])
+                            self.lookups.pop(message['data'])
+            except redis.RedisError:
+                log.exception('token revocation listener lost redis')
+            self.clearCache()
+            time.sleep(1)
+
+    def loadRevoked(self):
+        """Replace the in-memory list of revoked signed tokens with the
+        ones in redis that have not expired yet.
+        """
+        now     = time.time()
+        revoked = {}
+        for jti, expires in self.db.zrangebyscore(revokedKey, now, '+inf', withscores=True):
+            revoked[jti] = expires
+        self.revoked = revoked
+
+    def revokeSigned(self, jti, expires=None):
+        """Add the id of a signed token to the revocation list. Tokens
+        without an expiry are kept on the list for good.
+        """
+        if not expires:
+            expires = float('inf')
+        now  = time.time()
+        pipe = self.db.pipeline()
+        pipe.zadd(revokedKey, { jti: expires })
+        pipe.zremrangebyscore(revokedKey, '-inf', now)
+        pipe.publish(jtiChannel, '%s %s' % (jti, expires))
+        pipe.execute()
+        self.revoked[jti] = expires
+
+    def isRevoked(self, jti):
+        if self.listener is None:
+            return self.db.zscore(revokedKey, jti) is not None
+        expires = self.revoked.get(jti)
+        if expires is not None and expires < time.time():
+            del self.revoked[jti]
+            expires = None
+        return expires is not None
+
+    def clearCache(self):
+        self.verified.clear()
+        self.lookups.clear()
+
+    def startLogin(self, me, data, timeout):
+        """Store the data of a new login request for me, clearing any token
+        left from a previous login. The login expires after timeout seconds.
+        """
+        args = [timeout]
+        for field, value in data.items():
+            args.append(field)
+            args.append(value if value is not None else '')
+        return self._startLogin(keys=['login-%s' % me], args=args)
+
+    def getLogin(self, me):
+        return self.db.hgetall('login-%s' % me)
+
+    def completeLogin(self, me, code, token):
+        """Record the verified code and new session token for me
+        """
+        return self._completeLogin(keys=['login-%s' % me], args=[self.sessionLife, code, token])
+
+    def checkToken(self, token):
+        """Return the login data key for token if the token is still valid
+        """
+        if token is None:
+            return None
+        key = self.verified.get(token)
+        if key is None:
+            key = self._checkToken(keys=['token-%s' % token], args=[token, self.sessionLife])
+            if key and self.cacheTTL > 0:
+                self.verified.set(token, key, self.cacheTTL)
+        return key
+
+    def lookupToken(self, token):
+        """Return the key token points to without checking it
+        """
+        if token is None:
+            return None
+        key = self.lookups.get(token)
+        if key is None:
+            key = self._touchToken(keys=['token-%s' % token], args=[self.accessLife])
+            if key and self.cacheTTL > 0:
+                self.lookups.set(token, key, self.cacheTTL)
+        return key
+
+    def revokeToken(self, token):
+        self.verified.pop(token)
+        self.lookups.pop(token)
+        return self._revokeToken(keys=['token-%s' % token], args=[token])
+
+    def accessToken(self, me, client_id, scope, token):
+        """Return the access token for the client, storing token as the new
+        one if the client has none yet.
+        """
+        key = 'app-%s-%s-%s' % (me, client_id, scope)
+        return key, self._accessToken(keys=[key, 'token-%s' % token], args=[token, self.accessLife])
+
+    def sweep(self, count=100):
+        """Run one SCAN step of the token sweep.
+
+        Token keys whose login or app key is gone, and app keys whose
+        token key is gone, are removed. Keys without an expiry are given
+        one. Live tokens and, where redis supports MEMORY USAGE, their
+        size are counted and the counters are moved to sweep-stats when
+        a full pass over the token- and app- keys completes.
+
+        Returns True when the pass is complete.
+        """
+        state        = self.db.hmget(sweepKey, 'cursor', 'phase')
+        cursor       = int(state[0] or 0)
+        phase        = int(state[1] or 0)
+        cursor, keys = self.db.scan(cursor, match='%s*' % sweepPrefixes[phase], count=count)
+
+        pipe = self.db.pipeline(transaction=False)
+        for key in keys:
+            pipe.get(key)
+            pipe.ttl(key)
+        found = pipe.execute(raise_on_error=False)
+
+        # anything else that happens to share a prefix is not a string
+        # and is left alone
+        valid = [n for n in range(len(keys)) if not isinstance(found[n * 2], Exception)]
+        keys  = [keys[n] for n in valid]
+        found = sum([found[n * 2:n * 2 + 2] for n in valid], [])
+
+        pipe = self.db.pipeline(transaction=False)
+        for n, key in enumerate(keys):
+            value = found[n * 2]
+            if key.startswith('token-'):
+                pipe.exists(value or '')
+            else:
+                pipe.exists('token-%s' % value)
+        exists = pipe.execute()
+
+        counts = { 'session': 0, 'access': 0, 'orphans': 0, 'bytes': 0 }
+        live   = []
+        pipe   = self.db.pipeline(transaction=False)
+        for n, key in enumerate(keys):
+            value, ttl = found[n * 2], found[n * 2 + 1]
+            if not exists[n]:
+                counts['orphans'] += 1
+                pipe.delete(key)
+                continue
+            live.append(key)
+            if key.startswith('token-'):
+                if value.startswith('login-'):
+                    counts['session'] += 1
+                    lifetime = self.sessionLife
+                else:
+                    counts['access'] += 1
+                    lifetime = self.accessLife
+                if ttl is not None and ttl < 0 and lifetime > 0:
+                    pipe.expire(key, lifetime)
+                    pipe.expire(value, lifetime)
+        pipe.execute()
+
+        if self.memoryUsage and live:
+            pipe = self.db.pipeline(transaction=False)
+            for key in live:
+                pipe.execute_command('MEMORY', 'USAGE', key)
+            try:
+                counts['bytes'] = sum([size or 0 for size in pipe.execute()])
+            except redis.ResponseError:
+                self.memoryUsage = False
+
+        finished = cursor == 0 and phase == len(sweepPrefixes) - 1
+        pipe     = self.db.pipeline()
+        for name, value in counts.items():
+            pipe.hincrby(sweepKey, name, value)
+        if finished:
+            pipe.hdel(sweepKey, 'cursor', 'phase')
+            pipe.hset(sweepKey, 'finished', int(time.time()))
+            pipe.rename(sweepKey, statsKey)
+        elif cursor == 0:
+            pipe.hmset(sweepKey, { 'cursor': 0, 'phase': phase + 1 })
+        else:
+            pipe.hset(sweepKey, 'cursor', cursor)
+        pipe.execute()
+        return finished
+
+    def sweepAll(self, count=100):
+        while not self.sweep(count):
+            pass
+        return self.stats()
+
+    def sweeper(self, interval, count=100):
+        """Run a complete sweep about every interval seconds. The sweeper
+        that takes the sweep lease does the pass, renewing the lease as it
+        goes, and the others wait for the next one. Returns once the store
+        is stopped.
+        """
+        while not self.stopped.wait(interval):
+            try:
+                if self.db.set(leaseKey, os.getpid(), nx=True, ex=interval):
+                    while not self.sweep(count):
+                        self.db.expire(leaseKey, interval)
+                    log.info('token sweep complete %s', self.stats())
+            except redis.RedisError:
+                log.exception('token sweep failed')
+
+    def stats(self):
+        """Return the counters of the last complete sweep
+        """
+        return self.db.hgetall(statsKey)
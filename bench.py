@@ -0,0 +1,482 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+
+Benchmark the app against local stand-ins, no network needed.
+
+A stand-in web server plays every remote site: it serves generated
+Webmention source pages that link to target pages, a home page with
+the IndieAuth endpoints and an authorization endpoint that accepts any
+code. Redis is replaced by fakeredis unless --redis is given.
+
+Each scenario sends --requests requests from --concurrency threads
+through the Flask test client and the results, throughput, latency
+percentiles, status codes and memory, are printed as JSON. Pass an
+earlier result file to --compare to fail when a scenario got slower.
+
+With --startup the cold start of the app is measured instead, both with
+heavy modules loaded on first use and with startup.preload, in fresh
+interpreters that then fork --workers workers the way uwsgi does.
+
+    python bench.py --config ./indieweb.cfg --output bench.json
+    python bench.py --config ./indieweb.cfg --compare bench.json
+    python bench.py --config ./indieweb.cfg --startup 5
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import urllib
+import resource
+import tempfile
+import platform
+import functools
+import subprocess
+import threading
+import SocketServer
+import BaseHTTPServer
+
+from urlparse import urlparse
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+import ninka
+
+import indieweb
+import tokens
+import discovery
+import metrics
+
+
+scenarioNames = ('webmention', 'auth', 'token', 'token-issue', 'login', 'micropub')
+
+sourcePage = """<!DOCTYPE html>
+<html>
+<head><title>source %(n)s</title></head>
+<body>
+<div class="h-card"><a class="p-name u-url" href="%(base)s/">Stand In</a></div>
+<div class="h-entry">
+  <p class="p-name">Reply number %(n)s</p>
+  <div class="e-content">
+    <p>%(padding)s</p>
+    <p>In reply to <a class="u-in-reply-to" href="%(base)s/target/%(n)s">this post</a>.</p>
+  </div>
+</div>
+</body>
+</html>
+"""
+
+homePage = """<!DOCTYPE html>
+<html>
+<head>
+<link rel="authorization_endpoint" href="%(base)s/authorize">
+<link rel="token_endpoint" href="%(base)s/token">
+<link rel="webmention" href="%(base)s/webmention">
+</head>
+<body><div class="h-card"><a class="p-name u-url" href="%(base)s/">Stand In</a></div></body>
+</html>
+"""
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # keep-alive with small writes would otherwise stall on delayed acks
+    protocol_version        = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, code, body, contentType='text/html; charset=utf-8', head=False):
+        self.send_response(code)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def page(self, head=False):
+        base = self.server.base
+        path = urlparse(self.path).path
+        if path == '/':
+            self.reply(200, homePage % { 'base': base }, head=head)
+        elif path.startswith('/source/'):
+            self.reply(200, sourcePage % { 'base':    base,
+                                           'n':       path.rsplit('/', 1)[1],
+                                           'padding': self.server.padding,
+                                         }, head=head)
+        elif path.startswith('/target/'):
+            self.reply(200, '<html><body>target</body></html>', head=head)
+        else:
+            self.reply(404, 'not found', head=head)
+
+    def do_GET(self):
+        self.page()
+
+    def do_HEAD(self):
+        self.page(head=True)
+
+    def do_POST(self):
+        length = int(self.headers.get('content-length') or 0)
+        if length:
+            self.rfile.read(length)
+        if urlparse(self.path).path == '/authorize':
+            self.reply(200, urllib.urlencode({ 'me': self.server.base, 'scope': 'post' }), 'application/x-www-form-urlencoded')
+        else:
+            self.reply(202, 'accepted')
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads      = True
+    allow_reuse_address = True
+
+
+def startStandIn(sourceSize):
+    server         = StandInServer(('127.0.0.1', 0), StandInHandler)
+    server.base    = 'http://127.0.0.1:%d' % server.server_address[1]
+    server.padding = 'lorem ipsum ' * (sourceSize / 12)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
+
+def setupApp(configFile, base, workDir, redisAddress=None):
+    """Start the app with its config pointed at the stand-in and workDir
+    """
+    with open(configFile) as h:
+        data = json.load(h)
+
+    data.pop('redis', None)
+    data.update({ 'baseurl':     base,
+                  'our_domain':  urlparse(base).netloc,
+                  'client_id':   base,
+                  'basepath':    workDir,
+                  'contentpath': workDir,
+                  'logpath':     workDir,
+                  'secret':      data.get('secret') or 'bench',
+                })
+    data['tokens']   = dict(data.get('tokens', {}), format='signed')
+    data['limits']   = dict(data.get('limits', {}), source_per_minute=0, ip_per_minute=0)
+    data['queue']    = dict(data.get('queue', {}), enabled=False)
+    data['mentions'] = { 'path': os.path.join(workDir, 'mentions.db') }
+    data['events']   = dict(data.get('events', {}), plugin_path=None)
+    if redisAddress is not None:
+        host, port    = redisAddress.split(':')
+        data['redis'] = { 'host': host, 'port': int(port), 'db': 15 }
+
+    benchConfig = os.path.join(workDir, 'bench.cfg')
+    with open(benchConfig, 'w') as h:
+        json.dump(data, h)
+
+    indieweb.cfg, indieweb.db = indieweb.doStart(indieweb.app, benchConfig)
+    indieweb.templateData     = indieweb.buildTemplateContext(indieweb.cfg)
+    if indieweb.db is None:
+        if fakeredis is None:
+            raise SystemExit('fakeredis is needed to run without --redis')
+        indieweb.db = fakeredis.FakeStrictRedis()
+        discovery.initDiscovery(indieweb.cfg.discovery, indieweb.db)
+        metrics.initMetrics(indieweb.cfg.metrics, indieweb.db)
+
+    indieweb.app.config['WTF_CSRF_ENABLED'] = False
+
+    # the app validates codes with indieauth.com, send them to the stand-in
+    ninka.indieauth.validateAuthCode = functools.partial(ninka.indieauth.validateAuthCode,
+                                                         validationEndpoint='%s/authorize' % base)
+
+# run by a fresh interpreter for each cold start, it must not import bench
+startupScript = """
+import os, sys, json, time
+
+def memory():
+    result = {}
+    with open('/proc/self/status') as h:
+        for line in h:
+            if line.startswith('VmRSS:'):
+                result['rss_kb'] = int(line.split()[1])
+    try:
+        with open('/proc/self/smaps_rollup') as h:
+            for line in h:
+                name = line.split(':')[0]
+                if name in ('Pss', 'Private_Clean', 'Private_Dirty'):
+                    result[name.lower() + '_kb'] = int(line.split()[1])
+    except IOError:
+        pass
+    return result
+
+started = time.time()
+import indieweb
+imported = time.time()
+indieweb.cfg, indieweb.db = indieweb.doStart(indieweb.app, sys.argv[1])
+ready  = time.time()
+client = indieweb.app.test_client()
+client.get('/auth?token=bench')
+first  = time.time()
+
+result = { 'import_s':        imported - started,
+           'start_s':         ready - started,
+           'first_request_s': first - started,
+           'html_stack':      'bs4' in sys.modules,
+           'modules':         len(sys.modules),
+           'memory':          memory(),
+           'workers':         [],
+         }
+for n in range(int(sys.argv[2])):
+    r, w = os.pipe()
+    if os.fork() == 0:
+        os.close(r)
+        indieweb.app.test_client().get('/auth?token=bench')
+        os.write(w, json.dumps(memory()))
+        os._exit(0)
+    os.close(w)
+    data = ''
+    while True:
+        chunk = os.read(r, 4096)
+        if not chunk:
+            break
+        data += chunk
+    os.close(r)
+    os.wait()
+    result['workers'].append(json.loads(data))
+print json.dumps(result)
+"""
+
+def runStartup(configFile, workDir, runs, workers):
+    """Return the median cold start numbers with and without startup.preload
+    """
+    with open(configFile) as h:
+        data = json.load(h)
+    data.pop('redis', None)
+    data.update({ 'basepath': workDir, 'contentpath': workDir, 'logpath': workDir })
+    data['events'] = dict(data.get('events', {}), plugin_path=None)
+
+    def median(values):
+        values = sorted(values)
+        return values[len(values) / 2]
+
+    result = {}
+    for mode, preload in (('lazy', False), ('preload', True)):
+        data['startup'] = { 'preload': preload }
+        modeConfig      = os.path.join(workDir, '%s.cfg' % mode)
+        with open(modeConfig, 'w') as h:
+            json.dump(data, h)
+
+        samples = []
+        for n in range(runs):
+            output = subprocess.check_output([sys.executable, '-c', startupScript, modeConfig, str(workers)],
+                                             cwd=os.path.dirname(os.path.abspath(__file__)))
+            samples.append(json.loads(output.strip().splitlines()[-1]))
+
+        workerMemory = [worker for sample in samples for worker in sample['workers']]
+        result[mode] = { 'runs':              runs,
+                         'import_ms':         round(1000 * median([sample['import_s'] for sample in samples]), 1),
+                         'start_ms':          round(1000 * median([sample['start_s'] for sample in samples]), 1),
+                         'first_request_ms':  round(1000 * median([sample['first_request_s'] for sample in samples]), 1),
+                         'modules':           samples[0]['modules'],
+                         'html_stack_loaded': samples[0]['html_stack'],
+                         'rss_kb':            median([sample['memory']['rss_kb'] for sample in samples]),
+                         'worker':            {},
+                       }
+        for key in ('rss_kb', 'pss_kb', 'private_dirty_kb'):
+            values = [worker[key] for worker in workerMemory if key in worker]
+            if values:
+                result[mode]['worker'][key] = median(values)
+    return result
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+def memory():
+    """Return the current and peak resident size of this process in KB
+    """
+    current = 0
+    try:
+        with open('/proc/self/statm') as h:
+            current = int(h.read().split()[1]) * resource.getpagesize() / 1024
+    except IOError:
+        pass
+    return { 'rss_kb': current, 'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss }
+
+def makeScenarios(base):
+    me         = base
+    loginToken = str(uuid.uuid4())
+    store      = indieweb.getAuthStore()
+    store.startLogin(me, { 'redirect_uri': '%s/success' % base, 'client_id': base, 'scope': 'post' }, 3600)
+    store.completeLogin(me, 'bench', loginToken)
+    accessToken = tokens.signToken(indieweb.cfg.secret, me, base, 'post', 3600)
+    bearer      = { 'Authorization': 'Bearer %s' % accessToken }
+
+    def webmention(client, n):
+        return client.post('/webmention', data={ 'source': '%s/source/%d' % (base, n),
+                                                 'target': '%s/target/%d' % (base, n) })
+
+    def auth(client, n):
+        return client.get('/auth?token=%s' % loginToken)
+
+    def token(client, n):
+        return client.get('/token', headers=bearer)
+
+    def tokenIssue(client, n):
+        return client.post('/token', data={ 'code':         'bench-%d' % n,
+                                            'me':           me,
+                                            'redirect_uri': '%s/success' % base,
+                                            'client_id':    base })
+
+    def login(client, n):
+        return client.post('/login', data={ 'me':           me,
+                                            'client_id':    base,
+                                            'redirect_uri': '%s/success' % base })
+
+    def micropub(client, n):
+        return client.post('/micropub', headers=bearer, data={ 'h':       'entry',
+                                                               'content': 'bench note %d' % n })
+
+    return { 'webmention':  webmention,
+             'auth':        auth,
+             'token':       token,
+             'token-issue': tokenIssue,
+             'login':       login,
+             'micropub':    micropub,
+           }
+
+def runScenario(name, func, requests, concurrency, offset):
+    """Send requests calls of func from concurrency threads and return the results
+    """
+    latencies = []
+    statuses  = {}
+    lock      = threading.Lock()
+    counter   = [0]
+
+    def worker():
+        client = indieweb.app.test_client()
+        while True:
+            with lock:
+                n = counter[0]
+                if n >= requests:
+                    return
+                counter[0] += 1
+            started = time.time()
+            try:
+                status = func(client, offset + n).status_code
+            except Exception as e:
+                status = e.__class__.__name__
+            elapsed = time.time() - started
+            with lock:
+                latencies.append(elapsed)
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    started = time.time()
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - started
+
+    latencies.sort()
+    result = { 'requests':    requests,
+               'concurrency': concurrency,
+               'seconds':     round(elapsed, 3),
+               'throughput':  round(requests / elapsed, 1) if elapsed > 0 else 0.0,
+               'status':      statuses,
+               'latency_ms':  { 'mean': round(1000 * sum(latencies) / len(latencies), 2) if latencies else 0.0,
+                                'p50':  round(1000 * percentile(latencies, 0.50), 2),
+                                'p90':  round(1000 * percentile(latencies, 0.90), 2),
+                                'p99':  round(1000 * percentile(latencies, 0.99), 2),
+                                'max':  round(1000 * latencies[-1], 2) if latencies else 0.0,
+                              },
+               'memory':      memory(),
+             }
+    return result
+
+def compare(results, baseline, tolerance):
+    """Return the scenarios that are slower than in baseline by more than tolerance
+    """
+    regressions = []
+    for name, result in results['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if before is None:
+            continue
+        for key in ('p50', 'p99'):
+            if result['latency_ms'][key] > before['latency_ms'][key] * (1 + tolerance):
+                regressions.append('%s %s %sms -> %sms' % (name, key, before['latency_ms'][key], result['latency_ms'][key]))
+        if result['throughput'] < before['throughput'] * (1 - tolerance):
+            regressions.append('%s throughput %s -> %s' % (name, before['throughput'], result['throughput']))
+    return regressions
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='benchmark the app against local stand-ins')
+    parser.add_argument('--config',      default='./indieweb.cfg')
+    parser.add_argument('--scenarios',   default=','.join(scenarioNames), help='comma separated list from %s' % ', '.join(scenarioNames))
+    parser.add_argument('--requests',    default=200, type=int, help='requests per scenario')
+    parser.add_argument('--concurrency', default=8,   type=int)
+    parser.add_argument('--warmup',      default=10,  type=int, help='requests per scenario before measuring')
+    parser.add_argument('--source-size', default=20000, type=int, help='bytes of text in each source page')
+    parser.add_argument('--redis',       default=None, help='host:port of a real redis to use, db 15 is flushed')
+    parser.add_argument('--output',      default=None, help='write the results to this file')
+    parser.add_argument('--compare',     default=None, help='earlier results to check for regressions')
+    parser.add_argument('--tolerance',   default=0.25, type=float, help='allowed slowdown when comparing, 0.25 is 25%%')
+    parser.add_argument('--startup',     default=0, type=int, help='measure this many cold starts instead of the scenarios')
+    parser.add_argument('--workers',     default=4, type=int, help='workers forked after each cold start')
+
+    args = parser.parse_args()
+
+    workDir = tempfile.mkdtemp(prefix='indieweb-bench-')
+    try:
+        if args.startup:
+            print json.dumps(runStartup(args.config, workDir, args.startup, args.workers), indent=2, sort_keys=True)
+            sys.exit(0)
+
+        standIn = startStandIn(args.source_size)
+        setupApp(args.config, standIn.base, workDir, args.redis)
+        if args.redis is not None:
+            indieweb.db.flushdb()
+
+        scenarios = makeScenarios(standIn.base)
+        results   = { 'started':   time.strftime('%Y-%m-%dT%H:%M:%S'),
+                      'python':    platform.python_version(),
+                      'redis':     args.redis or 'fakeredis',
+                      'scenarios': {},
+                    }
+        offset = 0
+        for name in args.scenarios.split(','):
+            name = name.strip()
+            if name not in scenarios:
+                parser.error('unknown scenario %s' % name)
+            if args.warmup:
+                runScenario(name, scenarios[name], args.warmup, 1, offset)
+                offset += args.warmup
+            results['scenarios'][name] = runScenario(name, scenarios[name], args.requests, args.concurrency, offset)
+            offset += args.requests
+        results['memory'] = memory()
+        # let the background steps of any posts finish before workDir goes
+        if indieweb.publisher is not None:
+            indieweb.publisher.drain()
+            indieweb.publisher.queue.stop()
+            indieweb.publisher.thread.join()
+
+        output = json.dumps(results, indent=2, sort_keys=True)
+        print output
+        if args.output is not None:
+            with open(args.output, 'w') as h:
+                h.write(output)
+
+        if args.compare is not None:
+            with open(args.compare) as h:
+                regressions = compare(results, json.load(h), args.tolerance)
+            if regressions:
+                print >> sys.stderr, 'regressions:\n  %s' % '\n  '.join(regressions)
+                sys.exit(1)
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
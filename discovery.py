@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+
+Cached discovery of Webmention and IndieAuth endpoints.
+
+A single fetch of a URL yields every endpoint it advertises, either
+in the HTTP Link header or in <link> and <a> elements. Results are
+kept in an in-process LRU in front of redis, for as long as the
+response's Cache-Control or Expires headers allow, and URLs that
+advertise nothing are cached for a shorter negative TTL.
+"""
+
+import re
+import json
+import time
+import logging
+
+from email.utils import parsedate_tz, mktime_tz
+from urlparse import urlparse, urljoin
+
+import requests
+import httpclient
+
+from ttlcache import TTLCache
+
+
+log = logging.getLogger('indieweb.discovery')
+
+webmentionRels = ('webmention', 'http://webmention.org', 'http://webmention.org/',
+                  'https://webmention.org', 'https://webmention.org/')
+authRels       = ('authorization_endpoint', 'token_endpoint', 'micropub', 'redirect_uri')
+knownRels      = webmentionRels + authRels
+
+_linkHeader = re.compile(r'<([^>]*)>\s*;(.*)')
+_linkRel    = re.compile(r'rel\s*=\s*"?([^";]+)"?')
+
+cache       = TTLCache()
+db          = None
+minTTL      = 300
+maxTTL      = 86400
+defaultTTL  = 3600
+negativeTTL = 600
+
+
+def initDiscovery(cfgDiscovery, redisDB=None):
+    global cache, db, minTTL, maxTTL, defaultTTL, negativeTTL
+
+    if 'lru_size' not in cfgDiscovery:
+        cfgDiscovery.lru_size = 1024
+    if 'min_ttl' not in cfgDiscovery:
+        cfgDiscovery.min_ttl = 300
+    if 'max_ttl' not in cfgDiscovery:
+        cfgDiscovery.max_ttl = 86400
+    if 'default_ttl' not in cfgDiscovery:
+        cfgDiscovery.default_ttl = 3600
+    if 'negative_ttl' not in cfgDiscovery:
+        cfgDiscovery.negative_ttl = 600
+
+    cache       = TTLCache(cfgDiscovery.lru_size)
+    db          = redisDB
+    minTTL      = cfgDiscovery.min_ttl
+    maxTTL      = cfgDiscovery.max_ttl
+    defaultTTL  = cfgDiscovery.default_ttl
+    negativeTTL = cfgDiscovery.negative_ttl
+
+def cacheTTL(headers):
+    """Work out how long a discovery result may be cached for from the
+    Cache-Control and Expires headers, clamped to [minTTL, maxTTL]
+    """
+    ttl     = defaultTTL
+    control = headers.get('cache-control', '').lower()
+    if 'no-store' in control or 'no-cache' in control:
+        ttl = minTTL
+    else:
+        m = re.search(r'max-age\s*=\s*(\d+)', control)
+        if m is not None:
+            ttl = int(m.group(1))
+        elif 'expires' in headers:
+            expires = parsedate_tz(headers['expires'])
+            if expires is not None:
+                ttl = int(mktime_tz(expires) - time.time())
+    return max(minTTL, min(maxTTL, ttl))
+
+def parseEndpoints(baseURL, headers, content):
+    """Return a dict of rel -> list of absolute URLs found in the Link
+    header and the html of a response.
+    """
+    result = {}
+
+    def add(rel, href):
+        url = urljoin(baseURL, href.strip())
+        if urlparse(url).scheme in ('http', 'https'):
+            urls = result.setdefault(rel, [])
+            if url not in urls:
+                urls.append(url)
+
+    for link in headers.get('link', '').split(','):
+        m = _linkHeader.search(link)
+        if m is not None:
+            rels = _linkRel.search(m.group(2))
+            if rels is not None:
+                for rel in rels.group(1).split():
+                    if rel in knownRels:
+                        add(rel, m.group(1))
+
+    if content:
+        from bs4 import BeautifulSoup, SoupStrainer
+        for link in BeautifulSoup(content, 'html.parser', parse_only=SoupStrainer(['link', 'a'])).find_all(rel=True, href=True):
+            for rel in link.get('rel'):
+                if rel in knownRels:
+                    add(rel, link.get('href'))
+    return result
+
+def fetchEndpoints(url):
+    """Fetch url and return the discovery result and how long to cache it
+    """
+    result = { 'status': None, 'endpoints': {} }
+    try:
+        r = httpclient.get(url, verify=False)
+    except (requests.RequestException, httpclient.BodyTooLarge) as e:
+        log.info('discovery of %s failed: %s', url, e)
+        return result, negativeTTL
+
+    result['status'] = r.status_code
+    if r.status_code == requests.codes.ok:
+        result['endpoints'] = parseEndpoints(r.url, r.headers, r.content)
+
+    if result['endpoints']:
+        ttl = cacheTTL(r.headers)
+    else:
+        ttl = negativeTTL
+    return result, ttl
+
+def discover(url):
+    """Return the discovery result for url from the in-process cache,
+    then redis and only then by fetching it.
+    """
+    key    = 'discovery-%s' % url
+    result = cache.get(key)
+    if result is not None:
+        return result
+
+    if db is not None:
+        data = db.get(key)
+        if data is not None:
+            result = json.loads(data)
+            ttl    = db.ttl(key)
+            if ttl is not None and ttl > 0:
+                cache.set(key, result, ttl)
+            return result
+
+    result, ttl = fetchEndpoints(url)
+    cache.set(key, result, ttl)
+    if db is not None:
+        db.setex(key, ttl, json.dumps(result))
+    return result
+
+def invalidate(url):
+    """Remove any cached discovery result for url
+    """
+    key = 'discovery-%s' % url
+    cache.pop(key)
+    if db is not None:
+        db.delete(key)
+
+def webmentionEndpoint(url):
+    """Return (status code, Webmention endpoint) for url in the same form
+    as ronkyuu.discoverEndpoint()
+    """
+    result = discover(url)
+    href   = None
+    for rel in webmentionRels:
+        if rel in result['endpoints']:
+            href = result['endpoints'][rel][0]
+            break
+    return result['status'], href
+
+def authEndpoints(url):
+    """Return the IndieAuth endpoints for url in the same form as
+    ninka.indieauth.discoverAuthEndpoints(), a dict of rel -> parsed URLs
+    """
+    result = discover(url)
+    found  = {}
+    for rel in authRels:
+        if rel in result['endpoints']:
+            found[rel] = [urlparse(href) for href in result['endpoints'][rel]]
+    return found
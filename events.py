@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+
+Event plugins and the dispatcher that runs them.
+
+Every .py file found in the plugin directory is imported once, at
+startup, and any module with a handleEvent(eventType, payload) function
+becomes a handler. A module can limit the events it is given with an
+'events' tuple and change its time limit with a 'timeout' value. A
+plugin can raise events of its own with dispatch().
+
+Events are handed to a small pool of worker threads so handlers never
+run on the request thread. Events with the same key (the target URL
+for Webmentions) always go to the same worker and are handled in the
+order they were dispatched. Each worker runs every plugin on a thread
+of its own, so the number of threads is fixed. A handler that runs past
+its timeout is left to finish and the worker moves on. Until the late
+call returns the later events for that plugin are queued behind it
+without waiting, so calls of a plugin never overlap, run out of order or
+hold up the worker twice.
+"""
+
+import os
+import imp
+import json
+import time
+import Queue
+import logging
+import threading
+
+
+log     = logging.getLogger('indieweb.events')
+plugins = []
+current = None
+
+WEBMENTION_INBOUND  = 'webmention-inbound'
+WEBMENTION_OUTBOUND = 'webmention-outbound'
+ARTICLE_POST        = 'article-post'
+MEDIA_UPLOAD        = 'media-upload'
+
+
+def loadPlugins(pluginPath):
+    """Import every .py file in pluginPath and return the modules that
+    have a handleEvent() function
+    """
+    result = []
+    if pluginPath and os.path.isdir(pluginPath):
+        for filename in sorted(os.listdir(pluginPath)):
+            name, ext = os.path.splitext(filename)
+            if ext == '.py' and not name.startswith('_'):
+                try:
+                    module = imp.load_source('dainin_plugin_%s' % name, os.path.join(pluginPath, filename))
+                except Exception:
+                    log.exception('unable to load plugin %s', filename)
+                    continue
+                if hasattr(module, 'handleEvent'):
+                    log.info('loaded plugin %s', name)
+                    result.append((name, module))
+    return result
+
+
+def dispatch(eventType, payload, key=None):
+    """Dispatch an event from a plugin or a helper module through the
+    dispatcher of this process, the event is dropped if there is none
+    """
+    if current is None:
+        return False
+    return current.dispatch(eventType, payload, key)
+
+
+class HandlerStats(object):
+    def __init__(self):
+        self.calls    = 0
+        self.errors   = 0
+        self.timeouts = 0
+        self.queued   = 0
+        self.dropped  = 0
+        self.total    = 0.0
+        self.slowest  = 0.0
+        self.lock     = threading.Lock()
+
+    def record(self, elapsed, failed=False):
+        with self.lock:
+            self.calls  += 1
+            self.total  += elapsed
+            self.slowest = max(self.slowest, elapsed)
+            if failed:
+                self.errors += 1
+
+    def count(self, outcome):
+        """Count a call that timed out, was queued or was dropped
+        """
+        with self.lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def asDict(self):
+        return { 'calls':    self.calls,
+                 'errors':   self.errors,
+                 'timeouts': self.timeouts,
+                 'queued':   self.queued,
+                 'dropped':  self.dropped,
+                 'average':  self.total / self.calls if self.calls else 0.0,
+                 'slowest':  self.slowest,
+               }
+
+
+class Tracker(object):
+    """Follows the handlers of one dispatched event until every one of
+    them has returned, including calls queued behind a late one
+    """
+    def __init__(self):
+        self.outcomes = {}
+        self.closed   = False
+        self.lock     = threading.Lock()
+        self.finished = threading.Event()
+
+    def start(self, name):
+        with self.lock:
+            self.outcomes[name] = None
+
+    def finish(self, name, outcome):
+        with self.lock:
+            self.outcomes[name] = outcome
+            self.check()
+
+    def close(self):
+        """Called once every handler of the event has been started
+        """
+        with self.lock:
+            self.closed = True
+            self.check()
+
+    def check(self):
+        if self.closed and None not in self.outcomes.values():
+            self.finished.set()
+
+    def wait(self, timeout=None):
+        """Wait up to timeout seconds for the handlers and return the
+        outcome of each, 'ok', 'failed', 'dropped' or None if it is still
+        running. None is returned if the event never reached a worker.
+        """
+        self.finished.wait(timeout)
+        with self.lock:
+            if not self.closed:
+                return None
+            return dict(self.outcomes)
+
+
+class Runner(object):
+    """The thread that runs one plugin for one worker, its calls are run
+    one at a time in the order they were made
+    """
+    def __init__(self, name, module, stats, queueSize=1000):
+        self.name          = name
+        self.module        = module
+        self.stats         = stats
+        self.queueSize     = queueSize
+        self.calls         = Queue.Queue()
+        self.pending       = 0
+        self.lock          = threading.Lock()
+        self.thread        = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            eventType, payload, done, tracker = self.calls.get()
+            started = time.time()
+            failed  = False
+            try:
+                self.module.handleEvent(eventType, payload)
+            except Exception:
+                failed = True
+                log.exception('plugin %s failed handling %s', self.name, eventType)
+            finally:
+                self.stats.record(time.time() - started, failed)
+                with self.lock:
+                    self.pending -= 1
+                if tracker is not None:
+                    tracker.finish(self.name, 'failed' if failed else 'ok')
+                if done is not None:
+                    done['failed'] = failed
+                    done['finished'].set()
+
+    def call(self, eventType, payload, timeout, tracker=None):
+        """Run the handler, waiting up to timeout seconds for it. Returns
+        'ok', 'failed' or 'timeout'. While an earlier call that ran past
+        its timeout has not returned the call is queued behind it and
+        'queued' is returned at once, or 'dropped' if queueSize calls
+        are already waiting.
+        """
+        with self.lock:
+            late = self.pending > 0
+            if late and self.pending > self.queueSize:
+                return 'dropped'
+            self.pending += 1
+        if late:
+            self.calls.put((eventType, payload, None, tracker))
+            return 'queued'
+        done = { 'failed': False, 'finished': threading.Event() }
+        self.calls.put((eventType, payload, done, tracker))
+        if not done['finished'].wait(timeout):
+            return 'timeout'
+        return 'failed' if done['failed'] else 'ok'
+
+
+class Dispatcher(object):
+    def __init__(self, plugins, workers=4, timeout=30, queueSize=1000):
+        self.plugins = plugins
+        self.timeout = timeout
+        self.stats   = {}
+        self.dropped = 0
+        self.queues  = []
+        self.runners = []
+        for name, module in plugins:
+            self.stats[name] = HandlerStats()
+        for n in range(workers):
+            q       = Queue.Queue(queueSize)
+            runners = dict([(name, Runner(name, module, self.stats[name], queueSize)) for name, module in plugins])
+            t = threading.Thread(target=self.worker, args=(q, runners))
+            t.daemon = True
+            t.start()
+            self.queues.append(q)
+            self.runners.append(runners)
+
+    def dispatch(self, eventType, payload, key=None, tracker=None):
+        """Queue an event for the handlers without waiting for them, a
+        tracker can be given to follow them. Events are dropped, and
+        counted, if the worker's queue is full. Returns False if the event
+        was dropped.
+        """
+        if not self.plugins:
+            if tracker is not None:
+                tracker.close()
+            return True
+        if key is None:
+            key = eventType
+        q = self.queues[hash(key) % len(self.queues)]
+        try:
+            q.put_nowait((eventType, payload, tracker))
+        except Queue.Full:
+            self.dropped += 1
+            log.warning('event queue full, dropped %s for %s', eventType, key)
+            return False
+        return True
+
+    def worker(self, q, runners):
+        while True:
+            eventType, payload, tracker = q.get()
+            try:
+                self.run(eventType, payload, runners, tracker)
+            finally:
+                if tracker is not None:
+                    tracker.close()
+                q.task_done()
+
+    def run(self, eventType, payload, runners=None, tracker=None):
+        """Hand the event to every interested handler, one after the other
+        """
+        if runners is None:
+            runners = self.runners[0]
+        for name, module in self.plugins:
+            events = getattr(module, 'events', None)
+            if events is not None and eventType not in events:
+                continue
+            if tracker is not None:
+                tracker.start(name)
+            self.call(runners[name], eventType, payload, tracker)
+
+    def call(self, runner, eventType, payload, tracker=None):
+        timeout = getattr(runner.module, 'timeout', self.timeout)
+        outcome = runner.call(eventType, payload, timeout, tracker)
+        if outcome == 'timeout':
+            self.stats[runner.name].count('timeouts')
+            log.warning('plugin %s took longer than %ss handling %s', runner.name, timeout, eventType)
+        elif outcome == 'queued':
+            self.stats[runner.name].count('queued')
+            log.info('plugin %s is still busy past its timeout, queued %s', runner.name, eventType)
+        elif outcome == 'dropped':
+            self.stats[runner.name].count('dropped')
+            if tracker is not None:
+                tracker.finish(runner.name, 'dropped')
+            log.warning('plugin %s has %d calls waiting, dropped %s', runner.name, runner.queueSize, eventType)
+
+    def pending(self):
+        return sum([q.qsize() for q in self.queues])
+
+    def getStats(self):
+        result = { 'dropped': self.dropped,
+                   'pending': self.pending(),
+                   'handlers': {},
+                 }
+        for name in self.stats:
+            result['handlers'][name] = self.stats[name].asDict()
+        return result
+
+
+def initEvents(cfgEvents):
+    """Set the event defaults and load the plugins. The dispatcher itself
+    is created later, by each process, as it starts threads.
+    """
+    global plugins
+
+    if 'plugin_path' not in cfgEvents:
+        cfgEvents.plugin_path = None
+    if 'workers' not in cfgEvents:
+        cfgEvents.workers = 4
+    if 'timeout' not in cfgEvents:
+        cfgEvents.timeout = 30
+    if 'queue_size' not in cfgEvents:
+        cfgEvents.queue_size = 1000
+
+    plugins = loadPlugins(cfgEvents.plugin_path)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from bearlib.config import Config
+
+    parser = argparse.ArgumentParser(description='trigger an event and run the event plugins for it')
+    parser.add_argument('--config',  default='/etc/indieweb.cfg')
+    parser.add_argument('--event',   required=True, help='event type, for example %s' % WEBMENTION_INBOUND)
+    parser.add_argument('--payload', default='{}',  help='json payload of the event')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-9s %(message)s')
+
+    cfg = Config()
+    cfg.fromJson(args.config)
+
+    initEvents(cfg.events)
+    dispatcher = Dispatcher(plugins, 1, cfg.events.timeout)
+    # plugins reach the dispatcher through the imported events module,
+    # not through this __main__ one
+    import events
+    events.current = dispatcher
+    dispatcher.run(args.event, json.loads(args.payload))
+    print json.dumps(dispatcher.getStats(), indent=2)
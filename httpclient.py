@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+
+Process wide HTTP client so that every outbound request,
+including the ones made inside of ronkyuu and ninka, share
+one pool of keep-alive connections.
+"""
+
+import requests
+
+from bearlib.config import Config
+from requests.adapters import HTTPAdapter
+
+
+session = None
+timeout = (5, 15)
+maxBody = 5 * 1024 * 1024
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+def initHTTP(cfgHTTP):
+    """Build the shared session from the http section of the configuration
+    """
+    global session, timeout, maxBody
+
+    if 'pool_connections' not in cfgHTTP:
+        cfgHTTP.pool_connections = 20
+    if 'pool_maxsize' not in cfgHTTP:
+        cfgHTTP.pool_maxsize = 10
+    if 'connect_timeout' not in cfgHTTP:
+        cfgHTTP.connect_timeout = 5
+    if 'read_timeout' not in cfgHTTP:
+        cfgHTTP.read_timeout = 15
+    if 'max_body' not in cfgHTTP:
+        cfgHTTP.max_body = 5 * 1024 * 1024
+    if 'user_agent' not in cfgHTTP:
+        cfgHTTP.user_agent = 'dainin (+https://github.com/bear/dainin)'
+
+    adapter = HTTPAdapter(pool_connections=cfgHTTP.pool_connections,
+                          pool_maxsize=cfgHTTP.pool_maxsize)
+    session = requests.Session()
+    session.mount('http://',  adapter)
+    session.mount('https://', adapter)
+    session.headers['User-Agent'] = cfgHTTP.user_agent
+
+    timeout = (cfgHTTP.connect_timeout, cfgHTTP.read_timeout)
+    maxBody = cfgHTTP.max_body
+    return session
+
+def getSession():
+    if session is None:
+        return initHTTP(Config())
+    return session
+
+def readBody(r, limit=None):
+    """Read the body of a streamed response, stopping at limit bytes.
+
+    The body is stored back on the response so that r.content and
+    r.text work as they would for a non-streamed request.
+    """
+    if limit is None:
+        limit = maxBody
+    length = r.headers.get('content-length')
+    if length is not None and length.isdigit() and int(length) > limit:
+        r.close()
+        raise BodyTooLarge('%s is %s bytes' % (r.url, length))
+
+    chunks = []
+    size   = 0
+    for chunk in r.iter_content(chunk_size=16384):
+        size += len(chunk)
+        if size > limit:
+            r.close()
+            raise BodyTooLarge('%s is larger than %d bytes' % (r.url, limit))
+        chunks.append(chunk)
+    r._content          = b''.join(chunks)
+    r._content_consumed = True
+    return r
+
+def request(method, url, **kwargs):
+    kwargs.setdefault('timeout', timeout)
+    if method == 'GET':
+        kwargs['stream'] = True
+        r = getSession().request(method, url, **kwargs)
+        return readBody(r)
+    else:
+        return getSession().request(method, url, **kwargs)
+
+def stream(url, **kwargs):
+    """Start a GET request and return the response without reading the
+    body, the caller is responsible for closing it.
+    """
+    kwargs.setdefault('timeout', timeout)
+    kwargs.setdefault('allow_redirects', True)
+    kwargs['stream'] = True
+    return getSession().get(url, **kwargs)
+
+def get(url, **kwargs):
+    kwargs.setdefault('allow_redirects', True)
+    return request('GET', url, **kwargs)
+
+def head(url, **kwargs):
+    kwargs.setdefault('allow_redirects', False)
+    return request('HEAD', url, **kwargs)
+
+def post(url, data=None, **kwargs):
+    return request('POST', url, data=data, **kwargs)
+
+
+class SessionRequests(object):
+    """Stand-in for the requests module that routes the common calls
+    through the shared session. Anything else is handed to requests.
+    """
+    codes = requests.codes
+
+    def get(self, url, **kwargs):
+        return get(url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return head(url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return post(url, data=data, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+def shareSession(*modules):
+    """Point the requests reference of each of the given modules at the
+    shared session.
+    """
+    for module in modules:
+        module.requests = SessionRequests()
@@ -9,22 +9,43 @@ events that IndieWeb sites require.
 """
 
 import os, sys
+import re
 import json
 import uuid
+import hashlib
+import math
+import time
 import urllib
 import logging
 import datetime
+import threading
 
-from urlparse import urlparse, ParseResult
+from urlparse import urlparse, urljoin, ParseResult
+from HTMLParser import HTMLParser, HTMLParseError
 
 import redis
 import requests
-import ronkyuu
-import ninka
+import vouches
+import tokens
+import authstore
+import ratelimit
+import singleflight
+import discovery
+import httpclient
+import events
+import sender
+import mentionstore
+import renderer
+import logqueue
+import metrics
+import media
+import posts
+import publish
+import jobqueue
+import notify
 
 from bearlib.config import Config
-from mf2py.parser import Parser
-from flask import Flask, request, redirect, render_template, session, flash
+from flask import Flask, Request, request, redirect, render_template, session, flash
 from flask.ext.wtf import Form
 from wtforms import TextField, HiddenField, BooleanField
 from wtforms.validators import Required
@@ -44,6 +65,25 @@ class TokenForm(Form):
     state        = TextField('state', validators = [])
 
 
+class SourceUnavailable(Exception):
+    pass
+
+
+class MediaRequest(Request):
+    """Request that has werkzeug write the file parts of a media upload
+    straight into the media directory, keeping track of them so any that
+    are not committed can be removed
+    """
+    uploads = ()
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.path != '/micropub/media':
+            return Request._get_file_stream(self, total_content_length, content_type, filename, content_length)
+        upload = media.Upload(content_type, filename)
+        self.uploads = self.uploads + (upload,)
+        return upload
+
+
 # check for uwsgi, use PWD if present or getcwd() if not
 _uwsgi = __name__.startswith('uwsgi')
 if _uwsgi:
@@ -54,10 +94,29 @@ else:
     _configFile = os.path.join(_ourPath, 'indieweb.cfg')
 
 app = Flask(__name__)
+app.request_class = MediaRequest
 app.config['SECRET_KEY'] = 'foo'  # replaced downstream
 cfg = None
 db  = None
 templateData = {}
+vouchDomains = None
+authStore    = None
+flights      = None
+limiter      = None
+slots        = None
+dispatcher   = None
+mentionStore = None
+indieAuth    = None
+webmention   = None
+pageRenderer = None
+postIndex    = None
+publisher    = None
+jobQueue     = None
+queryCache   = {}
+
+micropubContent = ('content', 'name', 'summary', 'photo', 'in-reply-to', 'repost-of', 'like-of', 'bookmark-of')
+micropubURLs    = ('in-reply-to', 'repost-of', 'like-of', 'bookmark-of', 'photo', 'video', 'audio', 'syndication')
+micropubDate    = re.compile(r'^\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}:?\d{2})?)?$')
 
 
 def baseDomain(domain, includeScheme=True):
@@ -74,17 +133,52 @@ def baseDomain(domain, includeScheme=True):
         result += url.netloc
     return result
 
+def getIndieAuth():
+    """Return ninka.indieauth, importing it on first use
+    """
+    global indieAuth
+    if indieAuth is None:
+        import ninka.indieauth
+        httpclient.shareSession(ninka.indieauth)
+        indieAuth = ninka.indieauth
+    return indieAuth
+
+def getWebmention():
+    """Return ronkyuu.webmention, importing it on first use
+    """
+    global webmention
+    if webmention is None:
+        import ronkyuu
+        httpclient.shareSession(ronkyuu.webmention, ronkyuu.tools, ronkyuu.relme)
+        webmention = ronkyuu.webmention
+    return webmention
+
+def getAuthStore():
+    """Return the redis backed login and token store, creating it on first use
+    """
+    global authStore
+    if authStore is None:
+        authStore = authstore.AuthStore(db, cfg.token_cache.ttl, cfg.token_cache.size,
+                                        cfg.tokens.session_lifetime, cfg.tokens.lifetime)
+    return authStore
+
+@app.before_first_request
+def startSweeper():
+    """Start the token sweeper of this process, every web and worker
+    process runs one and they take turns through the sweep lease
+    """
+    if db is not None and cfg.tokens.sweep_interval > 0:
+        sweeper = threading.Thread(target=getAuthStore().sweeper, args=(cfg.tokens.sweep_interval,))
+        sweeper.daemon = True
+        sweeper.start()
+
 def clearAuth():
     """Clear both the Session cookie and any stored token data
     """
     if 'indieauth_token' in session:
         indieauth_token = session['indieauth_token']
         if db is not None:
-            key = db.get('token-%s' % indieauth_token)
-            if key:
-                data = db.hgetall(key)
-                db.delete(key)
-                db.delete('token-%s' % indieauth_token)
+            getAuthStore().revokeToken(indieauth_token)
     session.pop('indieauth_token', None)
     session.pop('indieauth_scope', None)
     session.pop('indieauth_id', None)
@@ -99,20 +193,31 @@ def checkAuth():
         indieauth_token = session['indieauth_token']
         app.logger.info('session cookie found')
         if db is not None:
-            key = db.get('token-%s' % indieauth_token)
-            if key:
-                data = db.hgetall(key)
-                if data and data['token'] == indieauth_token:
-                    authed = True
+            if getAuthStore().checkToken(indieauth_token):
+                authed = True
     return authed, indieauth_id
 
+def checkAdmin():
+    """Check if the current session belongs to the owner of our_domain
+    """
+    authed, indieauth_id = checkAuth()
+    return authed and baseDomain(indieauth_id, includeScheme=False) == cfg.our_domain
+
 def checkAccessToken(access_token):
     """Check if the given access token matches any in the data stored
     """
     client_id  = None
     me         = None
     scope      = None
-    key        = db.get('token-%s' % access_token)
+    if tokens.isSigned(access_token):
+        data = tokens.verifyToken(cfg.secret, access_token)
+        if data is not None and not getAuthStore().isRevoked(data['jti']):
+            me        = data['me']
+            client_id = data['cid']
+            scope     = data['scp']
+        return me, client_id, scope
+
+    key        = getAuthStore().lookupToken(access_token)
     if key:
         data      = key.split('-')
         me        = data[1]
@@ -121,25 +226,65 @@ def checkAccessToken(access_token):
 
     return me, client_id, scope
 
+def canCreate(scope):
+    """Check if a token scope allows creating posts and media
+    """
+    return 'create' in (scope or '').split() or 'post' in (scope or '').split()
+
+def insufficientScope():
+    return (json.dumps({ 'error': 'insufficient_scope', 'error_description': 'the create or post scope is required' }),
+            403, { 'Content-Type': 'application/json' })
+
 @app.route('/logout', methods=['GET'])
 def handleLogout():
-    app.logger.info('handleLogout [%s]' % request.method)
+    app.logger.info('handleLogout [%s]', request.method)
     clearAuth()
     return redirect('/')
 
+@app.route('/admin/discovery', methods=['POST'])
+def handleDiscoveryInvalidate():
+    app.logger.info('handleDiscoveryInvalidate [%s]', request.method)
+    if not checkAdmin():
+        return 'unauthorized', 401
+    url = request.form.get('url')
+    if not url:
+        return 'url is required', 400
+    discovery.invalidate(url)
+    return 'invalidated %s' % url, 200
+
+@app.route('/admin/tokens', methods=['GET'])
+def handleTokenStats():
+    app.logger.info('handleTokenStats [%s]', request.method)
+    if not checkAdmin():
+        return 'unauthorized', 401
+    return (json.dumps(getAuthStore().stats()), 200, {'Content-Type': 'application/json'})
+
+@app.route('/admin/events', methods=['GET'])
+def handleEventStats():
+    app.logger.info('handleEventStats [%s]', request.method)
+    if not checkAdmin():
+        return 'unauthorized', 401
+    return (json.dumps(getDispatcher().getStats()), 200, {'Content-Type': 'application/json'})
+
+@app.route('/metrics', methods=['GET'])
+def handleMetrics():
+    return (metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'})
+
 @app.route('/login', methods=['GET', 'POST'])
+@metrics.timed('login')
 def handleLogin():
-    app.logger.info('handleLogin [%s]' % request.method)
+    app.logger.info('handleLogin [%s]', request.method)
 
     form = LoginForm(me='', client_id=cfg['client_id'], 
                      redirect_uri='%s/success' % cfg['baseurl'], 
                      from_uri=request.args.get('from_uri'))
 
     if form.validate_on_submit():
-        app.logger.info('me [%s]' % form.me.data)
+        app.logger.info('me [%s]', form.me.data)
 
-        me            = baseDomain(form.me.data)
-        authEndpoints = ninka.indieauth.discoverAuthEndpoints(me)
+        me = baseDomain(form.me.data)
+        with metrics.timer('login_discovery'):
+            authEndpoints = discovery.authEndpoints(me)
 
         if 'authorization_endpoint' in authEndpoints:
             authURL = None
@@ -160,16 +305,12 @@ def handleLogin():
                                                    }),
                                   authURL.fragment).geturl()
                 if db is not None:
-                    key = 'login-%s' % me
-                    data = db.hgetall(key)
-                    if data: # clear any existing auth data
-                        db.delete('token-%s' % data['token'])
-                        db.hdel(key, 'token')
-                    db.hset(key, 'from_uri',     form.from_uri.data)
-                    db.hset(key, 'redirect_uri', form.redirect_uri.data)
-                    db.hset(key, 'client_id',    form.client_id.data)
-                    db.hset(key, 'scope',        'post')
-                    db.expire(key, cfg['auth_timeout']) # expire in N minutes unless successful
+                    # clears any existing auth data and expires in N minutes unless successful
+                    getAuthStore().startLogin(me, { 'from_uri':     form.from_uri.data,
+                                                    'redirect_uri': form.redirect_uri.data,
+                                                    'client_id':    form.client_id.data,
+                                                    'scope':        'post',
+                                                  }, cfg['auth_timeout'])
                 return redirect(url)
         else:
             return 'insert fancy no auth endpoint found error message here', 403
@@ -180,30 +321,28 @@ def handleLogin():
 
 @app.route('/success', methods=['GET',])
 def handleLoginSuccess():
-    app.logger.info('handleLoginSuccess [%s]' % request.method)
+    app.logger.info('handleLoginSuccess [%s]', request.method)
     me   = request.args.get('me')
     code = request.args.get('code')
-    app.logger.info('me [%s] code [%s]' % (me, code))
+    app.logger.info('me [%s] code [%s]', me, code)
+    scope    = None
+    from_uri = None
 
     if db is not None:
         app.logger.info('getting data to validate auth code')
-        key  = 'login-%s' % me
-        data = db.hgetall(key)
+        data = getAuthStore().getLogin(me)
         if data:
-            r = ninka.indieauth.validateAuthCode(code=code, 
-                                                 client_id=me,
-                                                 redirect_uri=data['redirect_uri'])
+            r = getIndieAuth().validateAuthCode(code=code, 
+                                                client_id=me,
+                                                redirect_uri=data['redirect_uri'])
             if r['status'] == requests.codes.ok:
                 app.logger.info('login code verified')
                 scope    = r['response']['scope']
                 from_uri = data['from_uri']
                 token    = str(uuid.uuid4())
 
-                db.hset(key, 'code',  code)
-                db.hset(key, 'token', token)
-                db.expire(key, cfg['auth_timeout'])
-                db.set('token-%s' % token, key)
-                db.expire('token-%s' % code, cfg['auth_timeout'])
+                getAuthStore().completeLogin(me, code, token)
+                notify.notify('login', me=me)
 
                 session['indieauth_token'] = token
                 session['indieauth_scope'] = scope
@@ -212,7 +351,7 @@ def handleLoginSuccess():
                 app.logger.info('login invalid')
                 clearAuth()
         else:
-            app.logger.info('nothing found for [%s]' % me)
+            app.logger.info('nothing found for [%s]', me)
 
     if scope:
         if from_uri:
@@ -224,16 +363,13 @@ def handleLoginSuccess():
 
 @app.route('/auth', methods=['GET',])
 def handleAuth():
-    app.logger.info('handleAuth [%s]' % request.method)
+    app.logger.info('handleAuth [%s]', request.method)
     result = False
     if db is not None:
         token = request.args.get('token')
         if token is not None:
-            me = db.get('token-%s' % token)
-            if me:
-                data = db.hgetall(me)
-                if data and data['token'] == token:
-                    result = True
+            if getAuthStore().checkToken(token):
+                result = True
     if result:
         return 'valid', 200
     else:
@@ -243,63 +379,263 @@ def handleAuth():
         return 'invalid', 403
 
 
-def handleMicropubEntry(data):
-    # do something with the parameters sent by the micropub client
-    # and return the new location and a 2## code
-    return cfg.baseurl, 200
-
-def processMicropub(data):
-    if request.method == 'POST':
-        if data['action'] not in ('entry',):
-            return ('Micropub CREATE requires a valid action parameter', 400, [])
-        else:
-            location = None
-            code     = 400
-            action   = data['action'].lower()
-
-            if action == 'entry':
-                location, code = handleEntry(data)
-
-            if code in (200,202,):
-                return ('Micropub CREATE %s successful for %s' % (action, location), code, {'Location': location})
-            else:
-                return ('Micropub CREATE %s failed for %s' % (action, location), code, {})
+def readMicropubRequest():
+    """Return the action, h type and properties of a Micropub POST, form
+    encoded or json, with every property as a list of strings
+    """
+    properties = {}
+    if request.mimetype == 'application/json':
+        data   = request.get_json(silent=True) or {}
+        action = data.get('action', 'create')
+        h      = (data.get('type') or ['h-entry'])[0]
+        for key, values in (data.get('properties') or {}).items():
+            if not isinstance(values, list):
+                values = [values]
+            for value in values:
+                if isinstance(value, dict):
+                    value = value.get('html', value.get('value'))
+                properties.setdefault(key, []).append(value)
     else:
-        return ('Unable to process Micropub %s' % request.method, 400, [])
+        action = request.form.get('action', 'create')
+        h      = request.form.get('h', 'entry')
+        for key in request.form:
+            if key not in ('h', 'action', 'access_token'):
+                name = key[:-2] if key.endswith('[]') else key
+                properties.setdefault(name, []).extend(request.form.getlist(key))
+    if h.startswith('h-'):
+        h = h[2:]
+    for old, new in (('slug', 'mp-slug'), ('syndicate-to', 'mp-syndicate-to')):
+        if old in properties:
+            properties.setdefault(new, []).extend(properties.pop(old))
+    result = {}
+    for key, values in properties.items():
+        values = [value.strip() for value in values if isinstance(value, basestring) and value.strip()]
+        if values:
+            result[key] = values
+    return action.lower(), h.lower(), result
+
+def validateEntry(properties):
+    """Return why the properties are not a valid h-entry, or None
+    """
+    if not any([key in properties for key in micropubContent]):
+        return 'an h-entry needs content, a name or a url it is about'
+    for key in micropubURLs:
+        for value in properties.get(key, []):
+            if urlparse(value).scheme not in ('http', 'https'):
+                return '%s must be an http or https url' % key
+    for value in properties.get('published', []):
+        if not micropubDate.match(value):
+            return 'published must be an ISO 8601 date'
+    allowed = [target['uid'] for target in cfg.micropub.syndicate_to]
+    for value in properties.get('mp-syndicate-to', []):
+        if value not in allowed:
+            return 'unknown syndication target %s' % value
+    return None
+
+def handleMicropubEntry(properties):
+    """Write the source file of a new post and queue its background steps.
+    Only the one file and its index entry are written before returning, so
+    the time taken does not depend on the size of the site.
+    """
+    now = datetime.datetime.utcnow()
+    if 'published' not in properties:
+        properties['published'] = [now.strftime('%Y-%m-%dT%H:%M:%SZ')]
+    words = ' '.join(re.sub(r'<[^>]*>', ' ', properties.get('content', [''])[0]).split()[:6])
+    slug  = posts.slugify((properties.get('mp-slug') or properties.get('name') or [words])[0]) or now.strftime('%H%M%S')
+
+    syndicateTo = properties.get('mp-syndicate-to', [])
+    for key in properties.keys():
+        if key.startswith('mp-'):
+            del properties[key]
+
+    filename = posts.createPost(properties['published'][0][:4], slug, 'entry', properties)
+    entry    = getPostIndex().indexFile(filename)
+    jobId    = str(uuid.uuid4())
+    getPublisher().submit(jobId, { 'url':         entry['url'],
+                                   'filename':    filename,
+                                   'properties':  properties,
+                                   'syndicateTo': syndicateTo,
+                                 })
+    return entry['url'], jobId
+
+@metrics.timed('micropub_create')
+def processMicropub(action, h, properties):
+    if action != 'create':
+        return ('Micropub %s is not supported' % action, 400, {})
+    if h != 'entry':
+        return ('Micropub CREATE only supports h-entry', 400, {})
+
+    error = validateEntry(properties)
+    if error is not None:
+        return (json.dumps({ 'error': 'invalid_request', 'error_description': error }),
+                400, { 'Content-Type': 'application/json' })
+
+    location, jobId = handleMicropubEntry(properties)
+    app.logger.info('micropub created %s job %s', location, jobId)
+    return ('Micropub CREATE entry successful for %s' % location, 202,
+            { 'Location': location,
+              'Link':     '<%s/micropub/status/%s>; rel="status"' % (cfg.baseurl, jobId),
+            })
 
 @app.route('/micropub', methods=['GET', 'POST', 'PATCH', 'PUT', 'DELETE'])
 def handleMicroPub():
-    app.logger.info('handleMicroPub [%s]' % request.method)
+    app.logger.info('handleMicroPub [%s]', request.method)
 
     access_token = request.headers.get('Authorization')
     if access_token:
         access_token = access_token.replace('Bearer ', '')
     me, client_id, scope = checkAccessToken(access_token)
 
-    app.logger.info('micropub %s [%s] [%s, %s, %s]' % (request.method, access_token, me, client_id, scope))
+    app.logger.info('micropub %s [%s, %s, %s]', request.method, me, client_id, scope)
 
     if me is None or client_id is None:
         return ('Invalid access_token', 400, {})
     else:
         if request.method == 'POST':
                 domain = baseDomain(me, includeScheme=False)
-                
-                if domain == cfg.our_domain:
-                    data = {}
-                    for key in ('h', 'name', 'summary', 'content', 'published', 'updated', 'category', 
-                                'slug', 'location', 'in-reply-to', 'repost-of', 'syndication', 'syndicate-to'):
-                        data[key] = request.form.get(key)
 
-                    return processMicropub(me, client_id, scope, data)
+                if domain == cfg.our_domain:
+                    if not canCreate(scope):
+                        return insufficientScope()
+                    action, h, properties = readMicropubRequest()
+                    return processMicropub(action, h, properties)
                 else:
                     return 'unauthorized', 401
         elif request.method == 'GET':
-            # add support for /micropub?q=syndicate-to
-            return 'not implemented', 501
+            if baseDomain(me, includeScheme=False) != cfg.our_domain:
+                return 'unauthorized', 401
+            return handleMicropubQuery()
+        else:
+            return ('Unable to process Micropub %s' % request.method, 400, {})
+
+@app.route('/micropub/status/<jobId>', methods=['GET'])
+def handleMicropubStatus(jobId):
+    app.logger.info('handleMicropubStatus [%s]', jobId)
+    data = None
+    if db is not None:
+        data = getPublisher().getStatus(jobId)
+    if data:
+        return (json.dumps(data), 200, {'Content-Type': 'application/json'})
+    else:
+        return 'unknown micropub post', 404
+
+def buildQuery(q):
+    """Return the body and etag of a q=config or q=syndicate-to response.
+    They only depend on the configuration so each is built once for every
+    configuration that is loaded.
+    """
+    if q not in queryCache:
+        body = { 'syndicate-to': list(cfg.micropub.syndicate_to) }
+        if q == 'config':
+            body['media-endpoint'] = '%s/micropub/media' % cfg.baseurl
+        data = json.dumps(body, sort_keys=True)
+        queryCache[q] = (data, hashlib.sha1(data).hexdigest())
+    return queryCache[q]
+
+def queryResponse(data, etag, cacheControl):
+    """Return a json response that is a 304 when the client already has it
+    """
+    response = app.response_class(data, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cacheControl
+    response.headers['Vary']          = 'Authorization'
+    return response.make_conditional(request)
+
+@metrics.timed('micropub_query')
+def handleMicropubQuery():
+    q = request.args.get('q')
+    if q in ('config', 'syndicate-to'):
+        data, etag = buildQuery(q)
+        return queryResponse(data, etag, 'private, max-age=%d' % cfg.micropub.query_max_age)
+    elif q == 'source':
+        url   = request.args.get('url')
+        entry = None
+        if url:
+            entry = getPostIndex().lookup(url)
+        if entry is None:
+            return (json.dumps({ 'error': 'invalid_request', 'error_description': 'no post found for url' }),
+                    400, { 'Content-Type': 'application/json' })
+        wanted = request.args.getlist('properties[]') or request.args.getlist('properties')
+        if wanted:
+            body = { 'properties': dict([(k, v) for k, v in entry['properties'].items() if k in wanted]) }
+            etag = hashlib.sha1(('%s %s' % (entry['etag'], ' '.join(sorted(wanted)))).encode('utf-8')).hexdigest()
+        else:
+            body = { 'type': ['h-%s' % entry['h']], 'properties': entry['properties'] }
+            etag = entry['etag']
+        # the etag changes with the post so clients revalidate every time
+        return queryResponse(json.dumps(body), etag, 'private, no-cache')
+    return ('Unknown Micropub query %s' % q, 400, {})
+
+@app.route('/micropub/media', methods=['POST'])
+@metrics.timed('media')
+def handleMicropubMedia():
+    app.logger.info('handleMicropubMedia [%s]', request.content_length)
+
+    # only the header is looked at, a token in the form would mean
+    # reading the whole upload before knowing if it is wanted
+    access_token = request.headers.get('Authorization')
+    if access_token:
+        access_token = access_token.replace('Bearer ', '')
+    me, client_id, scope = checkAccessToken(access_token)
+
+    if me is None or client_id is None:
+        return ('Invalid access_token', 401, {})
+    if baseDomain(me, includeScheme=False) != cfg.our_domain:
+        return ('unauthorized', 401, {})
+    if not canCreate(scope):
+        return insufficientScope()
+    if media.tooLarge(request.content_length):
+        return ('upload is larger than %d bytes' % media.maxBytes, 413, {})
+
+    try:
+        if request.mimetype == 'multipart/form-data':
+            part = request.files.get('file')
+            if part is None:
+                return ('a file part is required', 400, {})
+            upload = part.stream
+        else:
+            upload = media.Upload(request.mimetype)
+            request.uploads += (upload,)
+            upload.readFrom(request.stream)
+
+        if not media.allowedType(upload.contentType):
+            return ('unsupported media type %s' % upload.contentType, 415, {})
+
+        name, created = upload.commit()
+    except media.TooLarge:
+        return ('upload is larger than %d bytes' % media.maxBytes, 413, {})
+    finally:
+        for item in request.uploads:
+            item.close()
+
+    location = media.mediaURL(name)
+    app.logger.info('media %s %s bytes new %s', location, upload.size, created)
+    if created:
+        getDispatcher().dispatch(events.MEDIA_UPLOAD, { 'url':         location,
+                                                        'filename':    media.mediaFile(name),
+                                                        'contentType': upload.contentType,
+                                                        'sha256':      upload.digest.hexdigest(),
+                                                        'size':        upload.size,
+                                                      }, key=name)
+    return ('', 201, { 'Location': location })
+
+def revokeAccessToken(token):
+    """Revoke an access token, signed tokens are added to the revocation
+    list and stored tokens are removed.
+    """
+    if tokens.isSigned(token):
+        data = tokens.verifyToken(cfg.secret, token)
+        if data is not None:
+            getAuthStore().revokeSigned(data['jti'], data.get('exp'))
+    elif token:
+        getAuthStore().revokeToken(token)
+    # per the spec the response is 200 even if the token was not valid
+    return 'revoked', 200
 
 @app.route('/token', methods=['POST', 'GET'])
+@metrics.timed('token')
 def handleToken():
-    app.logger.info('handleToken [%s]' % request.method)
+    app.logger.info('handleToken [%s]', request.method)
 
     if request.method == 'GET':
         access_token = request.headers.get('Authorization')
@@ -318,28 +654,32 @@ def handleToken():
             return (urllib.urlencode(params), 200, {'Content-Type': 'application/x-www-form-urlencoded'})
 
     elif request.method == 'POST':
+        if request.form.get('action') == 'revoke':
+            return revokeAccessToken(request.form.get('token'))
+
         code         = request.form.get('code')
         me           = request.form.get('me')
         redirect_uri = request.form.get('redirect_uri')
         client_id    = request.form.get('client_id')
         state        = request.form.get('state')
 
-        r = ninka.indieauth.validateAuthCode(code=code, 
-                                             client_id=me,
-                                             state=state,
-                                             redirect_uri=redirect_uri)
+        with metrics.timer('token_validate_code'):
+            r = getIndieAuth().validateAuthCode(code=code, 
+                                                client_id=me,
+                                                state=state,
+                                                redirect_uri=redirect_uri)
         if r['status'] == requests.codes.ok:
             app.logger.info('token request auth code verified')
             scope = r['response']['scope']
-            key   = 'app-%s-%s-%s' % (me, client_id, scope)
-            token = db.get(key)
-            if token is None:
-                token     = str(uuid.uuid4())
-                token_key = 'token-%s' % token
-                db.set(key, token)
-                db.set(token_key, key)
+            if isinstance(scope, list):
+                scope = ' '.join(scope)
+            if cfg.tokens.format == 'signed':
+                key   = 'signed'
+                token = tokens.signToken(cfg.secret, me, client_id, scope, cfg.tokens.lifetime)
+            else:
+                key, token = getAuthStore().accessToken(me, client_id, scope, str(uuid.uuid4()))
 
-            app.logger.info('[%s] [%s]' % (key, token))
+            app.logger.info('issued %s token for [%s] [%s] [%s]', key.split('-')[0], me, client_id, scope)
 
             params = { 'me': me,
                        'scope': scope,
@@ -347,12 +687,13 @@ def handleToken():
                      }
             return (urllib.urlencode(params), 200, {'Content-Type': 'application/x-www-form-urlencoded'})
 
+@metrics.timed('target_head')
 def validURL(targetURL):
     """Validate the target URL exists by making a HEAD request for it
     """
     result = 404
     try:
-        r = requests.head(targetURL)
+        r = httpclient.head(targetURL)
         result = r.status_code
     except:
         result = 404
@@ -374,6 +715,71 @@ def extractHCard(mf2Data):
                     result['url'] = item['properties']['url']
     return result
 
+def getMentionStore():
+    """Return the store of accepted mentions, opening it on first use
+    """
+    global mentionStore
+    if mentionStore is None:
+        if 'path' in cfg.mentions:
+            path = cfg.mentions.path
+        else:
+            path = os.path.join(cfg['basepath'], 'mentions.db')
+        mentionStore = mentionstore.MentionStore(path)
+    return mentionStore
+
+def getPostIndex():
+    """Return the index of post source files, opening it on first use
+    """
+    global postIndex
+    if postIndex is None:
+        if 'index' in cfg.posts:
+            path = cfg.posts.index
+        else:
+            path = os.path.join(cfg['basepath'], 'posts.db')
+        postIndex = posts.PostIndex(path)
+    return postIndex
+
+def getJobQueue():
+    """Return the redis work queue of Webmention jobs
+    """
+    global jobQueue
+    if jobQueue is None:
+        jobQueue = jobqueue.JobQueue(db, cfg.queue.name, cfg.queue.lease, cfg.queue.poll)
+    return jobQueue
+
+def getPublisher():
+    """Return the publisher of new posts, starting its thread on first use.
+    Posts wait in a redis queue, so those of a process that stops are
+    picked up by the publisher of another one.
+    """
+    global publisher
+    if publisher is None:
+        queue     = jobqueue.JobQueue(db, cfg.posts.queue, cfg.queue.lease, cfg.queue.poll)
+        publisher = publish.Publisher(db, queue, getDispatcher(), cfg.posts.build_command,
+                                      cfg.queue.status_ttl, cfg.posts.publish_timeout)
+        publisher.start()
+    return publisher
+
+def getRenderer():
+    """Return the renderer of mention fragments, starting it on first use
+    """
+    global pageRenderer
+    if pageRenderer is None:
+        pageRenderer = renderer.Renderer(getMentionStore(), cfg.contentpath, cfg.baseurl, noteTemplate,
+                                         cfg.render['marker'], cfg.render.delay)
+        pageRenderer.start()
+    return pageRenderer
+
+def getVouchDomains():
+    """Return the in-memory list of accepted vouch domains, loading it on first use
+    """
+    global vouchDomains
+    if vouchDomains is None:
+        vouchDomains = vouches.VouchDomains(os.path.join(cfg['basepath'], 'vouch_domains.txt'))
+        vouchDomains.load()
+    return vouchDomains
+
+@metrics.timed('vouch')
 def processVouch(sourceURL, targetURL, vouchDomain):
     """Determine if a vouch domain is valid.
 
@@ -385,18 +791,14 @@ def processVouch(sourceURL, targetURL, vouchDomain):
 
     yep, super simple but enough for me to test implement vouches
     """
-    vouchFile = os.path.join(cfg['basepath'], 'vouch_domains.txt')
-    with open(vouchFile, 'r') as h:
-        vouchDomains = []
-        for domain in h.readlines():
-            vouchDomains.append(domain.strip().lower())
-
-    if vouchDomain.lower() in vouchDomains:
+    result = False
+    if vouchDomain in getVouchDomains():
         result = True
     else:
-        wmStatus, wmUrl = ronkyuu.discoverEndpoint(vouchDomain, test_urls=False)
+        # one cached discovery fetch answers both the webmention and indieauth checks
+        wmStatus, wmUrl = discovery.webmentionEndpoint(vouchDomain)
         if wmUrl is not None and wmStatus == 200:
-            authEndpoints = ninka.indieauth.discoverAuthEndpoints(vouchDomain)
+            authEndpoints = discovery.authEndpoints(vouchDomain)
 
             if 'authorization_endpoint' in authEndpoints:
                 authURL = None
@@ -405,105 +807,524 @@ def processVouch(sourceURL, targetURL, vouchDomain):
                     break
                 if authURL is not None:
                     result = True
-                    with open(vouchFile, 'a+') as h:
-                        h.write('\n%s' % vouchDomain)
+                    getVouchDomains().add(vouchDomain, { 'source':                 sourceURL,
+                                                         'target':                 targetURL,
+                                                         'webmention':             wmUrl,
+                                                         'authorization_endpoint': authURL.geturl(),
+                                                       })
+    return result
 
-def processWebmention(sourceURL, targetURL, vouchDomain=None):
+class LinkScanner(HTMLParser):
+    """Incremental html parser that watches for a link to targetURL
+    as the chunks of a page are fed to it.
+    """
+    def __init__(self, sourceURL, targetURL):
+        HTMLParser.__init__(self)
+        self.sourceURL = sourceURL
+        self.targetURL = targetURL
+        self.found     = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a' and not self.found:
+            for name, value in attrs:
+                if name == 'href' and value and urljoin(self.sourceURL, value.strip()) == self.targetURL:
+                    self.found = True
+
+htmlTypes = ('text/html', 'application/xhtml+xml')
+
+@metrics.timed('source_fetch')
+def fetchSource(sourceURL, targetURL=None, etag=None, lastModified=None):
+    """Retrieve and parse the source of a Webmention.
+
+    The source is downloaded and parsed only once, the returned dict
+    carries the status, headers, content and the BeautifulSoup document
+    so that the link check and the mf2 parse can share them.
+
+    The body is streamed and a source larger than cfg.http.max_body is
+    rejected with a 413 status, as is anything that is not html, so a
+    truncated document is never parsed or stored. If targetURL is given
+    each chunk is scanned as it arrives, until a link to targetURL is
+    found, and the 'linked' result says if there was one. A source that
+    does not link to the target is not parsed at all.
+
+    The etag and lastModified values of an earlier fetch are sent as
+    conditional headers, an unchanged source returns a 304 status. A
+    source that cannot be fetched returns a 502 status and the error.
+    """
+    result  = { 'status':  None,
+                'headers': {},
+                'content': None,
+                'doc':     None,
+                'linked':  None,
+                'hash':    None,
+                'error':   None,
+              }
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if lastModified:
+        headers['If-Modified-Since'] = lastModified
+    try:
+        r = httpclient.stream(sourceURL, verify=False, headers=headers)
+    except requests.RequestException as e:
+        app.logger.info('unable to fetch source %s: %s', sourceURL, e)
+        result['status'] = 502
+        result['error']  = str(e)
+        return result
+    try:
+        result['status']  = r.status_code
+        result['headers'] = r.headers
+        if r.status_code != requests.codes.ok:
+            return result
+
+        contentType = r.headers.get('content-type', '').split(';')[0].strip().lower()
+        if contentType and contentType not in htmlTypes:
+            app.logger.info('source rejected, content-type is %s', contentType)
+            result['status'] = 415
+            return result
+
+        scanner = None
+        if targetURL is not None:
+            scanner = LinkScanner(sourceURL, targetURL)
+        chunks = []
+        size   = 0
+        digest = hashlib.sha1()
+        for chunk in r.iter_content(chunk_size=16384):
+            size += len(chunk)
+            if size > httpclient.maxBody:
+                app.logger.info('source %s rejected, it is larger than %d bytes', sourceURL, httpclient.maxBody)
+                result['status'] = 413
+                return result
+            chunks.append(chunk)
+            digest.update(chunk)
+            if scanner is not None and not scanner.found:
+                try:
+                    scanner.feed(chunk)
+                except HTMLParseError:
+                    # leave the link check to the full parse below
+                    scanner = None
+    except requests.RequestException as e:
+        app.logger.info('unable to read source %s: %s', sourceURL, e)
+        result['status'] = 502
+        result['error']  = str(e)
+        return result
+    finally:
+        r.close()
+
+    content        = b''.join(chunks)
+    result['hash'] = digest.hexdigest()
+    if scanner is not None:
+        result['linked'] = scanner.found
+    if 'charset' in r.headers.get('content-type', ''):
+        content = content.decode(r.encoding, 'replace')
+    result['content'] = content
+    if result['linked'] is not False:
+        from bs4 import BeautifulSoup
+        result['doc'] = BeautifulSoup(content, 'html.parser')
+    return result
+
+@metrics.timed('process')
+def processWebmention(sourceURL, targetURL, vouchDomain=None, source=None):
     result = False
-    r      = requests.get(sourceURL, verify=False)
-    if r.status_code == requests.codes.ok:
+    if source is None:
+        source = fetchSource(sourceURL)
+    if source['status'] == requests.codes.ok:
         mentionData = { 'sourceURL':   sourceURL,
                         'targetURL':   targetURL,
                         'vouchDomain': vouchDomain,
                         'vouched':     False,
                         'received':    datetime.date.today().strftime('%d %b %Y %H:%M'),
-                        'postDate':    datetime.date.today().strftime('%Y-%m-%dT%H:%M:%S')
+                        'postDate':    datetime.date.today().strftime('%Y-%m-%dT%H:%M:%S'),
+                        'receivedAt':  time.time(),
+                        'content':     source['content'],
                       }
-        if 'charset' in r.headers.get('content-type', ''):
-            mentionData['content'] = r.text
-        else:
-            mentionData['content'] = r.content
 
         if vouchDomain is not None and cfg['require_vouch']:
             mentionData['vouched'] = processVouch(sourceURL, targetURL, vouchDomain)
             result                 = mentionData['vouched']
-            app.logger.info('result of vouch? %s' % result)
+            app.logger.info('result of vouch? %s', result)
         else:
             result = not cfg['require_vouch']
-            app.logger.info('no vouch domain, result %s' % result)
+            app.logger.info('no vouch domain, result %s', result)
 
-        mf2Data = Parser(doc=mentionData['content']).to_dict()
+        from mf2py.parser import Parser
+        with metrics.timer('mf2_parse'):
+            mf2Data = Parser(doc=source['doc'], url=sourceURL).to_dict()
         hcard   = extractHCard(mf2Data)
 
         mentionData['hcardName'] = hcard['name']
         mentionData['hcardURL']  = hcard['url']
         mentionData['mf2data']   = mf2Data
 
-        # Do something with the inbound mention
+        if result:
+            with metrics.timer('mention_store'):
+                getMentionStore().add(mentionData)
+            getRenderer().schedule(targetURL)
+            getDispatcher().dispatch(events.WEBMENTION_INBOUND, mentionData, key=targetURL)
+            notify.notify('webmention', source=sourceURL, target=targetURL)
 
     return result
 
+def sourceCacheKey(sourceURL, targetURL, vouchDomain=None):
+    return 'source-%s' % hashlib.sha1('%s %s %s' % (sourceURL, targetURL, vouchDomain)).hexdigest()
+
+def getSourceCache(sourceURL, targetURL, vouchDomain=None):
+    """Return what we know about the last verification of the given
+    source, target and vouch, or an empty dict.
+    """
+    if db is None:
+        return {}
+    return db.hgetall(sourceCacheKey(sourceURL, targetURL, vouchDomain))
+
+def setSourceCache(sourceURL, targetURL, vouchDomain, source, result):
+    """Remember the validators and content hash of a successful
+    verification so an unchanged source can be skipped next time. A
+    failed verification drops what was known, the source is checked in
+    full again next time.
+    """
+    if db is None:
+        return
+    key  = sourceCacheKey(sourceURL, targetURL, vouchDomain)
+    if not result:
+        db.delete(key)
+        return
+    data = { 'hash':          source['hash'] or '',
+             'result':        1,
+             'etag':          source['headers'].get('etag', ''),
+             'last_modified': source['headers'].get('last-modified', ''),
+           }
+    pipe = db.pipeline()
+    pipe.delete(key)
+    pipe.hmset(key, data)
+    pipe.expire(key, cfg.source_cache.ttl)
+    pipe.execute()
+
+@metrics.timed('mention')
 def mention(sourceURL, targetURL, vouchDomain=None):
     """Process the Webmention of the targetURL from the sourceURL.
 
     To verify that the sourceURL has indeed referenced our targetURL
-    we run findMentions() at it and scan the resulting href list.
+    the source is scanned for a link to it while it is downloaded,
+    falling back to findMentions() if the page could not be scanned.
+    The source is fetched once and the parsed document is handed to
+    processWebmention().
+
+    Repeat Webmentions of a source that was accepted before use a
+    conditional GET and if the source has not changed, either a 304 or
+    the same content hash as last time, it is accepted again without any
+    parsing or processing. Failures are never replayed.
     """
-    app.logger.info('discovering Webmention endpoint for %s' % sourceURL)
-
-    mentions = ronkyuu.findMentions(sourceURL)
-    result   = False
-    app.logger.info('mentions %s' % mentions)
-    for href in mentions['refs']:
-        if href != sourceURL and href == targetURL:
-            app.logger.info('post at %s was referenced by %s' % (targetURL, sourceURL))
+    app.logger.info('discovering Webmention endpoint for %s', sourceURL)
 
-            result = processWebmention(sourceURL, targetURL, vouchDomain)
-    app.logger.info('mention() returning %s' % result)
+    cached = getSourceCache(sourceURL, targetURL, vouchDomain)
+    if cached.get('result') != '1':
+        cached = {}
+    source = fetchSource(sourceURL, targetURL, cached.get('etag'), cached.get('last_modified'))
+    result = False
+    if cached and (source['status'] == 304 or (source['status'] == requests.codes.ok and source['hash'] == cached['hash'])):
+        app.logger.info('source %s is unchanged, mention() returning True', sourceURL)
+        return True
+
+    if source['status'] == 502:
+        raise SourceUnavailable(source['error'])
+    if source['status'] != requests.codes.ok:
+        app.logger.info('source %s returned %s', sourceURL, source['status'])
+        return result
+
+    linked = source['linked']
+    if linked is None:
+        with metrics.timer('find_mentions'):
+            mentions = getWebmention().findMentions(sourceURL, content=source['doc'])
+        app.logger.debug('mentions %s', mentions['refs'])
+        linked   = targetURL in mentions['refs']
+    if linked and sourceURL != targetURL:
+        app.logger.info('post at %s was referenced by %s', targetURL, sourceURL)
+
+        result = processWebmention(sourceURL, targetURL, vouchDomain, source)
+    setSourceCache(sourceURL, targetURL, vouchDomain, source, result)
+    app.logger.info('mention() returning %s', result)
     return result
 
+def verifyWebmention(sourceURL, targetURL, vouchDomain=None):
+    """Run the full Webmention verification for the given source and target.
+
+    Returns a tuple of (status code, message) so that both the inline
+    handler and the queue workers can report the same result.
+    """
+    valid = validURL(targetURL)
+
+    app.logger.info('valid? %s', valid)
+
+    if valid == requests.codes.ok:
+        try:
+            accepted = mention(sourceURL, targetURL, vouchDomain)
+        except SourceUnavailable as e:
+            return 502, 'unable to fetch the source: %s' % e
+        if accepted:
+            return 200, 'Webmention accepted'
+        else:
+            if vouchDomain is None and cfg['require_vouch']:
+                return 449, 'Vouch required for webmention'
+            else:
+                return 400, 'Webmention is invalid'
+    else:
+        return 404, 'invalid post'
+
+def finalResult(result):
+    """Only final outcomes are shared with later requests, a source that
+    could not be fetched is fetched again by the next one
+    """
+    return result[0] != 502
+
+def getFlights():
+    """Return the single-flight helper used for Webmention verification
+    """
+    global flights
+    if flights is None:
+        flights = singleflight.SingleFlight(db, 'webmention', cfg.singleflight.lease,
+                                            cfg.singleflight.result_ttl, cfg.singleflight.wait,
+                                            keep=finalResult)
+    return flights
+
+def getDispatcher():
+    """Return the event dispatcher, starting its worker threads on first use
+    """
+    global dispatcher
+    if dispatcher is None:
+        dispatcher = events.Dispatcher(events.plugins, cfg.events.workers,
+                                       cfg.events.timeout, cfg.events.queue_size)
+        events.current = dispatcher
+    return dispatcher
+
+def getLimiter():
+    global limiter, slots
+    if limiter is None:
+        limiter = ratelimit.RateLimiter(db)
+        slots   = ratelimit.Slots(db, 'outbound-slots', cfg.limits.max_inflight, cfg.limits.inflight_lease)
+    return limiter
+
+def checkRateLimit(sourceURL, remoteAddr):
+    """Charge a Webmention to the buckets of its source domain and the
+    client address. Returns 0 or the seconds to wait before trying again.
+    """
+    if db is None:
+        return 0
+    domain = urlparse(sourceURL or '').netloc.lower()
+    return getLimiter().check([ ('source-%s' % domain, cfg.limits.source_per_minute / 60.0, cfg.limits.source_burst),
+                                ('ip-%s' % remoteAddr, cfg.limits.ip_per_minute / 60.0,     cfg.limits.ip_burst),
+                              ])
+
+def boundedVerify(sourceURL, targetURL, vouchDomain=None, wait=0):
+    """Run verifyWebmention() while holding one of the cfg.limits.max_inflight
+    outbound slots shared by all workers.
+
+    Raises ratelimit.Busy if no slot frees up within wait seconds.
+    """
+    getLimiter()
+    holder = slots.acquire(wait)
+    try:
+        return verifyWebmention(sourceURL, targetURL, vouchDomain)
+    finally:
+        slots.release(holder)
+
+def sharedVerify(sourceURL, targetURL, vouchDomain=None, wait=0):
+    """Run verifyWebmention() so that only one verification of a given
+    source, target and vouch is in flight across all workers at a time.
+    Concurrent and quickly repeated requests share its result.
+
+    Raises singleflight.FlightTimeout if the result does not arrive in time
+    and ratelimit.Busy if all outbound slots stay in use for wait seconds.
+    """
+    if db is None:
+        return verifyWebmention(sourceURL, targetURL, vouchDomain)
+    status, message = getFlights().run((sourceURL, targetURL, vouchDomain),
+                                       boundedVerify, sourceURL, targetURL, vouchDomain, wait)
+    return status, message
+
+def checkWebmention(sourceURL, targetURL):
+    """Cheap sanity check of a Webmention request that needs no network I/O.
+
+    Returns None if the request looks valid or an error message if not.
+    """
+    if not sourceURL or not targetURL:
+        return 'source and target are required'
+    source = urlparse(sourceURL)
+    target = urlparse(targetURL)
+    if source.scheme not in ('http', 'https') or target.scheme not in ('http', 'https'):
+        return 'source and target must be http or https URLs'
+    if sourceURL == targetURL:
+        return 'source and target must be different'
+    if 'our_domain' in cfg and target.netloc.lower() != cfg.our_domain.lower():
+        return 'target is not a post on %s' % cfg.our_domain
+    return None
+
+def queueWebmention(sourceURL, targetURL, vouchDomain=None):
+    """Store a Webmention job and push it onto the work queue.
+
+    All of the writes are sent in a single pipeline so the request
+    only pays for one round trip to Redis.
+    """
+    jobId = str(uuid.uuid4())
+    key   = 'webmention-%s' % jobId
+    job   = { 'source':   sourceURL,
+              'target':   targetURL,
+              'status':   'queued',
+              'attempts': 0,
+              'received': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+            }
+    if vouchDomain is not None:
+        job['vouch'] = vouchDomain
+
+    pipe = db.pipeline()
+    pipe.hmset(key, job)
+    pipe.expire(key, cfg.queue.status_ttl)
+    getJobQueue().push(jobId, pipe)
+    pipe.execute()
+    return jobId
+
+def promoteDelayed():
+    """Move any retry jobs whose backoff has expired back onto the work queue
+    """
+    delayed = '%s-delayed' % cfg.queue.name
+    for jobId in db.zrangebyscore(delayed, 0, time.time()):
+        # only the worker that wins the zrem gets to requeue the job
+        if db.zrem(delayed, jobId):
+            db.lpush(cfg.queue.name, jobId)
+
+def processJob(jobId):
+    """Run the verification for a single queued Webmention job.
+
+    Exceptions are treated as transient failures and the job is retried
+    with an increasing delay until cfg.queue.retries is reached, after
+    which it is moved to the dead letter list.
+    """
+    key  = 'webmention-%s' % jobId
+    data = db.hgetall(key)
+    if not data:
+        app.logger.info('webmention job %s has expired', jobId)
+        return
+
+    attempts = db.hincrby(key, 'attempts', 1)
+    db.hset(key, 'status', 'processing')
+    try:
+        status, message = sharedVerify(data['source'], data['target'], data.get('vouch'), cfg.limits.slot_wait)
+        if status == 502:
+            # the source may well be back by the next attempt
+            raise SourceUnavailable(message)
+        pipe = db.pipeline()
+        pipe.hmset(key, { 'status':  'accepted' if status == 200 else 'rejected',
+                          'code':    status,
+                          'message': message,
+                        })
+        pipe.expire(key, cfg.queue.status_ttl)
+        pipe.execute()
+        app.logger.info('webmention job %s finished [%s] %s', jobId, status, message)
+    except Exception as e:
+        app.logger.exception('webmention job %s failed on attempt %d', jobId, attempts)
+        pipe = db.pipeline()
+        if attempts < cfg.queue.retries:
+            delay = cfg.queue.retry_delay * (2 ** (attempts - 1))
+            pipe.hmset(key, { 'status': 'retrying', 'message': str(e) })
+            pipe.zadd('%s-delayed' % cfg.queue.name, { jobId: time.time() + delay })
+        else:
+            pipe.hmset(key, { 'status': 'failed', 'message': str(e) })
+            pipe.lpush('%s-deadletter' % cfg.queue.name, jobId)
+        pipe.expire(key, cfg.queue.status_ttl)
+        pipe.execute()
+
+def webmentionWorker(workerId):
+    """Drain the Webmention queue until the process is stopped
+    """
+    getJobQueue().serve(workerId, processJob, promoteDelayed)
+
+def startWorkers(count):
+    """Start count Webmention worker threads and return them
+    """
+    workers = []
+    for n in range(count):
+        t = threading.Thread(target=webmentionWorker, args=(n,))
+        t.daemon = True
+        t.start()
+        workers.append(t)
+    return workers
+
+@app.route('/webmention/<jobId>', methods=['GET'])
+def handleWebmentionStatus(jobId):
+    app.logger.info('handleWebmentionStatus [%s]', jobId)
+    data = None
+    if db is not None:
+        data = db.hgetall('webmention-%s' % jobId)
+    if data:
+        return (json.dumps(data), 200, {'Content-Type': 'application/json'})
+    else:
+        return 'unknown webmention', 404
+
 @app.route('/webmention', methods=['POST'])
+@metrics.timed('webmention')
 def handleWebmention():
-    app.logger.info('handleWebmention [%s]' % request.method)
+    app.logger.info('handleWebmention [%s]', request.method)
     if request.method == 'POST':
-        valid  = False
         source = request.form.get('source')
         target = request.form.get('target')
         vouch  = request.form.get('vouch')
-        app.logger.info('source: %s target: %s vouch %s' % (source, target, vouch))
-
-        valid = validURL(target)
-
-        app.logger.info('valid? %s' % valid)
-
-        if valid == requests.codes.ok:
-            if mention(source, target, vouch):
-                return redirect(target)
-            else:
-                if vouch is None and cfg['require_vouch']:
-                    return 'Vouch required for webmention', 449
-                else:
-                    return 'Webmention is invalid', 400
+        app.logger.info('source: %s target: %s vouch %s', source, target, vouch)
+
+        retryAfter = checkRateLimit(source, request.remote_addr)
+        if retryAfter > 0:
+            app.logger.info('rate limited [%s] [%s]', source, request.remote_addr)
+            return ('Too many Webmentions, try again later', 429, {'Retry-After': int(math.ceil(retryAfter))})
+
+        if cfg.queue.enabled and db is not None:
+            error = checkWebmention(source, target)
+            if error is not None:
+                return error, 400
+            jobId     = queueWebmention(source, target, vouch)
+            statusURL = '%s/webmention/%s' % (cfg.baseurl, jobId)
+            return (statusURL, 202, {'Location': statusURL})
+
+        try:
+            status, message = sharedVerify(source, target, vouch)
+        except singleflight.FlightTimeout:
+            return ('Webmention verification already in progress', 503, {'Retry-After': cfg.singleflight.wait})
+        except ratelimit.Busy:
+            return ('Too busy to verify Webmentions, try again later', 503, {'Retry-After': cfg.limits.slot_wait})
+        if status == 200:
+            return redirect(target)
         else:
-            return 'invalid post', 404
+            return message, status
 
-def initLogging(logger, logpath=None, echo=False):
-    logFormatter = logging.Formatter("%(asctime)s %(levelname)-9s %(message)s", "%Y-%m-%d %H:%M:%S")
+def initLogging(logger, logpath=None, echo=False, cfgLogging=None):
+    if cfgLogging is None:
+        cfgLogging = Config()
+    if cfgLogging.format == 'json':
+        logFormatter = logqueue.JSONFormatter()
+    else:
+        logFormatter = logging.Formatter("%(asctime)s %(levelname)-9s %(message)s", "%Y-%m-%d %H:%M:%S")
+    handlers = []
 
     if logpath is not None:
-        from logging.handlers import RotatingFileHandler
-
         logfilename = os.path.join(logpath, 'indieweb.log')
-        logHandler  = logging.handlers.RotatingFileHandler(logfilename, maxBytes=1024 * 1024 * 100, backupCount=7)
+        logHandler  = logqueue.LockedRotatingFileHandler(logfilename, maxBytes=cfgLogging.max_bytes or 1024 * 1024 * 100,
+                                                         backupCount=cfgLogging.backup_count or 7)
         logHandler.setFormatter(logFormatter)
-        logger.addHandler(logHandler)
+        handlers.append(logHandler)
 
     if echo:
         echoHandler = logging.StreamHandler()
         echoHandler.setFormatter(logFormatter)
-        logger.addHandler(echoHandler)
-
-    logger.setLevel(logging.INFO)
+        handlers.append(echoHandler)
+
+    # records are written by a background thread, see logqueue.py
+    if cfgLogging.queue and handlers:
+        handlers = [ logqueue.QueueHandler(handlers, cfgLogging.queue_size or 10000, cfgLogging.debug_sample or 1) ]
+
+    # the helper modules (discovery, etc) log to children of the 'indieweb' logger
+    for l in set([logger, logging.getLogger('indieweb')]):
+        for handler in handlers:
+            l.addHandler(handler)
+        l.setLevel(logqueue.parseLevel(cfgLogging.level or 'INFO'))
+    for name, level in cfgLogging.levels.items():
+        logging.getLogger('indieweb.%s' % name).setLevel(logqueue.parseLevel(level))
     logger.info('starting Indieweb App')
 
 def loadConfig(configFilename, host=None, port=None, basepath=None, logpath=None):
@@ -522,6 +1343,84 @@ def loadConfig(configFilename, host=None, port=None, basepath=None, logpath=None
         result.auth_timeout = 300
     if 'require_vouch' not in result:
         result.require_vouch = False
+    if 'format' not in result.tokens:
+        result.tokens.format = 'uuid'
+    if 'lifetime' not in result.tokens:
+        result.tokens.lifetime = 90 * 24 * 60 * 60
+    if 'session_lifetime' not in result.tokens:
+        result.tokens.session_lifetime = result.auth_timeout
+    if 'sweep_interval' not in result.tokens:
+        result.tokens.sweep_interval = 3600
+    if result.tokens.format == 'signed' and 'secret' not in result:
+        raise ValueError('signed tokens require a secret in the configuration')
+    if 'ttl' not in result.token_cache:
+        result.token_cache.ttl = 30
+    if 'size' not in result.token_cache:
+        result.token_cache.size = 4096
+    if 'ttl' not in result.source_cache:
+        result.source_cache.ttl = 30 * 24 * 60 * 60
+    if 'lease' not in result.singleflight:
+        result.singleflight.lease = 60
+    if 'result_ttl' not in result.singleflight:
+        result.singleflight.result_ttl = 60
+    if 'wait' not in result.singleflight:
+        result.singleflight.wait = 30
+    if 'source_per_minute' not in result.limits:
+        result.limits.source_per_minute = 30
+    if 'source_burst' not in result.limits:
+        result.limits.source_burst = 10
+    if 'ip_per_minute' not in result.limits:
+        result.limits.ip_per_minute = 60
+    if 'ip_burst' not in result.limits:
+        result.limits.ip_burst = 20
+    if 'max_inflight' not in result.limits:
+        result.limits.max_inflight = 16
+    if 'inflight_lease' not in result.limits:
+        result.limits.inflight_lease = 120
+    if 'slot_wait' not in result.limits:
+        result.limits.slot_wait = 10
+    if 'queue' not in result.logging:
+        result.logging.queue = False
+    if 'format' not in result.logging:
+        result.logging.format = 'text'
+    if 'level' not in result.logging:
+        result.logging.level = 'INFO'
+    if 'debug_sample' not in result.logging:
+        result.logging.debug_sample = 1
+    if 'queue_size' not in result.logging:
+        result.logging.queue_size = 10000
+    if 'max_bytes' not in result.logging:
+        result.logging.max_bytes = 1024 * 1024 * 100
+    if 'backup_count' not in result.logging:
+        result.logging.backup_count = 7
+    if 'preload' not in result.startup:
+        result.startup.preload = False
+    if 'contentpath' not in result:
+        result.contentpath = '.'
+    if 'marker' not in result.render:
+        result.render['marker'] = '<!-- webmentions -->'
+    if 'delay' not in result.render:
+        result.render.delay = 2
+    if 'syndicate_to' not in result.micropub:
+        result.micropub.syndicate_to = []
+    if 'query_max_age' not in result.micropub:
+        result.micropub.query_max_age = 300
+    if 'enabled' not in result.queue:
+        result.queue.enabled = False
+    if 'name' not in result.queue:
+        result.queue.name = 'webmention-queue'
+    if 'workers' not in result.queue:
+        result.queue.workers = 4
+    if 'retries' not in result.queue:
+        result.queue.retries = 3
+    if 'retry_delay' not in result.queue:
+        result.queue.retry_delay = 30
+    if 'poll' not in result.queue:
+        result.queue.poll = 5
+    if 'status_ttl' not in result.queue:
+        result.queue.status_ttl = 86400
+    if 'lease' not in result.queue:
+        result.queue.lease = 300
 
     return result
 
@@ -533,7 +1432,7 @@ def getRedis(cfgRedis):
     if 'db' not in cfgRedis:
         cfgRedis.db = 0
 
-    return redis.StrictRedis(host=cfgRedis.host, port=cfgRedis.port, db=cfgRedis.db)
+    return metrics.TimedRedis(host=cfgRedis.host, port=cfgRedis.port, db=cfgRedis.db)
 
 def buildTemplateContext(config):
     result = {}
@@ -545,14 +1444,37 @@ def buildTemplateContext(config):
         result[key] = value
     return result
 
+def preload(app):
+    """Load the modules and templates that are otherwise loaded on first
+    use, so a uwsgi master that loads the app before forking its workers
+    shares them with every worker.
+    """
+    getIndieAuth()
+    getWebmention()
+    from bs4 import BeautifulSoup
+    from mf2py.parser import Parser
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
 def doStart(app, configFile, ourHost=None, ourPort=None, ourBasePath=None, ourPath=None, echo=False):
     _cfg = loadConfig(configFile, host=ourHost, port=ourPort, basepath=ourBasePath, logpath=ourPath)
     _db  = None
     if 'secret' in _cfg:
         app.config['SECRET_KEY'] = _cfg['secret']
-    initLogging(app.logger, _cfg[.logpath, echo=echo)
+    initLogging(app.logger, _cfg.logpath, echo=echo, cfgLogging=_cfg.logging)
+    httpclient.initHTTP(_cfg.http)
     if 'redis' in _cfg:
         _db = getRedis(_cfg.redis)
+    discovery.initDiscovery(_cfg.discovery, _db)
+    metrics.initMetrics(_cfg.metrics, _db)
+    notify.initNotify(_cfg.notify, _db)
+    sender.initSender(_cfg.sender)
+    events.initEvents(_cfg.events)
+    media.initMedia(_cfg.media, _cfg.contentpath, _cfg.baseurl)
+    posts.initPosts(_cfg.posts, _cfg.contentpath, _cfg.baseurl)
+    queryCache.clear()
+    if _cfg.startup.preload:
+        preload(app)
     return _cfg, _db
 
 if _uwsgi:
@@ -570,10 +1492,28 @@ if __name__ == '__main__':
     parser.add_argument('--logpath',  default='/var/log')
     parser.add_argument('--basepath', default='/var/www')
     parser.add_argument('--config',   default='/etc/indieweb.cfg')
+    parser.add_argument('--worker',   action='store_true', help='run the Webmention queue workers instead of the web app')
+    parser.add_argument('--workers',  default=None, type=int, help='number of queue worker threads')
+    parser.add_argument('--sweep',    action='store_true', help='run one full pass of the token sweep and show the stats')
 
     args = parser.parse_args()
 
     cfg, db = doStart(app, args.config, args.host, args.port, args.basepath, args.logpath, echo=True)
     templateData = buildTemplateContext(cfg)
 
-    app.run(host=cfg.host, port=cfg.port, debug=True)
+    if args.sweep:
+        if db is None:
+            parser.error('the token sweep requires a redis configuration')
+        print json.dumps(getAuthStore().sweepAll(), indent=2)
+    elif args.worker:
+        if db is None:
+            parser.error('the Webmention queue requires a redis configuration')
+        # publishes the posts left queued by web processes that stopped
+        getPublisher()
+        startSweeper()
+        count = args.workers if args.workers is not None else cfg.queue.workers
+        for t in startWorkers(count):
+            while t.is_alive():
+                t.join(1)
+    else:
+        app.run(host=cfg.host, port=cfg.port, debug=True)
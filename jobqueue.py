@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+
+Redis list work queues that survive the loss of a worker.
+
+A job is an id pushed onto the list name. A worker moves the job it
+takes into a processing list of its own, <name>-processing-<worker>,
+and removes it from there once it is done. Every time it polls the
+queue the worker renews a lease, <name>-lease-<worker>, and registers
+in the set <name>-workers. A worker whose lease has expired is taken for
+dead and the others move the jobs of its processing list back onto the
+queue, the lists of live workers are never touched.
+"""
+
+import os
+import time
+import socket
+import logging
+import threading
+
+import redis
+
+
+log = logging.getLogger('indieweb.jobqueue')
+
+# count the jobs waiting on the queue and those held by its workers in one
+# step, so a job moving between lists is never missed
+_pending = """
+local count = redis.call('llen', KEYS[1])
+for _, worker in ipairs(redis.call('smembers', KEYS[2])) do
+    count = count + redis.call('llen', ARGV[1] .. worker)
+end
+return count
+"""
+
+
+class JobQueue(object):
+    def __init__(self, db, name, lease=300, poll=5):
+        self.db         = db
+        self.name       = name
+        self.lease      = lease
+        self.poll       = poll
+        self.workersKey = '%s-workers' % name
+        self.stopped    = threading.Event()
+        self._pending   = db.register_script(_pending)
+
+    def workerName(self, workerId):
+        return '%s:%d:%s' % (socket.gethostname(), os.getpid(), workerId)
+
+    def processingList(self, worker):
+        return '%s-processing-%s' % (self.name, worker)
+
+    def leaseKey(self, worker):
+        return '%s-lease-%s' % (self.name, worker)
+
+    def push(self, jobId, pipe=None):
+        (pipe or self.db).lpush(self.name, jobId)
+
+    def heartbeat(self, worker):
+        """Renew the lease of worker
+        """
+        pipe = self.db.pipeline()
+        pipe.set(self.leaseKey(worker), int(time.time()), ex=self.lease)
+        pipe.sadd(self.workersKey, worker)
+        pipe.execute()
+
+    def requeueStale(self):
+        """Move any jobs left in the processing list of a dead worker back
+        onto the queue. The lists of workers that still hold a lease are
+        left alone.
+        """
+        for worker in self.db.smembers(self.workersKey):
+            if self.db.exists(self.leaseKey(worker)):
+                continue
+            processing = self.processingList(worker)
+            while self.db.rpoplpush(processing, self.name) is not None:
+                pass
+            self.db.srem(self.workersKey, worker)
+            log.info('requeued the jobs of dead worker %s of %s', worker, self.name)
+
+    def pending(self):
+        """Return the number of jobs waiting or being worked on
+        """
+        return self._pending(keys=[self.name, self.workersKey], args=[self.processingList('')])
+
+    def serve(self, workerId, process, idle=None):
+        """Hand the jobs of the queue to process, one at a time, until the
+        process or the queue is stopped. idle is called before every poll.
+        """
+        worker     = self.workerName(workerId)
+        processing = self.processingList(worker)
+        checked    = 0
+        log.info('worker %s of %s started', worker, self.name)
+        while not self.stopped.is_set():
+            try:
+                self.heartbeat(worker)
+                if time.time() - checked > self.lease:
+                    self.requeueStale()
+                    checked = time.time()
+                if idle is not None:
+                    idle()
+                jobId = self.db.brpoplpush(self.name, processing, timeout=self.poll)
+                if jobId is not None:
+                    process(jobId)
+                    self.db.lrem(processing, 1, jobId)
+            except redis.RedisError:
+                log.exception('worker %s of %s lost redis', worker, self.name)
+                time.sleep(self.poll)
+
+    def stop(self):
+        """Let the workers of this queue return after their current poll
+        """
+        self.stopped.set()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+
+Logging that stays off the request thread.
+
+QueueHandler only puts the record on a queue, the message is built from
+its format and args later by the QueueListener thread which hands it to
+the real handlers. As args are formatted when the record is written,
+log values rather than objects that may change right after the call.
+Debug records can be sampled so a chatty call site only logs one record
+in every n.
+
+LockedRotatingFileHandler lets several processes, uwsgi workers for
+example, write and rotate one log file: each write holds a lock file
+and a process notices when another one has rotated the file under it.
+"""
+
+import os
+import json
+import time
+import Queue
+import fcntl
+import logging
+import threading
+
+from logging.handlers import RotatingFileHandler
+
+
+class QueueHandler(logging.Handler):
+    """Queue records for the given handlers, which are run by a listener
+    thread. Each process starts its own queue and listener when it first
+    logs, so the handler can be set up before uwsgi forks its workers.
+    """
+    def __init__(self, handlers, size=10000, sample=1):
+        logging.Handler.__init__(self)
+        self.handlers = handlers
+        self.size     = size
+        self.sample   = sample
+        self.counts   = {}
+        self.dropped  = 0
+        self.pid      = None
+        self.listener = None
+
+    def startListener(self):
+        self.queue    = Queue.Queue(self.size)
+        self.listener = QueueListener(self.queue, self.handlers)
+        self.listener.start()
+        self.pid      = os.getpid()
+
+    def emit(self, record):
+        if record.levelno <= logging.DEBUG and self.sample > 1:
+            site  = (record.pathname, record.lineno)
+            count = self.counts.get(site, 0)
+            self.counts[site] = count + 1
+            if count % self.sample:
+                return
+        if self.pid != os.getpid():
+            self.startListener()
+        if record.exc_info:
+            # the traceback has to be rendered before the frames go away
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        if self.pid == os.getpid():
+            self.listener.stop()
+        logging.Handler.close(self)
+
+
+class QueueListener(object):
+    def __init__(self, queue, handlers):
+        self.queue         = queue
+        self.handlers      = handlers
+        self.thread        = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        """Write out every queued record and stop the listener
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        data = { 'time':    time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)),
+                 'level':   record.levelname,
+                 'logger':  record.name,
+                 'module':  record.module,
+                 'line':    record.lineno,
+                 'process': record.process,
+                 'message': record.getMessage(),
+               }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data)
+
+
+class LockedRotatingFileHandler(RotatingFileHandler):
+    def __init__(self, filename, maxBytes=0, backupCount=0):
+        RotatingFileHandler.__init__(self, filename, maxBytes=maxBytes, backupCount=backupCount)
+        self.lockFile = None
+        self.lockPid  = None
+
+    def emit(self, record):
+        # flock() locks are shared by forked processes, each needs its own
+        if self.lockPid != os.getpid():
+            self.lockFile = open('%s.lock' % self.baseFilename, 'a')
+            self.lockPid  = os.getpid()
+        fcntl.flock(self.lockFile, fcntl.LOCK_EX)
+        try:
+            self.reopenIfRotated()
+            RotatingFileHandler.emit(self, record)
+        finally:
+            fcntl.flock(self.lockFile, fcntl.LOCK_UN)
+
+    def reopenIfRotated(self):
+        """Reopen the log file if another process has rotated it
+        """
+        try:
+            current = os.stat(self.baseFilename)
+        except OSError:
+            current = None
+        if self.stream is not None:
+            opened = os.fstat(self.stream.fileno())
+            if current is not None and (current.st_dev, current.st_ino) == (opened.st_dev, opened.st_ino):
+                return
+            self.stream.close()
+        self.stream = self._open()
+
+    def shouldRollover(self, record):
+        # another process may have written since we last looked
+        if self.maxBytes > 0:
+            self.stream.seek(0, 2)
+        return RotatingFileHandler.shouldRollover(self, record)
+
+    def close(self):
+        RotatingFileHandler.close(self)
+        if self.lockFile is not None:
+            self.lockFile.close()
+
+
+def parseLevel(level):
+    if isinstance(level, basestring):
+        return logging.getLevelName(level.upper())
+    return level
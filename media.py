@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+
+Streaming storage of Micropub media uploads.
+
+An upload is written, one chunk at a time, to a temp file in the media
+directory while its sha256 is computed, so the request body is never
+held in memory. Once the body is read the file is renamed to
+<sha256><ext>: an identical file that was uploaded before is kept and
+the new copy dropped, and readers never see a partial file. An upload
+larger than maxBytes is stopped as soon as it passes the limit.
+
+The extension always comes from the checked content type, the filename
+sent by the client only picks between the extensions of that type, so
+an upload can not be stored, and then served, as html or another type.
+SVG images can carry scripts and are refused.
+"""
+
+import os
+import re
+import hashlib
+import tempfile
+import mimetypes
+
+
+directory = None
+urlPrefix = None
+maxBytes  = 50 * 1024 * 1024
+chunkSize = 64 * 1024
+types     = ('image/', 'video/', 'audio/')
+unsafe    = ('image/svg+xml',)
+overhead  = 16 * 1024
+
+_extension = re.compile(r'^\.[a-z0-9]{1,8}$')
+
+
+class TooLarge(Exception):
+    pass
+
+
+def initMedia(cfgMedia, contentPath, baseURL):
+    global directory, urlPrefix, maxBytes, chunkSize, types
+
+    if 'path' not in cfgMedia:
+        cfgMedia.path = 'media'
+    if 'max_bytes' not in cfgMedia:
+        cfgMedia.max_bytes = 50 * 1024 * 1024
+    if 'chunk_size' not in cfgMedia:
+        cfgMedia.chunk_size = 64 * 1024
+    if 'types' not in cfgMedia:
+        cfgMedia.types = ['image/', 'video/', 'audio/']
+
+    directory = os.path.join(contentPath, cfgMedia.path)
+    urlPrefix = '%s/%s/' % (baseURL.rstrip('/'), cfgMedia.path.strip('/'))
+    maxBytes  = cfgMedia.max_bytes
+    chunkSize = cfgMedia.chunk_size
+    types     = tuple(cfgMedia.types)
+
+def tooLarge(contentLength):
+    """Check a Content-Length before any of the body is read, leaving
+    room for the multipart headers around the file
+    """
+    return bool(maxBytes) and contentLength is not None and contentLength > maxBytes + overhead
+
+def mimeType(contentType):
+    return (contentType or '').split(';')[0].strip().lower()
+
+def allowedType(contentType):
+    mime = mimeType(contentType)
+    return mime.startswith(types) and mime not in unsafe
+
+def extension(filename, contentType):
+    """Return the file extension for an upload of contentType, the one of
+    its filename is used only if it is an extension of that type
+    """
+    mime       = mimeType(contentType)
+    extensions = mimetypes.guess_all_extensions(mime) if mime else []
+    ext        = None
+    if filename:
+        ext = os.path.splitext(filename)[1].lower()
+    if ext not in extensions:
+        ext = mimetypes.guess_extension(mime) if mime else None
+        if ext == '.jpe':
+            ext = '.jpg'
+    if not ext or not _extension.match(ext):
+        ext = ''
+    return ext
+
+
+class Upload(object):
+    """A writable file in the media directory that hashes and counts what
+    is written to it. It is also handed to werkzeug as the stream of a
+    multipart file part so the form parser writes straight into it.
+    """
+    def __init__(self, contentType=None, filename=None):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, self.tempName = tempfile.mkstemp(dir=directory, prefix='.upload-')
+        self.file        = os.fdopen(fd, 'w+b')
+        self.digest      = hashlib.sha256()
+        self.size        = 0
+        self.contentType = contentType
+        self.filename    = filename
+        self.name        = None
+
+    def write(self, data):
+        self.size += len(data)
+        if maxBytes and self.size > maxBytes:
+            raise TooLarge('upload is larger than %d bytes' % maxBytes)
+        self.digest.update(data)
+        self.file.write(data)
+
+    def readFrom(self, stream):
+        """Copy stream into the upload in chunkSize reads
+        """
+        while True:
+            data = stream.read(chunkSize)
+            if not data:
+                break
+            self.write(data)
+
+    def read(self, *args):
+        return self.file.read(*args)
+
+    def readline(self, *args):
+        return self.file.readline(*args)
+
+    def seek(self, *args):
+        return self.file.seek(*args)
+
+    def tell(self):
+        return self.file.tell()
+
+    def commit(self):
+        """Move the upload into place and return its name and whether it
+        is new or the same as an earlier upload
+        """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.name = '%s%s' % (self.digest.hexdigest(), extension(self.filename, self.contentType))
+        filename  = os.path.join(directory, self.name)
+        if os.path.exists(filename):
+            os.unlink(self.tempName)
+            return self.name, False
+        os.chmod(self.tempName, 0644)
+        os.rename(self.tempName, filename)
+        return self.name, True
+
+    def discard(self):
+        if not self.file.closed:
+            self.file.close()
+        if os.path.exists(self.tempName):
+            os.unlink(self.tempName)
+
+    def close(self):
+        # werkzeug closes the streams of a request when it is done with
+        # them, an upload that was never committed goes away then
+        if self.name is None:
+            self.discard()
+
+
+def mediaURL(name):
+    return urlPrefix + name
+
+def mediaFile(name):
+    return os.path.join(directory, name)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+
+SQLite store of accepted Webmentions.
+
+Mentions are indexed by target, source domain and the time they were
+received so that "all mentions of X since T" is one indexed query. The
+source html is zlib compressed and kept once per distinct body, however
+many mentions share it. A later mention from the same source to the
+same target replaces the earlier one.
+
+The database runs in WAL mode so readers, such as the site generator,
+never block the app while it writes. Each thread gets its own connection.
+"""
+
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import threading
+
+from urlparse import urlparse
+
+
+_schema = """
+create table if not exists content (
+    hash     text primary key,
+    data     blob not null
+);
+create table if not exists mentions (
+    id       integer primary key,
+    source   text not null,
+    target   text not null,
+    domain   text not null,
+    received real not null,
+    vouch    text,
+    vouched  integer not null default 0,
+    name     text,
+    url      text,
+    hash     text not null references content(hash),
+    mf2      blob,
+    unique (source, target)
+);
+create index if not exists mentions_target   on mentions (target, received);
+create index if not exists mentions_domain   on mentions (domain, received);
+create index if not exists mentions_received on mentions (received);
+create index if not exists mentions_hash     on mentions (hash);
+"""
+
+_columns = 'm.source, m.target, m.domain, m.received, m.vouch, m.vouched, m.name, m.url, m.mf2, c.data'
+
+
+def _first(value):
+    """mf2 properties are lists, return the first item of one
+    """
+    if isinstance(value, list):
+        value = value[0] if value else None
+    if isinstance(value, dict):
+        value = value.get('value')
+    return value
+
+
+class MentionStore(object):
+    def __init__(self, path, timeout=30):
+        self.path    = path
+        self.timeout = timeout
+        self.local   = threading.local()
+        db = self.connection()
+        db.executescript(_schema)
+        db.commit()
+
+    def connection(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=self.timeout)
+            db.execute('pragma journal_mode=wal')
+            db.execute('pragma synchronous=normal')
+            self.local.db = db
+        return db
+
+    def close(self):
+        db = getattr(self.local, 'db', None)
+        if db is not None:
+            db.close()
+            self.local.db = None
+
+    def add(self, mentionData):
+        """Store the mentionData of an accepted Webmention
+        """
+        content = mentionData.get('content') or ''
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+        digest = hashlib.sha1(content).hexdigest()
+        mf2    = None
+        if mentionData.get('mf2data') is not None:
+            mf2 = sqlite3.Binary(zlib.compress(json.dumps(mentionData['mf2data'])))
+
+        db = self.connection()
+        with db:
+            old = db.execute('select hash from mentions where source = ? and target = ?',
+                             (mentionData['sourceURL'], mentionData['targetURL'])).fetchone()
+            db.execute('insert or ignore into content (hash, data) values (?, ?)',
+                       (digest, sqlite3.Binary(zlib.compress(content))))
+            db.execute('insert or replace into mentions (source, target, domain, received, vouch, vouched, name, url, hash, mf2) '
+                       'values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                       (mentionData['sourceURL'], mentionData['targetURL'],
+                        urlparse(mentionData['sourceURL']).netloc.lower(),
+                        mentionData.get('receivedAt', time.time()),
+                        mentionData.get('vouchDomain'), 1 if mentionData.get('vouched') else 0,
+                        _first(mentionData.get('hcardName')), _first(mentionData.get('hcardURL')),
+                        digest, mf2))
+            if old is not None and old[0] != digest:
+                db.execute('delete from content where hash = ? and not exists (select 1 from mentions where hash = ?)',
+                           (old[0], old[0]))
+        return digest
+
+    def query(self, where, args):
+        db     = self.connection()
+        result = []
+        for row in db.execute('select %s from mentions m join content c on c.hash = m.hash where %s order by m.received' % (_columns, where), args):
+            result.append({ 'sourceURL':   row[0],
+                            'targetURL':   row[1],
+                            'domain':      row[2],
+                            'received':    row[3],
+                            'vouchDomain': row[4],
+                            'vouched':     bool(row[5]),
+                            'hcardName':   row[6],
+                            'hcardURL':    row[7],
+                            'mf2data':     json.loads(zlib.decompress(row[8])) if row[8] is not None else None,
+                            'content':     zlib.decompress(row[9]),
+                          })
+        return result
+
+    def forTarget(self, targetURL, since=0):
+        """Return the mentions of targetURL received after since, oldest first
+        """
+        return self.query('m.target = ? and m.received > ?', (targetURL, since))
+
+    def forDomain(self, domain, since=0):
+        """Return the mentions sent from domain received after since, oldest first
+        """
+        return self.query('m.domain = ? and m.received > ?', (domain.lower(), since))
+
+    def since(self, since=0):
+        """Return every mention received after since, oldest first
+        """
+        return self.query('m.received > ?', (since,))
+
+    def targets(self, since=0):
+        """Return the targets with mentions received after since
+        """
+        db = self.connection()
+        return [row[0] for row in db.execute('select distinct target from mentions where received > ?', (since,))]
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='list the stored Webmentions')
+    parser.add_argument('--db',     default='/var/www/mentions.db')
+    parser.add_argument('--target', default=None)
+    parser.add_argument('--domain', default=None)
+    parser.add_argument('--since',  default=0, type=float, help='only mentions received after this unix time')
+
+    args  = parser.parse_args()
+    store = MentionStore(args.db)
+
+    if args.target is not None:
+        mentions = store.forTarget(args.target, args.since)
+    elif args.domain is not None:
+        mentions = store.forDomain(args.domain, args.since)
+    else:
+        mentions = store.since(args.since)
+    print json.dumps(mentions, indent=2)
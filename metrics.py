@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+
+Latency histograms and counters shared by every worker through redis.
+
+Observations are added up in process memory, which costs a dict update
+under a lock, and a background thread adds the totals to one redis hash
+every few seconds with a single pipeline. render() turns the hash into
+the Prometheus text format.
+
+Hash fields are "<kind>|<name>|<labels>|<bucket>" where labels is the
+Prometheus label string and bucket is only used by histogram buckets.
+"""
+
+import os
+import time
+import logging
+import functools
+import threading
+
+import redis
+
+
+log       = logging.getLogger('indieweb.metrics')
+prefix    = 'indieweb_'
+metricKey = 'metrics'
+buckets   = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+db        = None
+interval  = 5
+pending   = {}
+lock      = threading.Lock()
+flushPid  = None
+
+# commands that wait for data, their time is mostly spent idle
+blocking = ('BLPOP', 'BRPOP', 'BRPOPLPUSH', 'BZPOPMIN', 'BZPOPMAX')
+
+helpText = { 'stage_seconds':         ('histogram', 'Time spent in each stage of request handling'),
+             'stage_errors_total':    ('counter',   'Stages that ended with an exception'),
+             'redis_command_seconds': ('histogram', 'Time spent in each redis command'),
+           }
+
+
+def initMetrics(cfgMetrics, redisDB=None):
+    global db, interval
+
+    if 'flush_interval' not in cfgMetrics:
+        cfgMetrics.flush_interval = 5
+
+    db       = redisDB
+    interval = cfgMetrics.flush_interval
+
+def labelString(labels):
+    return ','.join(['%s="%s"' % (k, str(labels[k]).replace('\\', '\\\\').replace('"', '\\"')) for k in sorted(labels)])
+
+def add(*items):
+    """Add each (field, value) pair to the totals of this process
+    """
+    if flushPid != os.getpid():
+        startFlusher()
+    with lock:
+        for field, value in items:
+            pending[field] = pending.get(field, 0) + value
+
+def count(name, value=1, **labels):
+    add(('c|%s|%s|' % (name, labelString(labels)), value))
+
+def observe(name, seconds, **labels):
+    labels = labelString(labels)
+    items  = [ ('s|%s|%s|' % (name, labels), float(seconds)),
+               ('n|%s|%s|' % (name, labels), 1),
+             ]
+    for le in buckets:
+        if seconds <= le:
+            items.append(('b|%s|%s|%s' % (name, labels, le), 1))
+            break
+    add(*items)
+
+
+class timer(object):
+    """Time a block of code as a stage, counting it as an error if it raises
+    """
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        observe('stage_seconds', time.time() - self.started, stage=self.stage)
+        if excType is not None:
+            count('stage_errors_total', stage=self.stage)
+        return False
+
+def timed(stage):
+    """Decorator timing every call of a function as a stage
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def startFlusher():
+    """Start the flush thread of this process, after a fork the thread of
+    the parent is gone and any totals it had are dropped
+    """
+    global flushPid, pending
+    with lock:
+        if flushPid == os.getpid():
+            return
+        if flushPid is not None:
+            pending = {}
+        flushPid = os.getpid()
+    if db is not None:
+        t = threading.Thread(target=flusher)
+        t.daemon = True
+        t.start()
+
+def rawPipeline():
+    """Return a pipeline that is not timed, the metrics' own redis
+    traffic is kept out of redis_command_seconds
+    """
+    return redis.StrictRedis.pipeline(db, transaction=False)
+
+def flusher():
+    while True:
+        time.sleep(interval)
+        try:
+            flush()
+        except redis.RedisError:
+            log.exception('unable to flush metrics')
+
+def flush():
+    """Add the totals gathered since the last flush to redis
+    """
+    global pending
+    with lock:
+        totals  = pending
+        pending = {}
+    if not totals or db is None:
+        return
+    pipe = rawPipeline()
+    for field, value in totals.items():
+        if isinstance(value, float):
+            pipe.hincrbyfloat(metricKey, field, value)
+        else:
+            pipe.hincrby(metricKey, field, value)
+    try:
+        pipe.execute()
+    except redis.RedisError:
+        with lock:
+            for field, value in totals.items():
+                pending[field] = pending.get(field, 0) + value
+        raise
+
+def collect():
+    """Return the totals of every worker, or of this process without redis
+    """
+    if db is None:
+        with lock:
+            return dict(pending)
+    flush()
+    pipe = rawPipeline()
+    pipe.hgetall(metricKey)
+    result = {}
+    for field, value in pipe.execute()[0].items():
+        result[field] = float(value)
+    return result
+
+def render():
+    """Return the metrics in the Prometheus text format
+    """
+    series = {}
+    for field, value in collect().items():
+        kind, name, labels, le = field.split('|', 3)
+        series.setdefault(name, {}).setdefault(labels, {})[(kind, le)] = value
+
+    lines = []
+    for name in sorted(series):
+        metric = prefix + name
+        if name in helpText:
+            lines.append('# HELP %s %s' % (metric, helpText[name][1]))
+            lines.append('# TYPE %s %s' % (metric, helpText[name][0]))
+        for labels in sorted(series[name]):
+            values = series[name][labels]
+            sep    = ',' if labels else ''
+            if ('n', '') in values:
+                total = 0
+                for le in buckets:
+                    total += values.get(('b', str(le)), 0)
+                    lines.append('%s_bucket{%s%sle="%s"} %d' % (metric, labels, sep, le, total))
+                lines.append('%s_bucket{%s%sle="+Inf"} %d' % (metric, labels, sep, values[('n', '')]))
+                lines.append('%s_sum{%s} %f' % (metric, labels, values.get(('s', ''), 0)))
+                lines.append('%s_count{%s} %d' % (metric, labels, values[('n', '')]))
+            elif labels:
+                lines.append('%s{%s} %d' % (metric, labels, values.get(('c', ''), 0)))
+            else:
+                lines.append('%s %d' % (metric, values.get(('c', ''), 0)))
+    return '\n'.join(lines) + '\n'
+
+
+class TimedPipeline(redis.client.Pipeline):
+    def execute(self, raise_on_error=True):
+        started = time.time()
+        try:
+            return redis.client.Pipeline.execute(self, raise_on_error)
+        finally:
+            observe('redis_command_seconds', time.time() - started, command='PIPELINE')
+
+
+class TimedRedis(redis.StrictRedis):
+    """StrictRedis that times every command it sends, except the
+    blocking ones
+    """
+    def execute_command(self, *args, **options):
+        if args[0] in blocking:
+            return redis.StrictRedis.execute_command(self, *args, **options)
+        started = time.time()
+        try:
+            return redis.StrictRedis.execute_command(self, *args, **options)
+        finally:
+            observe('redis_command_seconds', time.time() - started, command=args[0])
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return TimedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
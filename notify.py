@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+
+Notifications for the owner, delivered by the XMPP bridge.
+
+The app pushes a small json item onto the redis list notify.key for
+every new Webmention, login and published post. The list is a durable
+queue: items wait in redis until the bridge (xmpp_handler.py) has sent
+them, whether or not the bridge is running or connected.
+
+The bridge's Outbox moves each item into a pending list for every
+recipient JID and sends each recipient a digest of what is pending.
+The first item of a burst waits delay seconds for others to join it and
+a recipient gets at most one message every interval seconds, so a flood
+of mentions turns into a few messages. Items leave a pending list only
+after the digest holding them has been sent.
+"""
+
+import json
+import time
+import logging
+
+from collections import OrderedDict
+from urlparse import urlparse
+
+import redis
+
+
+log       = logging.getLogger('indieweb.notify')
+db        = None
+enabled   = False
+key       = 'notifications'
+maxLength = 10000
+
+
+def initNotify(cfgNotify, redisDB=None):
+    global db, enabled, key, maxLength
+
+    if 'enabled' not in cfgNotify:
+        cfgNotify.enabled = False
+    if 'key' not in cfgNotify:
+        cfgNotify.key = 'notifications'
+    if 'max_length' not in cfgNotify:
+        cfgNotify.max_length = 10000
+
+    db        = redisDB
+    enabled   = cfgNotify.enabled
+    key       = cfgNotify.key
+    maxLength = cfgNotify.max_length
+
+def notify(kind, **fields):
+    """Queue a notification, the queue keeps the newest maxLength items
+    """
+    if not enabled or db is None:
+        return
+    fields['kind'] = kind
+    fields['time'] = time.time()
+    try:
+        pipe = db.pipeline(transaction=False)
+        pipe.lpush(key, json.dumps(fields))
+        pipe.ltrim(key, 0, maxLength - 1)
+        pipe.execute()
+    except redis.RedisError:
+        log.warning('unable to queue the %s notification', kind, exc_info=True)
+
+def domain(url):
+    return urlparse(url).netloc or url
+
+def digest(items, maxLines=10):
+    """Return the text of one message summing up items, oldest first
+    """
+    groups = OrderedDict()
+    for item in items:
+        subject = item.get('target') or item.get('url') or item.get('me')
+        groups.setdefault((item['kind'], subject), []).append(item)
+
+    lines = []
+    for (kind, subject), group in groups.items():
+        if kind == 'webmention':
+            sources = []
+            for item in group:
+                if domain(item['source']) not in sources:
+                    sources.append(domain(item['source']))
+            more = ' and %d more' % (len(sources) - 3) if len(sources) > 3 else ''
+            lines.append('%d new webmention%s for %s from %s%s' % (len(group), 's' if len(group) > 1 else '',
+                                                                   subject, ', '.join(sources[:3]), more))
+        elif kind == 'login':
+            lines.append('%s logged in%s' % (subject, ' %d times' % len(group) if len(group) > 1 else ''))
+        elif kind == 'post':
+            lines.append('published %s' % subject)
+        else:
+            lines.append('%d %s %s' % (len(group), kind, subject))
+    if len(lines) > maxLines:
+        lines = lines[:maxLines] + ['and %d more' % (len(lines) - maxLines)]
+    return '\n'.join(lines)
+
+
+class Outbox(object):
+    def __init__(self, redisDB, recipients, queueKey='notifications', delay=30, interval=300, batch=1000):
+        self.db         = redisDB
+        self.recipients = recipients
+        self.key        = queueKey
+        self.fanoutKey  = '%s-fanout' % queueKey
+        self.delay      = delay
+        self.interval   = interval
+        self.batch      = batch
+        self.nextSend   = {}
+
+    def pendingKey(self, jid):
+        return '%s-pending-%s' % (self.key, jid)
+
+    def spread(self, item):
+        pipe = self.db.pipeline()
+        for jid in self.recipients:
+            pipe.lpush(self.pendingKey(jid), item)
+        pipe.lrem(self.fanoutKey, 1, item)
+        pipe.execute()
+
+    def fanout(self, timeout=5):
+        """Move one item from the queue to the pending list of every
+        recipient, waiting up to timeout seconds for one to arrive.
+        The item is parked in the fanout list meanwhile so it is not lost
+        if the bridge stops.
+        """
+        item = self.db.brpoplpush(self.key, self.fanoutKey, timeout)
+        if item is None:
+            return False
+        self.spread(item)
+        return True
+
+    def recover(self):
+        """Spread the items a stopped bridge left in the fanout list
+        """
+        for item in self.db.lrange(self.fanoutKey, 0, -1):
+            self.spread(item)
+
+    def due(self, jid, now, flush=False):
+        """Return the oldest pending items of jid if a digest is due, the
+        burst has to be delay seconds old unless flush is set and the
+        last digest interval seconds ago
+        """
+        if now < self.nextSend.get(jid, 0):
+            return []
+        items = [json.loads(item) for item in reversed(self.db.lrange(self.pendingKey(jid), -self.batch, -1))]
+        if not items or (not flush and now - items[0]['time'] < self.delay):
+            return []
+        return items
+
+    def sent(self, jid, count, now):
+        """Drop the count oldest pending items of jid once they are sent
+        """
+        self.db.ltrim(self.pendingKey(jid), 0, -(count + 1))
+        self.nextSend[jid] = now + self.interval
+
+    def pending(self, jid):
+        return self.db.llen(self.pendingKey(jid))
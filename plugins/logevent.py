@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+
+Example event plugin, logs every event it is given.
+"""
+
+import logging
+
+
+log     = logging.getLogger('indieweb')
+events  = ('webmention-inbound', 'webmention-outbound', 'article-post')
+timeout = 5
+
+def handleEvent(eventType, payload):
+    log.info('event %s source %s target %s', eventType, payload.get('sourceURL'), payload.get('targetURL'))
@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+
+Send the Webmentions for every new post.
+"""
+
+import sender
+
+
+events  = ('article-post',)
+timeout = 300
+
+def handleEvent(eventType, payload):
+    sender.sendMentions(payload['sourceURL'], payload.get('content'))
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+
+Make thumbnails of uploaded images, next to the image as
+<sha256>-<size>.<ext>. Needs Pillow, without it uploads are left as is.
+"""
+
+import os
+import logging
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+log     = logging.getLogger('indieweb.thumbnails')
+events  = ('media-upload',)
+timeout = 60
+sizes   = (320, 640)
+
+def handleEvent(eventType, payload):
+    if Image is None or not payload['contentType'].startswith('image/'):
+        return
+    base, ext = os.path.splitext(payload['filename'])
+    for size in sizes:
+        image = Image.open(payload['filename'])
+        if max(image.size) <= size:
+            continue
+        image.thumbnail((size, size), Image.ANTIALIAS)
+        filename = '%s-%d%s' % (base, size, ext)
+        tmp      = '%s.tmp' % filename
+        image.save(tmp, image.format)
+        os.rename(tmp, filename)
+        log.info('thumbnail %s', filename)
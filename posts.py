@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+
+Post source files and the index used to answer Micropub q=source.
+
+Each post is a text file below the posts directory, <year>/<slug>.md,
+with one "property: value" line per value (a property can repeat) then
+a blank line and the content:
+
+    h: entry
+    name: A post
+    published: 2015-01-02T10:11:12
+    category: indieweb
+    category: python
+
+    The content of the post.
+
+The post at <year>/<slug>.md has the url <urlPrefix>/<year>/<slug>.html.
+
+The index is a SQLite table of url, file, mf2 properties and an etag.
+A lookup only stats the file of the post and reads it again if it was
+changed since it was indexed, the site files are never scanned for a
+request. rebuild() brings the whole index up to date, for posts added
+by hand or by the site generator.
+"""
+
+import os
+import re
+import json
+import codecs
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+
+import renderer
+
+
+directory = None
+urlPrefix = None
+extension = '.md'
+
+_schema = """
+create table if not exists posts (
+    url        text primary key,
+    filename   text not null unique,
+    h          text not null,
+    properties text not null,
+    etag       text not null,
+    mtime      real not null
+);
+"""
+
+
+def initPosts(cfgPosts, contentPath, baseURL):
+    global directory, urlPrefix
+
+    if 'path' not in cfgPosts:
+        cfgPosts.path = 'posts'
+    if 'url_path' not in cfgPosts:
+        cfgPosts.url_path = 'bearlog'
+    if 'build_command' not in cfgPosts:
+        cfgPosts.build_command = []
+    if 'queue' not in cfgPosts:
+        cfgPosts.queue = 'micropub-queue'
+    if 'publish_timeout' not in cfgPosts:
+        cfgPosts.publish_timeout = 900
+
+    directory = os.path.realpath(os.path.join(contentPath, cfgPosts.path))
+    urlPrefix = '%s/%s' % (baseURL.rstrip('/'), cfgPosts.url_path.strip('/'))
+
+def postFile(year, slug):
+    return os.path.join(directory, str(year), '%s%s' % (slug, extension))
+
+def postURL(filename):
+    """Return the url of the post stored in filename
+    """
+    year, name = os.path.split(os.path.relpath(filename, directory))
+    return '%s/%s/%s.html' % (urlPrefix, year, os.path.splitext(name)[0])
+
+def parsePost(text):
+    """Return the h type and mf2 properties of a post source file
+    """
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    header, _, content = text.partition('\n\n')
+    h          = 'entry'
+    properties = {}
+    for line in header.splitlines():
+        key, sep, value = line.partition(':')
+        if not sep:
+            continue
+        key   = key.strip().lower()
+        value = value.strip()
+        if key == 'h':
+            h = value
+        elif value:
+            properties.setdefault(key, []).append(value)
+    content = content.strip('\n')
+    if content:
+        properties['content'] = [content]
+    return h, properties
+
+def formatPost(h, properties):
+    """Return the text of a post source file, the reverse of parsePost()
+    """
+    lines = [u'h: %s' % h]
+    for key in sorted(properties):
+        if key != 'content':
+            for value in properties[key]:
+                lines.append(u'%s: %s' % (key, value.replace('\n', ' ')))
+    return u'%s\n\n%s\n' % ('\n'.join(lines), u'\n'.join(properties.get('content', [])))
+
+def slugify(text, length=60):
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').lower()
+    return re.sub(r'[^a-z0-9]+', '-', text).strip('-')[:length].rstrip('-')
+
+def createPost(year, slug, h, properties):
+    """Write a new post source file and return its filename. A slug that
+    is taken gets -2, -3, ... added, the name is claimed with an
+    exclusive create before the post is written atomically over it.
+    """
+    dirname = os.path.join(directory, str(year))
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            if not os.path.isdir(dirname):
+                raise
+    n    = 1
+    name = slug
+    while True:
+        filename = postFile(year, name)
+        try:
+            os.close(os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644))
+            break
+        except OSError:
+            if not os.path.exists(filename):
+                raise
+        n   += 1
+        name = '%s-%d' % (slug, n)
+    try:
+        renderer.writeAtomic(filename, formatPost(h, properties).encode('utf-8'))
+    except:
+        os.unlink(filename)
+        raise
+    return filename
+
+def readPost(filename):
+    with codecs.open(filename, 'r', 'utf-8') as h:
+        return parsePost(h.read())
+
+
+class PostIndex(object):
+    def __init__(self, path, timeout=30):
+        self.path    = path
+        self.timeout = timeout
+        self.local   = threading.local()
+        db = self.connection()
+        db.executescript(_schema)
+        db.commit()
+
+    def connection(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=self.timeout)
+            db.execute('pragma journal_mode=wal')
+            db.execute('pragma synchronous=normal')
+            self.local.db = db
+        return db
+
+    def put(self, filename, h, properties, mtime):
+        """Index the post stored in filename and return its entry
+        """
+        data  = json.dumps(properties, sort_keys=True)
+        entry = { 'url':        postURL(filename),
+                  'filename':   filename,
+                  'h':          h,
+                  'properties': properties,
+                  'etag':       hashlib.sha1(('%s\n%s' % (h, data)).encode('utf-8')).hexdigest(),
+                  'mtime':      mtime,
+                }
+        db = self.connection()
+        with db:
+            db.execute('delete from posts where filename = ?', (filename,))
+            db.execute('insert or replace into posts (url, filename, h, properties, etag, mtime) values (?, ?, ?, ?, ?, ?)',
+                       (entry['url'], filename, h, data, entry['etag'], mtime))
+        return entry
+
+    def indexFile(self, filename):
+        mtime         = os.path.getmtime(filename)
+        h, properties = readPost(filename)
+        return self.put(filename, h, properties, mtime)
+
+    def remove(self, url):
+        db = self.connection()
+        with db:
+            db.execute('delete from posts where url = ?', (url,))
+
+    def get(self, url):
+        db  = self.connection()
+        row = db.execute('select url, filename, h, properties, etag, mtime from posts where url = ?', (url,)).fetchone()
+        if row is None:
+            return None
+        return { 'url':        row[0],
+                 'filename':   row[1],
+                 'h':          row[2],
+                 'properties': json.loads(row[3]),
+                 'etag':       row[4],
+                 'mtime':      row[5],
+               }
+
+    def lookup(self, url):
+        """Return the indexed post for url, reading its file again if it
+        has changed since it was indexed
+        """
+        entry = self.get(url)
+        if entry is None:
+            return None
+        try:
+            mtime = os.path.getmtime(entry['filename'])
+        except OSError:
+            self.remove(url)
+            return None
+        if mtime != entry['mtime']:
+            entry = self.indexFile(entry['filename'])
+        return entry
+
+    def rebuild(self):
+        """Index every post file that is new or changed and drop the
+        posts whose file is gone
+        """
+        db      = self.connection()
+        known   = dict(db.execute('select filename, mtime from posts').fetchall())
+        result  = { 'indexed': 0, 'removed': 0, 'unchanged': 0 }
+        for root, dirs, files in os.walk(directory):
+            for name in files:
+                if not name.endswith(extension):
+                    continue
+                filename = os.path.join(root, name)
+                mtime    = known.pop(filename, None)
+                if mtime is not None and mtime == os.path.getmtime(filename):
+                    result['unchanged'] += 1
+                    continue
+                self.indexFile(filename)
+                result['indexed'] += 1
+        with db:
+            for filename in known:
+                db.execute('delete from posts where filename = ?', (filename,))
+                result['removed'] += 1
+        return result
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from bearlib.config import Config
+
+    parser = argparse.ArgumentParser(description='update or query the index of post source files')
+    parser.add_argument('--config', default='/etc/indieweb.cfg')
+    parser.add_argument('--index',  default=None, help='index database, posts.index from the configuration by default')
+    parser.add_argument('--url',    default=None, help='show the indexed post with this url instead of rebuilding')
+
+    args = parser.parse_args()
+
+    cfg = Config()
+    cfg.fromJson(args.config)
+    if 'contentpath' not in cfg:
+        cfg.contentpath = '.'
+
+    initPosts(cfg.posts, cfg.contentpath, cfg.baseurl)
+    index = PostIndex(args.index or cfg.posts.index or os.path.join(cfg.basepath or '/var/www', 'posts.db'))
+
+    if args.url is not None:
+        print json.dumps(index.lookup(args.url), indent=2)
+    else:
+        print json.dumps(index.rebuild(), indent=2)
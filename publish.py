@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+
+Background steps of a new Micropub post.
+
+The Micropub request only writes the post source file and queues the
+post in redis, the Publisher runs the slow steps on its own thread, one
+post at a time in the order they were created:
+
+    building     run the configured build command for the post
+    syndicating  dispatch the article-post event and wait for the
+                 sendmentions plugin and any syndication plugins
+    published    every plugin is done, the owner is notified
+
+A post ends up failed if a step fails, or timeout if a plugin is still
+running after timeout seconds.
+
+The post and its status are kept in redis as micropub-<job id> so
+clients, or the owner, can follow it. The queue is a jobqueue.JobQueue,
+the posts of a process that stops are published by another one.
+"""
+
+import json
+import time
+import logging
+import datetime
+import threading
+import subprocess
+
+import events
+import notify
+
+
+log = logging.getLogger('indieweb.publish')
+
+
+class BuildError(Exception):
+    pass
+
+
+class SyndicationError(Exception):
+    pass
+
+
+class SyndicationTimeout(SyndicationError):
+    pass
+
+
+class Publisher(object):
+    def __init__(self, db, queue, dispatcher, buildCommand=None, statusTTL=86400, timeout=900):
+        self.db           = db
+        self.queue        = queue
+        self.dispatcher   = dispatcher
+        self.buildCommand = buildCommand
+        self.statusTTL    = statusTTL
+        self.timeout      = timeout
+        self.stats        = { 'queued': 0, 'published': 0, 'failed': 0 }
+        self.thread       = None
+
+    def start(self):
+        self.thread        = threading.Thread(target=self.queue.serve, args=('publish', self.run))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def setStatus(self, jobId, pipe=None, **fields):
+        key = 'micropub-%s' % jobId
+        p   = pipe or self.db.pipeline()
+        p.hmset(key, fields)
+        p.expire(key, self.statusTTL)
+        if pipe is None:
+            p.execute()
+
+    def getStatus(self, jobId):
+        data = self.db.hgetall('micropub-%s' % jobId)
+        data.pop('post', None)
+        return data
+
+    def submit(self, jobId, post):
+        """Queue the background steps of a post that has been written
+        """
+        pipe = self.db.pipeline()
+        self.setStatus(jobId, pipe, url=post['url'], status='queued', post=json.dumps(post),
+                       received=datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'))
+        self.queue.push(jobId, pipe)
+        pipe.execute()
+        self.stats['queued'] += 1
+
+    def run(self, jobId):
+        data = self.db.hget('micropub-%s' % jobId, 'post')
+        if data is None:
+            log.info('micropub job %s has expired', jobId)
+            return
+        post = json.loads(data)
+        try:
+            self.publish(jobId, post)
+            self.stats['published'] += 1
+        except SyndicationTimeout as e:
+            log.warning('syndication of %s timed out: %s', post['url'], e)
+            self.stats['failed'] += 1
+            self.setStatus(jobId, status='timeout', message=str(e))
+        except Exception as e:
+            log.exception('unable to publish %s', post['url'])
+            self.stats['failed'] += 1
+            self.setStatus(jobId, status='failed', message=str(e))
+
+    def publish(self, jobId, post):
+        started = time.time()
+        if self.buildCommand:
+            self.setStatus(jobId, status='building')
+            self.build(post)
+        self.setStatus(jobId, status='syndicating')
+        self.syndicate(post)
+        self.setStatus(jobId, status='published')
+        notify.notify('post', url=post['url'])
+        log.info('published %s in %0.2fs', post['url'], time.time() - started)
+
+    def syndicate(self, post):
+        """Dispatch the article-post event and wait up to timeout seconds
+        for every plugin to be done with it
+        """
+        tracker = events.Tracker()
+        if not self.dispatcher.dispatch(events.ARTICLE_POST, { 'sourceURL':    post['url'],
+                                                               'filename':     post['filename'],
+                                                               'properties':   post['properties'],
+                                                               'syndicate-to': post['syndicateTo'],
+                                                             }, key=post['url'], tracker=tracker):
+            raise SyndicationError('the event queue is full')
+        outcomes = tracker.wait(self.timeout)
+        if outcomes is None:
+            raise SyndicationTimeout('the article-post event was not handled within %ss' % self.timeout)
+        late   = sorted([name for name in outcomes if outcomes[name] is None])
+        failed = sorted([name for name in outcomes if outcomes[name] not in (None, 'ok')])
+        if failed:
+            raise SyndicationError('%s failed' % ', '.join(failed))
+        if late:
+            raise SyndicationTimeout('%s still running after %ss' % (', '.join(late), self.timeout))
+
+    def build(self, post):
+        """Run the build command, each argument can use %(filename)s and
+        %(url)s of the post
+        """
+        args    = [arg % { 'filename': post['filename'], 'url': post['url'] } for arg in self.buildCommand]
+        process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output  = process.communicate()[0]
+        if process.returncode != 0:
+            raise BuildError('%s exited with %d: %s' % (args[0], process.returncode, output[-500:]))
+        log.debug('built %s: %s', post['url'], output)
+
+    def drain(self, timeout=60, poll=0.1):
+        """Wait up to timeout seconds until no post is queued or being
+        published, returns False if some still are
+        """
+        deadline = time.time() + timeout
+        while self.queue.pending() > 0:
+            if time.time() > deadline:
+                return False
+            time.sleep(poll)
+        return True
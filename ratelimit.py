@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+
+Rate limiting and concurrency caps shared by every worker through redis.
+
+RateLimiter is a set of token buckets, a request is only allowed if
+every bucket it is charged to has a token to spare. Slots is a counting
+semaphore whose holders expire so a crashed worker cannot leak a slot.
+"""
+
+import time
+import uuid
+
+
+# take one token from every bucket or from none of them
+#   KEYS[n]     bucket keys
+#   ARGV[1]     now
+#   ARGV[2n]    rate in tokens per second for KEYS[n]
+#   ARGV[2n+1]  burst size for KEYS[n]
+# returns 0 if allowed or the number of milliseconds until it would be
+_takeTokens = """
+local now     = tonumber(ARGV[1])
+local buckets = {}
+local wait    = 0
+for i, key in ipairs(KEYS) do
+    local rate   = tonumber(ARGV[i * 2])
+    local burst  = tonumber(ARGV[i * 2 + 1])
+    local bucket = redis.call('hmget', key, 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or burst
+    local ts     = tonumber(bucket[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+    if tokens < 1 then
+        wait = math.max(wait, math.ceil((1 - tokens) / rate * 1000))
+    end
+    buckets[i] = { tokens, math.ceil(burst / rate) }
+end
+if wait > 0 then
+    return wait
+end
+for i, key in ipairs(KEYS) do
+    redis.call('hmset', key, 'tokens', buckets[i][1] - 1, 'ts', now)
+    redis.call('expire', key, buckets[i][2])
+end
+return 0
+"""
+
+# take a slot if fewer than limit unexpired holders exist
+#   KEYS[1] slots key
+#   ARGV[1] now, ARGV[2] limit, ARGV[3] holder, ARGV[4] lease
+_takeSlot = """
+redis.call('zremrangebyscore', KEYS[1], '-inf', ARGV[1])
+if redis.call('zcard', KEYS[1]) < tonumber(ARGV[2]) then
+    redis.call('zadd', KEYS[1], tonumber(ARGV[1]) + tonumber(ARGV[4]), ARGV[3])
+    redis.call('expire', KEYS[1], ARGV[4])
+    return 1
+end
+return 0
+"""
+
+
+class Busy(Exception):
+    pass
+
+
+class RateLimiter(object):
+    def __init__(self, db, prefix='ratelimit'):
+        self.db          = db
+        self.prefix      = prefix
+        self._takeTokens = db.register_script(_takeTokens)
+
+    def check(self, buckets):
+        """Charge one request to each of the given buckets, a list of
+        (name, rate per second, burst) tuples. Buckets with a rate of 0
+        are not limited.
+
+        Returns 0 if the request is allowed or the number of seconds to
+        wait before trying again.
+        """
+        keys = []
+        args = [time.time()]
+        for name, rate, burst in buckets:
+            if rate > 0:
+                keys.append('%s-%s' % (self.prefix, name))
+                args.append(rate)
+                args.append(burst)
+        if not keys:
+            return 0
+        return self._takeTokens(keys=keys, args=args) / 1000.0
+
+
+class Slots(object):
+    def __init__(self, db, name, limit, lease=120, poll=0.25):
+        self.db        = db
+        self.name      = name
+        self.limit     = limit
+        self.lease     = lease
+        self.poll      = poll
+        self._takeSlot = db.register_script(_takeSlot)
+
+    def acquire(self, wait=0):
+        """Take a slot, waiting up to wait seconds for one to free up.
+        Returns the holder id to hand to release() or raises Busy.
+        """
+        holder   = str(uuid.uuid4())
+        deadline = time.time() + wait
+        while True:
+            if self._takeSlot(keys=[self.name], args=[time.time(), self.limit, holder, self.lease]):
+                return holder
+            if time.time() >= deadline:
+                raise Busy('all %d %s slots are in use' % (self.limit, self.name))
+            time.sleep(self.poll)
+
+    def release(self, holder):
+        self.db.zrem(self.name, holder)
+
+    def inUse(self):
+        self.db.zremrangebyscore(self.name, '-inf', time.time())
+        return self.db.zcard(self.name)
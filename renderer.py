@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+
+Incremental rendering of mentions into the static pages they target.
+
+Every page that shows mentions has a marker where they go. When a target
+gets new mentions only the pages depending on it are rewritten: each
+mention not already on the page is rendered and inserted before the
+marker and the page is replaced atomically by writing a temp file and
+renaming it over the original.
+
+Targets are queued and rendered by a background thread after a short
+delay so a burst of mentions for one post becomes a single write.
+
+A page is found from its url by taking the path below baseurl, with
+index.html for paths ending in /. The site generator can list other
+pages that show the mentions of a target, an index page for example,
+in mention-deps.json in the content path:
+
+    { "http://bear.im/bearlog/2015/1/post.html": [ "bearlog/2015/1/post.html", "index.html" ] }
+"""
+
+import os
+import cgi
+import json
+import time
+import fcntl
+import logging
+import tempfile
+import datetime
+import threading
+
+from urlparse import urlparse
+
+
+log = logging.getLogger('indieweb.renderer')
+
+
+class Renderer(object):
+    def __init__(self, store, contentPath, baseURL, template, marker='<!-- webmentions -->', delay=2):
+        self.store       = store
+        self.contentPath = os.path.realpath(contentPath)
+        self.baseURL     = baseURL.rstrip('/')
+        self.template    = template
+        self.marker      = marker.encode('utf-8')
+        self.delay       = delay
+        self.depsFile    = os.path.join(self.contentPath, 'mention-deps.json')
+        self.depsMTime   = None
+        self.deps        = {}
+        self.pending     = set()
+        self.lock        = threading.Lock()
+        self.wakeup      = threading.Event()
+        self.stats       = { 'scheduled': 0, 'rendered': 0, 'writes': 0 }
+        self.thread      = None
+
+    def start(self):
+        self.thread        = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def schedule(self, targetURL):
+        """Queue targetURL to have its pages rendered
+        """
+        with self.lock:
+            self.pending.add(targetURL)
+            self.stats['scheduled'] += 1
+        self.wakeup.set()
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            time.sleep(self.delay)
+            self.wakeup.clear()
+            with self.lock:
+                targets      = self.pending
+                self.pending = set()
+            for targetURL in targets:
+                try:
+                    self.render(targetURL)
+                except Exception:
+                    log.exception('unable to render the mentions of %s', targetURL)
+
+    def loadDeps(self):
+        try:
+            mtime = os.path.getmtime(self.depsFile)
+        except OSError:
+            self.deps = {}
+            return
+        if mtime != self.depsMTime:
+            with open(self.depsFile) as h:
+                self.deps = json.load(h)
+            self.depsMTime = mtime
+
+    def pages(self, targetURL):
+        """Return the files under the content path showing the mentions of targetURL
+        """
+        self.loadDeps()
+        if targetURL in self.deps:
+            names = self.deps[targetURL]
+        else:
+            if not targetURL.startswith(self.baseURL):
+                return []
+            path = urlparse(targetURL[len(self.baseURL):]).path.lstrip('/')
+            if path == '' or path.endswith('/'):
+                path += 'index.html'
+            names = [path]
+        result = []
+        for name in names:
+            filename = os.path.realpath(os.path.join(self.contentPath, name))
+            if filename.startswith(self.contentPath + os.sep):
+                result.append(filename)
+        return result
+
+    def fragment(self, mention):
+        name = mention['hcardName'] or mention['domain']
+        return self.template % { 'url':    cgi.escape(mention['sourceURL'], quote=True),
+                                 'name':   cgi.escape(name),
+                                 'date':   datetime.datetime.fromtimestamp(mention['received']).strftime('%Y-%m-%dT%H:%M:%S'),
+                                 'marker': '',
+                               }
+
+    def render(self, targetURL):
+        """Insert the mentions of targetURL missing from each of its pages
+        """
+        filenames = [filename for filename in self.pages(targetURL) if os.path.exists(filename)]
+        if not filenames:
+            return
+        mentions = self.store.forTarget(targetURL)
+        with open(os.path.join(self.contentPath, '.render.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            for filename in filenames:
+                self.renderPage(filename, mentions)
+        self.stats['rendered'] += 1
+
+    def renderPage(self, filename, mentions):
+        with open(filename) as h:
+            page = h.read()
+        if self.marker not in page:
+            return
+        fragments = ''
+        for mention in mentions:
+            if ('id="%s"' % cgi.escape(mention['sourceURL'], quote=True)).encode('utf-8') not in page:
+                fragments += self.fragment(mention).encode('utf-8')
+        if not fragments:
+            return
+        page = page.replace(self.marker, fragments + self.marker, 1)
+        writeAtomic(filename, page)
+        self.stats['writes'] += 1
+
+
+def writeAtomic(filename, data):
+    """Replace filename with data so that readers see either all of the
+    old file or all of the new one
+    """
+    dirname = os.path.dirname(filename)
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.%s.' % os.path.basename(filename))
+    try:
+        with os.fdopen(fd, 'w') as h:
+            h.write(data)
+            h.flush()
+            os.fsync(h.fileno())
+        if os.path.exists(filename):
+            os.chmod(tmp, os.stat(filename).st_mode & 0777)
+        os.rename(tmp, filename)
+    except:
+        os.unlink(tmp)
+        raise
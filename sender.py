@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+
+Send Webmentions for every link of a post.
+
+Links are handled by a pool of threads, each one discovers the
+endpoint of its target (discovery.py caches them) and posts the
+mention. No more than perHost requests are made to any one host at a
+time and failed requests are retried with an increasing delay.
+"""
+
+import time
+import logging
+import threading
+
+from urlparse import urlparse, urljoin
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+import events
+import discovery
+import httpclient
+
+
+log        = logging.getLogger('indieweb.sender')
+workers    = 16
+perHost    = 2
+retries    = 3
+retryDelay = 1
+hosts      = {}
+hostsLock  = threading.Lock()
+
+
+def initSender(cfgSender):
+    global workers, perHost, retries, retryDelay
+
+    if 'workers' not in cfgSender:
+        cfgSender.workers = 16
+    if 'per_host' not in cfgSender:
+        cfgSender.per_host = 2
+    if 'retries' not in cfgSender:
+        cfgSender.retries = 3
+    if 'retry_delay' not in cfgSender:
+        cfgSender.retry_delay = 1
+
+    workers    = cfgSender.workers
+    perHost    = cfgSender.per_host
+    retries    = cfgSender.retries
+    retryDelay = cfgSender.retry_delay
+
+def hostSlot(url):
+    """Return the semaphore limiting the requests made to the host of url
+    """
+    host = urlparse(url).netloc.lower()
+    with hostsLock:
+        if host not in hosts:
+            hosts[host] = threading.BoundedSemaphore(perHost)
+        return hosts[host]
+
+def extractLinks(sourceURL, content):
+    """Return the absolute http(s) links found in the html of a post,
+    in order and without duplicates or links back to the post itself.
+    The links of the e-content of the post are used if it has one.
+    """
+    from bs4 import BeautifulSoup
+    doc   = BeautifulSoup(content, 'html.parser')
+    entry = doc.find(class_='e-content') or doc
+    links = []
+    for a in entry.find_all('a', href=True):
+        url = urljoin(sourceURL, a['href'].strip()).split('#', 1)[0]
+        if urlparse(url).scheme in ('http', 'https') and url != sourceURL and url not in links:
+            links.append(url)
+    return links
+
+def sendMention(sourceURL, targetURL):
+    """Discover the endpoint of targetURL and send it the mention,
+    retrying errors, 429 and 5xx responses. Returns a dict describing
+    the outcome.
+    """
+    result = { 'target':   targetURL,
+               'endpoint': None,
+               'status':   None,
+               'error':    None,
+               'attempts': 0,
+             }
+    with hostSlot(targetURL):
+        status, endpoint = discovery.webmentionEndpoint(targetURL)
+    if endpoint is None:
+        result['status'] = status
+        result['error']  = 'no webmention endpoint'
+        return result
+
+    result['endpoint'] = endpoint
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            time.sleep(retryDelay * 2 ** (attempt - 1))
+        result['attempts'] += 1
+        try:
+            with hostSlot(endpoint):
+                r = httpclient.post(endpoint, data={ 'source': sourceURL, 'target': targetURL }, verify=False)
+        except requests.RequestException as e:
+            result['error'] = str(e)
+            continue
+        result['status'] = r.status_code
+        result['error']  = None
+        if r.status_code != 429 and r.status_code < 500:
+            break
+    return result
+
+def sendMentions(sourceURL, content=None):
+    """Send a Webmention to every link of the post at sourceURL, fetching
+    the post if its html is not given. Each outcome is dispatched as a
+    webmention-outbound event and the list of them returned.
+    """
+    if content is None:
+        r = httpclient.get(sourceURL, verify=False)
+        r.raise_for_status()
+        content = r.content
+
+    links = extractLinks(sourceURL, content)
+    if not links:
+        return []
+
+    started = time.time()
+    pool    = ThreadPool(min(workers, len(links)))
+    try:
+        result = pool.map(lambda targetURL: sendMention(sourceURL, targetURL), links)
+    finally:
+        pool.close()
+    log.info('sent %d webmentions for %s in %0.2fs', len(result), sourceURL, time.time() - started)
+    for outcome in result:
+        events.dispatch(events.WEBMENTION_OUTBOUND, { 'sourceURL': sourceURL,
+                                                      'targetURL': outcome['target'],
+                                                      'endpoint':  outcome['endpoint'],
+                                                      'status':    outcome['status'],
+                                                      'error':     outcome['error'],
+                                                      'attempts':  outcome['attempts'],
+                                                    }, key=outcome['target'])
+    return result
+
+
+if __name__ == '__main__':
+    import json
+    import argparse
+
+    from bearlib.config import Config
+
+    parser = argparse.ArgumentParser(description='send the Webmentions for a post')
+    parser.add_argument('--config', default='/etc/indieweb.cfg')
+    parser.add_argument('--file',   default=None, help='read the html of the post from a file instead of fetching it')
+    parser.add_argument('source',   help='url of the post')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-9s %(message)s')
+
+    cfg = Config()
+    cfg.fromJson(args.config)
+
+    httpclient.initHTTP(cfg.http)
+    discovery.initDiscovery(cfg.discovery)
+    initSender(cfg.sender)
+
+    content = None
+    if args.file is not None:
+        with open(args.file) as h:
+            content = h.read()
+    print json.dumps(sendMentions(args.source, content), indent=2)
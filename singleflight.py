@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+
+Single-flight calls across processes using a redis lease.
+
+Only the holder of the lease for a key runs the call, everyone else
+asking for the same key waits for its result. Results are kept for
+a short while so quick retries are answered without running again,
+unless the keep function given to SingleFlight says a result is not
+final.
+"""
+
+import json
+import time
+import uuid
+import hashlib
+
+
+# delete the lease only if we still hold it
+#   KEYS[1] lease key
+#   ARGV[1] our lease token
+_release = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class FlightTimeout(Exception):
+    pass
+
+
+class SingleFlight(object):
+    def __init__(self, db, prefix, lease=60, resultTTL=60, wait=30, poll=0.1, keep=None):
+        self.db        = db
+        self.prefix    = prefix
+        self.lease     = lease
+        self.resultTTL = resultTTL
+        self.wait      = wait
+        self.poll      = poll
+        self.keep      = keep
+        self._release  = db.register_script(_release)
+
+    def keys(self, *args):
+        digest = hashlib.sha1(' '.join([str(arg) for arg in args])).hexdigest()
+        return '%s-lease-%s' % (self.prefix, digest), '%s-result-%s' % (self.prefix, digest)
+
+    def run(self, key, func, *args, **kwargs):
+        """Return func(*args, **kwargs), running it only if no other process
+        is already running it for key. The result must be json serializable.
+
+        FlightTimeout is raised if the result does not show up within
+        self.wait seconds.
+        """
+        leaseKey, resultKey = self.keys(*key)
+        token    = str(uuid.uuid4())
+        deadline = time.time() + self.wait
+        while True:
+            data = self.db.get(resultKey)
+            if data is not None:
+                return json.loads(data)
+
+            if self.db.set(leaseKey, token, nx=True, ex=self.lease):
+                try:
+                    result = func(*args, **kwargs)
+                    if self.resultTTL > 0 and (self.keep is None or self.keep(result)):
+                        self.db.setex(resultKey, self.resultTTL, json.dumps(result))
+                    return result
+                finally:
+                    self._release(keys=[leaseKey], args=[token])
+
+            if time.time() > deadline:
+                raise FlightTimeout('%s is still in flight' % (key,))
+            time.sleep(self.poll)
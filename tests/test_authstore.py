@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+"""
+
+import time
+import unittest
+import threading
+
+import fakeredis
+
+import authstore
+
+
+class TestSweep(unittest.TestCase):
+    def setUp(self):
+        self.db = fakeredis.FakeStrictRedis()
+        self.db.flushall()
+        self.store = authstore.AuthStore(self.db, cacheTTL=0, sessionLifetime=300, accessLifetime=3600)
+
+        self.db.set('token-live', 'app-me-client-post')
+        self.db.set('app-me-client-post', 'live')
+        self.db.hmset('login-me', { 'token': 'session' })
+        self.db.set('token-session', 'login-me')
+        self.db.set('token-orphan', 'login-gone')
+        self.db.hmset('token-other', { 'not': 'a token' })
+
+    def testTwoPasses(self):
+        stats = self.store.sweepAll()
+        self.assertEqual(int(stats['orphans']), 1)
+        self.assertEqual(int(stats['access']), 1)
+        self.assertEqual(int(stats['session']), 1)
+        self.assertFalse(self.db.exists('token-orphan'))
+        self.assertTrue(self.db.exists('token-other'))
+        self.assertTrue(self.db.ttl('token-live') > 0)
+
+        # the bookkeeping of the first pass must not trip up the second
+        self.db.set('app-me-gone-post', 'missing')
+        stats = self.store.sweepAll()
+        self.assertEqual(int(stats['orphans']), 1)
+        self.assertEqual(int(stats['access']), 1)
+        self.assertFalse(self.db.exists('app-me-gone-post'))
+        self.assertTrue(self.db.exists('token-live'))
+        self.assertTrue(self.db.exists('token-session'))
+
+    def testSweeperTakesTurns(self):
+        # another process holds the lease, this sweeper waits its turn
+        self.db.set(authstore.leaseKey, 'other', ex=2)
+        sweeper = threading.Thread(target=self.store.sweeper, args=(1,))
+        sweeper.daemon = True
+        sweeper.start()
+        time.sleep(1.5)
+        self.assertEqual(self.store.stats(), {})
+        self.assertTrue(self.db.exists('token-orphan'))
+
+        deadline = time.time() + 5
+        while not self.store.stats() and time.time() < deadline:
+            time.sleep(0.1)
+        self.assertEqual(int(self.store.stats()['orphans']), 1)
+        self.assertNotEqual(self.db.get(authstore.leaseKey), 'other')
+        self.store.stopped.set()
+        sweeper.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
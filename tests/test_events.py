@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+"""
+
+import time
+import unittest
+import threading
+
+import events
+
+
+class HangingPlugin(object):
+    timeout = 0.05
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.seen    = []
+
+    def handleEvent(self, eventType, payload):
+        self.seen.append(payload['n'])
+        self.release.wait()
+
+
+class TestDispatcher(unittest.TestCase):
+    def testHungPluginDoesNotGrowThreads(self):
+        plugin     = HangingPlugin()
+        dispatcher = events.Dispatcher([('hang', plugin)], workers=2, timeout=1)
+        before     = threading.active_count()
+        for n in range(40):
+            dispatcher.run('article-post', { 'n': n })
+        self.assertEqual(threading.active_count(), before)
+
+        stats = dispatcher.getStats()['handlers']['hang']
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(stats['queued'], 39)
+        self.assertEqual(plugin.seen, [0])
+
+        # once the late call returns the queued events run, in order
+        plugin.release.set()
+        deadline = time.time() + 5
+        while len(plugin.seen) < 40 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(plugin.seen, range(40))
+
+        dispatcher.run('article-post', { 'n': 40 })
+        self.assertEqual(plugin.seen, range(41))
+        stats = dispatcher.getStats()['handlers']['hang']
+        self.assertEqual(stats['calls'], 41)
+        self.assertEqual(stats['timeouts'], 1)
+
+    def testFullPluginQueueDrops(self):
+        plugin     = HangingPlugin()
+        dispatcher = events.Dispatcher([('hang', plugin)], workers=1, timeout=1, queueSize=5)
+        for n in range(10):
+            dispatcher.run('article-post', { 'n': n })
+        stats = dispatcher.getStats()['handlers']['hang']
+        self.assertEqual((stats['timeouts'], stats['queued'], stats['dropped']), (1, 5, 4))
+        plugin.release.set()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+"""
+
+import os
+import socket
+import unittest
+import threading
+import SocketServer
+import BaseHTTPServer
+
+import indieweb
+
+
+target = 'http://bear.im/bearlog/2015/1/post.html'
+page   = ('<html><body><div class="h-entry"><a href="%s">link</a><p class="e-content">%s</p></div>'
+          '<a class="h-card" href="http://example.com/">Example Author</a></body></html>') % (target, 'x' * 60000)
+
+
+class SourceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        data = page if self.path == '/post' else 'y' * (indieweb.httpclient.maxBody + 1)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class SourceServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TestFetchSource(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        configFile   = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'indieweb.cfg')
+        indieweb.cfg = indieweb.loadConfig(configFile)
+        indieweb.httpclient.initHTTP(indieweb.cfg.http)
+        cls.server = SourceServer(('127.0.0.1', 0), SourceHandler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+        cls.base = 'http://127.0.0.1:%d' % cls.server.server_address[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def testWholeSourceIsRead(self):
+        source = indieweb.fetchSource('%s/post' % self.base, target)
+        self.assertEqual(source['status'], 200)
+        self.assertTrue(source['linked'])
+        self.assertEqual(len(source['content']), len(page))
+
+    def testLargeSourceIsRejected(self):
+        self.assertEqual(indieweb.fetchSource('%s/big' % self.base, target)['status'], 413)
+
+    def testUnreachableSource(self):
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+        source = indieweb.fetchSource('http://127.0.0.1:%d/post' % port, target)
+        self.assertEqual(source['status'], 502)
+        self.assertTrue(source['error'])
+
+
+if __name__ == '__main__':
+    unittest.main()
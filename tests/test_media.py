@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+"""
+
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+import StringIO
+
+import fakeredis
+
+import media
+import indieweb
+
+
+class TestExtension(unittest.TestCase):
+    def testFromContentType(self):
+        self.assertEqual(media.extension('x.html', 'image/png'), '.png')
+        self.assertEqual(media.extension('x.jpeg', 'image/jpeg'), '.jpeg')
+        self.assertEqual(media.extension('x.JPG', 'image/jpeg; charset=binary'), '.jpg')
+        self.assertEqual(media.extension(None, 'image/jpeg'), '.jpg')
+        self.assertEqual(media.extension('x.png', None), '')
+
+    def testAllowedType(self):
+        self.assertTrue(media.allowedType('image/png'))
+        self.assertTrue(media.allowedType('Audio/MPEG'))
+        self.assertFalse(media.allowedType('image/svg+xml'))
+        self.assertFalse(media.allowedType('text/html'))
+        self.assertFalse(media.allowedType(None))
+
+
+class FakeDispatcher(object):
+    def __init__(self):
+        self.events = []
+
+    def dispatch(self, eventType, payload, key=None, tracker=None):
+        self.events.append((eventType, payload))
+        return True
+
+
+class TestUpload(unittest.TestCase):
+    def setUp(self):
+        configFile   = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'indieweb.cfg')
+        indieweb.cfg = indieweb.loadConfig(configFile)
+        indieweb.db  = fakeredis.FakeStrictRedis()
+        indieweb.db.flushall()
+        indieweb.app.config['WTF_CSRF_ENABLED'] = False
+        indieweb.app.config['SECRET_KEY']       = 'test'
+        indieweb.cfg.tokens.sweep_interval      = 0
+
+        self.path = tempfile.mkdtemp()
+        indieweb.cfg.media.max_bytes  = 100000
+        indieweb.cfg.media.chunk_size = 4096
+        media.initMedia(indieweb.cfg.media, self.path, indieweb.cfg.baseurl)
+
+        indieweb.authStore  = None
+        indieweb.dispatcher = FakeDispatcher()
+        self.token  = indieweb.getAuthStore().accessToken('http://bear.im', 'https://client.example', 'create', 'upload')[1]
+        self.client = indieweb.app.test_client()
+
+    def tearDown(self):
+        indieweb.authStore  = None
+        indieweb.dispatcher = None
+        indieweb.db         = None
+        shutil.rmtree(self.path)
+
+    def upload(self, data, filename, contentType, token=None):
+        return self.client.post('/micropub/media', headers={ 'Authorization': 'Bearer %s' % (token or self.token) },
+                                data={ 'file': (StringIO.StringIO(data), filename, contentType) })
+
+    def files(self):
+        return sorted(os.listdir(media.directory))
+
+    def testMultipartUpload(self):
+        data = 'x' * 50000
+        r    = self.upload(data, 'photo.html', 'image/png')
+        self.assertEqual(r.status_code, 201)
+        name = hashlib.sha256(data).hexdigest() + '.png'
+        self.assertTrue(r.headers['Location'].endswith('/media/' + name))
+        self.assertEqual(self.files(), [name])
+        with open(media.mediaFile(name), 'rb') as h:
+            self.assertEqual(h.read(), data)
+        self.assertEqual(indieweb.dispatcher.events[0][1]['size'], len(data))
+
+        # the same file again is stored once and not announced again
+        self.assertEqual(self.upload(data, 'again.png', 'image/png').status_code, 201)
+        self.assertEqual(self.files(), [name])
+        self.assertEqual(len(indieweb.dispatcher.events), 1)
+
+    def testRawUpload(self):
+        r = self.client.post('/micropub/media', data='y' * 1000,
+                             headers={ 'Authorization': 'Bearer %s' % self.token, 'Content-Type': 'audio/mpeg' })
+        self.assertEqual(r.status_code, 201)
+        self.assertTrue(r.headers['Location'].endswith('.mp3'))
+
+    def testRejected(self):
+        self.assertEqual(self.upload('z' * 200000, 'big.png', 'image/png').status_code, 413)
+        self.assertEqual(self.upload('<svg/>', 'a.svg', 'image/svg+xml').status_code, 415)
+        self.assertEqual(self.upload('<p>', 'a.html', 'text/html').status_code, 415)
+        token = indieweb.getAuthStore().accessToken('http://bear.im', 'https://client.example', 'read', 'reader')[1]
+        self.assertEqual(self.upload('x', 'a.png', 'image/png', token).status_code, 403)
+        # nothing is left behind, not even the temp files
+        self.assertEqual(self.files(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
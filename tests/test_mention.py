@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+"""
+
+import os
+import unittest
+
+import fakeredis
+
+import indieweb
+
+
+source = 'http://example.com/reply'
+target = 'http://bear.im/bearlog/2015/1/post.html'
+
+
+class TestSourceCache(unittest.TestCase):
+    def setUp(self):
+        configFile   = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'indieweb.cfg')
+        indieweb.cfg = indieweb.loadConfig(configFile)
+        indieweb.db  = fakeredis.FakeStrictRedis()
+        indieweb.db.flushall()
+        self.fetchSource       = indieweb.fetchSource
+        self.processWebmention = indieweb.processWebmention
+        indieweb.fetchSource       = self.fetch
+        indieweb.processWebmention = self.process
+        self.accept    = False
+        self.fetched   = []
+        self.processed = 0
+
+    def tearDown(self):
+        indieweb.fetchSource       = self.fetchSource
+        indieweb.processWebmention = self.processWebmention
+        indieweb.db                = None
+
+    def fetch(self, sourceURL, targetURL=None, etag=None, lastModified=None):
+        self.fetched.append(etag)
+        if etag == '"v1"':
+            return { 'status': 304, 'headers': {}, 'hash': None }
+        return { 'status': 200, 'headers': { 'etag': '"v1"' }, 'hash': 'h1', 'linked': True, 'doc': None }
+
+    def process(self, sourceURL, targetURL, vouchDomain=None, source=None):
+        self.processed += 1
+        return self.accept
+
+    def testFailureIsNotReplayed(self):
+        self.assertFalse(indieweb.mention(source, target))
+        self.accept = True
+        self.assertTrue(indieweb.mention(source, target))
+        self.assertEqual(self.processed, 2)
+        self.assertEqual(self.fetched, [None, None])
+
+    def testSuccessIsReplayed(self):
+        self.accept = True
+        self.assertTrue(indieweb.mention(source, target))
+        self.assertTrue(indieweb.mention(source, target))
+        self.assertEqual(self.processed, 1)
+        self.assertEqual(self.fetched, [None, '"v1"'])
+        self.assertEqual(sorted(indieweb.db.hgetall(indieweb.sourceCacheKey(source, target))),
+                         ['etag', 'hash', 'last_modified', 'result'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+"""
+
+import unittest
+
+import redis
+import fakeredis
+
+import metrics
+from bearlib.config import Config
+
+
+class TestRedisTiming(unittest.TestCase):
+    def setUp(self):
+        pool    = redis.ConnectionPool(connection_class=fakeredis.FakeConnection, server=fakeredis.FakeServer())
+        self.db = metrics.TimedRedis(connection_pool=pool)
+        metrics.initMetrics(Config(), self.db)
+        metrics.pending = {}
+
+    def tearDown(self):
+        metrics.db      = None
+        metrics.pending = {}
+
+    def commands(self):
+        return sorted(set([field.split('|')[2] for field in metrics.collect()]))
+
+    def testBlockingAndFlushAreNotTimed(self):
+        self.db.set('a', 1)
+        self.db.brpoplpush('queue', 'processing', timeout=1)
+        metrics.flush()
+        self.assertEqual(self.commands(), ['command="SET"'])
+        self.assertEqual(self.commands(), ['command="SET"'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+"""
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+
+import fakeredis
+
+import media
+import posts
+import tokens
+import indieweb
+
+
+class FakePublisher(object):
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, jobId, post):
+        self.submitted.append((jobId, post))
+
+
+class MicropubCase(unittest.TestCase):
+    def setUp(self):
+        configFile   = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'indieweb.cfg')
+        indieweb.cfg = indieweb.loadConfig(configFile)
+        indieweb.db  = fakeredis.FakeStrictRedis()
+        indieweb.db.flushall()
+        indieweb.app.config['WTF_CSRF_ENABLED'] = False
+        indieweb.app.config['SECRET_KEY']       = 'test'
+        indieweb.cfg.tokens.sweep_interval      = 0
+
+        self.path = tempfile.mkdtemp()
+        indieweb.cfg.contentpath = self.path
+        indieweb.cfg.basepath    = self.path
+        media.initMedia(indieweb.cfg.media, self.path, indieweb.cfg.baseurl)
+        posts.initPosts(indieweb.cfg.posts, self.path, indieweb.cfg.baseurl)
+
+        indieweb.authStore = None
+        indieweb.postIndex = None
+        indieweb.publisher = FakePublisher()
+        self.client        = indieweb.app.test_client()
+
+    def tearDown(self):
+        indieweb.authStore = None
+        indieweb.postIndex = None
+        indieweb.publisher = None
+        indieweb.db        = None
+        shutil.rmtree(self.path)
+
+    def storedToken(self, scope):
+        return indieweb.getAuthStore().accessToken('http://bear.im', 'https://client.example', scope, 'token-%s' % scope.replace(' ', '_'))[1]
+
+    def post(self, token, data={ 'h': 'entry', 'content': 'hello world' }):
+        headers = {}
+        if token is not None:
+            headers['Authorization'] = 'Bearer %s' % token
+        return self.client.post('/micropub', headers=headers, data=data)
+
+
+class TestMicropub(MicropubCase):
+    def testStoredToken(self):
+        token = self.storedToken('create')
+        self.assertEqual(indieweb.checkAccessToken(token), ('http://bear.im', 'https://client.example', 'create'))
+        self.assertEqual(indieweb.checkAccessToken('unknown'), (None, None, None))
+        self.assertEqual(indieweb.checkAccessToken(None), (None, None, None))
+
+    def testSignedToken(self):
+        token = tokens.signToken(indieweb.cfg.secret, 'http://bear.im', 'https://client.example', 'post')
+        self.assertEqual(indieweb.checkAccessToken(token), ('http://bear.im', 'https://client.example', 'post'))
+
+    def testMissingToken(self):
+        self.assertEqual(self.post(None).status_code, 400)
+        self.assertEqual(self.client.get('/micropub?q=config').status_code, 400)
+
+    def testCreate(self):
+        r = self.post(self.storedToken('create update'), { 'h': 'entry', 'name': 'A post', 'content': 'hello world' })
+        self.assertEqual(r.status_code, 202)
+        self.assertTrue(r.headers['Location'].endswith('/a-post.html'))
+        self.assertIn('rel="status"', r.headers['Link'])
+        jobId, post = indieweb.publisher.submitted[0]
+        self.assertEqual(post['url'], r.headers['Location'])
+        self.assertEqual(posts.readPost(post['filename'])[1]['content'], ['hello world'])
+
+    def testInvalidEntry(self):
+        r = self.post(self.storedToken('create'), { 'h': 'entry', 'content': 'x', 'published': 'yesterday' })
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(indieweb.publisher.submitted, [])
+
+    def testScopeIsChecked(self):
+        for scope in ('read', 'update delete'):
+            r = self.post(self.storedToken(scope))
+            self.assertEqual(r.status_code, 403)
+            self.assertIn('insufficient_scope', r.data)
+        self.assertEqual(self.client.get('/micropub?q=config', headers={ 'Authorization': 'Bearer %s' % self.storedToken('read') }).status_code, 200)
+        self.assertEqual(indieweb.publisher.submitted, [])
+
+
+class TestMicropubQuery(MicropubCase):
+    def get(self, query, headers={}):
+        headers = dict(headers, Authorization='Bearer %s' % self.storedToken('read'))
+        return self.client.get('/micropub?%s' % query, headers=headers)
+
+    def testConfig(self):
+        indieweb.queryCache.clear()
+        r = self.get('q=config')
+        self.assertEqual(r.status_code, 200)
+        self.assertIn('/micropub/media', json.loads(r.data)['media-endpoint'])
+        self.assertEqual(r.headers['Cache-Control'], 'private, max-age=%d' % indieweb.cfg.micropub.query_max_age)
+        again = self.get('q=config', { 'If-None-Match': r.headers['ETag'] })
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(self.get('q=syndicate-to').status_code, 200)
+
+    def testSource(self):
+        filename = posts.createPost(2015, 'a-post', 'entry', { 'name': ['A post'], 'content': ['first'] })
+        url      = posts.postURL(filename)
+        indieweb.getPostIndex().indexFile(filename)
+
+        r = self.get('q=source&url=%s' % url)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(json.loads(r.data)['properties']['content'], ['first'])
+        self.assertEqual(self.get('q=source&url=%s' % url, { 'If-None-Match': r.headers['ETag'] }).status_code, 304)
+
+        # a changed file is read again and gets a new etag
+        with open(filename, 'w') as h:
+            h.write(posts.formatPost('entry', { 'name': ['A post'], 'content': ['second'] }).encode('utf-8'))
+        os.utime(filename, (time.time() + 10, time.time() + 10))
+        changed = self.get('q=source&url=%s' % url, { 'If-None-Match': r.headers['ETag'] })
+        self.assertEqual(changed.status_code, 200)
+        self.assertEqual(json.loads(changed.data)['properties']['content'], ['second'])
+
+        r = self.get('q=source&url=%s&properties[]=name' % url)
+        self.assertEqual(json.loads(r.data), { 'properties': { 'name': ['A post'] } })
+        self.assertEqual(self.get('q=source&url=%s/missing' % url).status_code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+"""
+
+import time
+import unittest
+import threading
+
+import fakeredis
+
+import events
+import publish
+import jobqueue
+
+
+class SlowPlugin(object):
+    timeout = 0.05
+
+    def __init__(self, fail=False):
+        self.release = threading.Event()
+        self.fail    = fail
+        self.seen    = []
+
+    def handleEvent(self, eventType, payload):
+        self.release.wait()
+        self.seen.append(payload['sourceURL'])
+        if self.fail:
+            raise ValueError('no luck')
+
+
+post = { 'url':         'http://bear.im/bearlog/2015/a-post.html',
+         'filename':    '/tmp/a-post.md',
+         'properties':  { 'content': ['hello'] },
+         'syndicateTo': [],
+       }
+
+
+class TestPublisher(unittest.TestCase):
+    def setUp(self):
+        self.db = fakeredis.FakeStrictRedis()
+        self.db.flushall()
+        self.queue      = jobqueue.JobQueue(self.db, 'micropub-queue', poll=1)
+        self.publishers = []
+
+    def tearDown(self):
+        self.queue.stop()
+        for publisher in self.publishers:
+            if publisher.thread is not None:
+                publisher.thread.join()
+
+    def publisher(self, plugin, timeout=5):
+        dispatcher = events.Dispatcher([('slow', plugin)], workers=1, timeout=1)
+        self.publishers.append(publish.Publisher(self.db, self.queue, dispatcher, timeout=timeout))
+        return self.publishers[-1]
+
+    def testSubmitQueuesInRedis(self):
+        publisher = self.publisher(SlowPlugin())
+        publisher.submit('job', post)
+        self.assertEqual(self.db.lrange('micropub-queue', 0, -1), ['job'])
+        status = publisher.getStatus('job')
+        self.assertEqual((status['status'], status['url']), ('queued', post['url']))
+        self.assertNotIn('post', status)
+
+    def testPublishedOnlyOncePluginsAreDone(self):
+        plugin    = SlowPlugin()
+        publisher = self.publisher(plugin)
+        publisher.submit('job', post)
+        publisher.start()
+        time.sleep(0.3)
+        # the plugin is past its timeout but has not returned yet
+        self.assertEqual(publisher.getStatus('job')['status'], 'syndicating')
+        plugin.release.set()
+        self.assertTrue(publisher.drain(5))
+        self.assertEqual(publisher.getStatus('job')['status'], 'published')
+        self.assertEqual(plugin.seen, [post['url']])
+
+    def testFailedPlugin(self):
+        plugin = SlowPlugin(fail=True)
+        plugin.release.set()
+        publisher = self.publisher(plugin)
+        publisher.submit('job', post)
+        publisher.start()
+        self.assertTrue(publisher.drain(5))
+        status = publisher.getStatus('job')
+        self.assertEqual(status['status'], 'failed')
+        self.assertIn('slow', status['message'])
+
+    def testLatePlugin(self):
+        plugin    = SlowPlugin()
+        publisher = self.publisher(plugin, timeout=0.2)
+        publisher.submit('job', post)
+        publisher.start()
+        self.assertTrue(publisher.drain(5))
+        self.assertEqual(publisher.getStatus('job')['status'], 'timeout')
+        plugin.release.set()
+
+    def testPostsOfAStoppedProcessArePublished(self):
+        self.queue.heartbeat('gone')
+        self.db.delete(self.queue.leaseKey('gone'))
+        plugin = SlowPlugin()
+        plugin.release.set()
+        publisher = self.publisher(plugin)
+        publisher.submit('job', post)
+        self.db.rpoplpush('micropub-queue', self.queue.processingList('gone'))
+        publisher.start()
+        self.assertTrue(publisher.drain(5))
+        self.assertEqual(publisher.getStatus('job')['status'], 'published')
+
+
+if __name__ == '__main__':
+    unittest.main()
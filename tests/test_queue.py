@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+"""
+
+import unittest
+
+import fakeredis
+
+import jobqueue
+
+
+class TestRequeue(unittest.TestCase):
+    def setUp(self):
+        self.db = fakeredis.FakeStrictRedis()
+        self.db.flushall()
+        self.queue = jobqueue.JobQueue(self.db, 'test-queue')
+
+    def testOnlyDeadWorkersAreRecovered(self):
+        self.queue.heartbeat('live')
+        self.queue.heartbeat('dead')
+        self.db.delete(self.queue.leaseKey('dead'))
+        self.db.lpush(self.queue.processingList('live'), 'job-live')
+        self.db.lpush(self.queue.processingList('dead'), 'job-dead')
+        self.assertEqual(self.queue.pending(), 2)
+
+        self.queue.requeueStale()
+        self.queue.requeueStale()
+
+        self.assertEqual(self.db.lrange('test-queue', 0, -1), ['job-dead'])
+        self.assertEqual(self.db.lrange(self.queue.processingList('live'), 0, -1), ['job-live'])
+        self.assertEqual(self.db.smembers('test-queue-workers'), set(['live']))
+        self.assertEqual(self.queue.pending(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+"""
+
+import os
+import time
+import unittest
+
+import fakeredis
+
+import indieweb
+import ratelimit
+
+
+class TestRateLimiter(unittest.TestCase):
+    def setUp(self):
+        self.db = fakeredis.FakeStrictRedis()
+        self.db.flushall()
+        self.limiter = ratelimit.RateLimiter(self.db)
+
+    def testBurstThenWait(self):
+        bucket = [('a', 1.0, 3)]
+        self.assertEqual([self.limiter.check(bucket) for n in range(3)], [0, 0, 0])
+        wait = self.limiter.check(bucket)
+        self.assertTrue(0 < wait <= 1.0)
+
+    def testAllOrNothing(self):
+        self.assertEqual(self.limiter.check([('a', 0.01, 1)]), 0)
+        # b is not charged while a is empty
+        for n in range(5):
+            self.assertTrue(self.limiter.check([('a', 0.01, 1), ('b', 0.01, 2)]) > 0)
+        self.assertEqual(self.limiter.check([('b', 0.01, 2)]), 0)
+        self.assertEqual(self.limiter.check([('b', 0.01, 2)]), 0)
+        self.assertTrue(self.limiter.check([('b', 0.01, 2)]) > 0)
+
+    def testZeroRateIsNotLimited(self):
+        for n in range(20):
+            self.assertEqual(self.limiter.check([('a', 0, 1)]), 0)
+        self.assertEqual(self.db.keys('ratelimit-*'), [])
+
+
+class TestSlots(unittest.TestCase):
+    def setUp(self):
+        self.db = fakeredis.FakeStrictRedis()
+        self.db.flushall()
+
+    def testLimit(self):
+        slots   = ratelimit.Slots(self.db, 'slots', 2, poll=0.01)
+        holders = [slots.acquire(), slots.acquire()]
+        self.assertEqual(slots.inUse(), 2)
+        started = time.time()
+        self.assertRaises(ratelimit.Busy, slots.acquire, 0.1)
+        self.assertTrue(time.time() - started >= 0.1)
+        slots.release(holders[0])
+        slots.acquire()
+        self.assertEqual(slots.inUse(), 2)
+
+    def testLeaseExpires(self):
+        slots = ratelimit.Slots(self.db, 'slots', 1, lease=1, poll=0.05)
+        slots.acquire()
+        # the holder never releases, as if its worker crashed
+        slots.acquire(wait=2)
+        self.assertEqual(slots.inUse(), 1)
+
+
+class TestWebmentionLimits(unittest.TestCase):
+    def setUp(self):
+        configFile   = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'indieweb.cfg')
+        indieweb.cfg = indieweb.loadConfig(configFile)
+        indieweb.db  = fakeredis.FakeStrictRedis()
+        indieweb.db.flushall()
+        indieweb.app.config['WTF_CSRF_ENABLED'] = False
+        indieweb.app.config['SECRET_KEY']       = 'test'
+        indieweb.cfg.tokens.sweep_interval      = 0
+        indieweb.cfg.queue.enabled         = True
+        indieweb.cfg.limits.source_burst   = 2
+        indieweb.cfg.limits.ip_per_minute  = 0
+        indieweb.limiter  = None
+        indieweb.jobQueue = None
+        self.client = indieweb.app.test_client()
+
+    def tearDown(self):
+        indieweb.limiter  = None
+        indieweb.jobQueue = None
+        indieweb.db       = None
+
+    def testSourceDomainIsLimited(self):
+        data  = { 'source': 'http://example.com/a', 'target': 'http://bear.im/bearlog/2015/1/post.html' }
+        codes = [self.client.post('/webmention', data=data).status_code for n in range(3)]
+        self.assertEqual(codes, [202, 202, 429])
+        r = self.client.post('/webmention', data=data)
+        self.assertTrue(int(r.headers['Retry-After']) > 0)
+        data['source'] = 'http://example.org/a'
+        self.assertEqual(self.client.post('/webmention', data=data).status_code, 202)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+"""
+
+import time
+import unittest
+
+import events
+import sender
+
+
+class Recorder(object):
+    events  = (events.WEBMENTION_OUTBOUND,)
+
+    def __init__(self):
+        self.seen = []
+
+    def handleEvent(self, eventType, payload):
+        self.seen.append(payload)
+
+
+class TestOutboundEvents(unittest.TestCase):
+    def setUp(self):
+        self.sendMention = sender.sendMention
+        sender.sendMention = lambda sourceURL, targetURL: { 'target':   targetURL,
+                                                            'endpoint': '%s/webmention' % targetURL,
+                                                            'status':   202,
+                                                            'error':    None,
+                                                            'attempts': 1,
+                                                          }
+        self.recorder   = Recorder()
+        events.current  = events.Dispatcher([('recorder', self.recorder)], workers=1, timeout=1)
+
+    def tearDown(self):
+        sender.sendMention = self.sendMention
+        events.current     = None
+
+    def testOneEventPerMention(self):
+        html   = '<div class="h-entry"><a href="http://a.example/1">a</a> <a href="http://b.example/2">b</a></div>'
+        result = sender.sendMentions('http://bear.im/bearlog/2015/a.html', html)
+        self.assertEqual(len(result), 2)
+        deadline = time.time() + 5
+        while len(self.recorder.seen) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(sorted([(e['targetURL'], e['status']) for e in self.recorder.seen]),
+                         [('http://a.example/1', 202), ('http://b.example/2', 202)])
+        self.assertEqual(self.recorder.seen[0]['sourceURL'], 'http://bear.im/bearlog/2015/a.html')
+
+    def testWithoutDispatcher(self):
+        events.current = None
+        self.assertFalse(events.dispatch(events.WEBMENTION_OUTBOUND, {}))
+
+
+if __name__ == '__main__':
+    unittest.main()
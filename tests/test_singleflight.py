@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+"""
+
+import time
+import unittest
+import threading
+
+import fakeredis
+
+import singleflight
+
+
+class TestSingleFlight(unittest.TestCase):
+    def setUp(self):
+        self.db = fakeredis.FakeStrictRedis()
+        self.db.flushall()
+        self.calls = []
+
+    def call(self, value, delay=0):
+        self.calls.append(value)
+        time.sleep(delay)
+        return value
+
+    def testConcurrentCallsShareOneRun(self):
+        flights = singleflight.SingleFlight(self.db, 'test', resultTTL=60, wait=5, poll=0.01)
+        results = []
+        def run():
+            results.append(flights.run(('a', 'b'), self.call, [200, 'ok'], 0.2))
+        threads = [threading.Thread(target=run) for n in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.calls, [[200, 'ok']])
+        self.assertEqual(results, [[200, 'ok']] * 5)
+
+    def testResultIsKept(self):
+        flights = singleflight.SingleFlight(self.db, 'test', resultTTL=60)
+        self.assertEqual(flights.run(('a',), self.call, 1), 1)
+        self.assertEqual(flights.run(('a',), self.call, 2), 1)
+        self.assertEqual(flights.run(('b',), self.call, 3), 3)
+        self.assertEqual(self.calls, [1, 3])
+
+    def testTransientResultIsNotKept(self):
+        flights = singleflight.SingleFlight(self.db, 'test', resultTTL=60, keep=lambda result: result[0] != 502)
+        self.assertEqual(flights.run(('a',), self.call, [502, 'down']), [502, 'down'])
+        self.assertEqual(flights.run(('a',), self.call, [200, 'ok']), [200, 'ok'])
+        self.assertEqual(flights.run(('a',), self.call, [400, 'no']), [200, 'ok'])
+        self.assertEqual(len(self.calls), 2)
+
+    def testTimeout(self):
+        flights = singleflight.SingleFlight(self.db, 'test', wait=0.1, poll=0.01)
+        leaseKey, resultKey = flights.keys('a')
+        self.db.set(leaseKey, 'someone else')
+        self.assertRaises(singleflight.FlightTimeout, flights.run, ('a',), self.call, 1)
+        self.assertEqual(self.calls, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+"""
+
+import unittest
+
+import tokens
+
+
+class TestVerify(unittest.TestCase):
+    def testRoundTrip(self):
+        token = tokens.signToken('secret', 'https://me.example', 'https://client.example', 'post', 60)
+        data  = tokens.verifyToken('secret', unicode(token))
+        self.assertEqual(data['me'], 'https://me.example')
+        self.assertEqual(data['scp'], 'post')
+
+    def testRejected(self):
+        token = tokens.signToken('secret', 'https://me.example', 'https://client.example', 'post')
+        self.assertIsNone(tokens.verifyToken('other', token))
+        self.assertIsNone(tokens.verifyToken('secret', token[:-1]))
+        self.assertIsNone(tokens.verifyToken('secret', u'a.é'))
+        self.assertIsNone(tokens.verifyToken('secret', u'é.%s' % token.split('.')[1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
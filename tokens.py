@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+
+Self-describing access tokens signed with the configured secret.
+
+A token is two base64url parts joined by a '.', a json payload with
+the me, client_id, scope, expiry and a unique id, and the HMAC-SHA256
+of that payload. Checking a token needs no storage at all, only the
+unique ids of revoked tokens have to be kept until they expire.
+"""
+
+import hmac
+import json
+import time
+import uuid
+import base64
+import hashlib
+
+
+def _encode(data):
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+def _decode(data):
+    return base64.urlsafe_b64decode(str(data) + '=' * (-len(data) % 4))
+
+def _signature(secret, payload):
+    return _encode(hmac.new(str(secret), payload, hashlib.sha256).digest())
+
+def isSigned(token):
+    return token is not None and '.' in token
+
+def signToken(secret, me, client_id, scope, lifetime=None):
+    """Return a new signed token. A lifetime of None or 0 means the token
+    does not expire.
+    """
+    data = { 'me':  me,
+             'cid': client_id,
+             'scp': scope,
+             'jti': uuid.uuid4().hex[:16],
+           }
+    if lifetime:
+        data['exp'] = int(time.time()) + lifetime
+    payload = _encode(json.dumps(data, separators=(',', ':')))
+    return '%s.%s' % (payload, _signature(secret, payload))
+
+def verifyToken(secret, token):
+    """Return the payload of token as a dict if the signature matches and it
+    has not expired, None otherwise.
+    """
+    if not isSigned(token):
+        return None
+    try:
+        # tokens are plain ascii, header and form values arrive as unicode
+        payload, signature = str(token).rsplit('.', 1)
+    except UnicodeError:
+        return None
+    if not hmac.compare_digest(signature, _signature(secret, payload)):
+        return None
+    try:
+        data = json.loads(_decode(payload))
+    except (TypeError, ValueError):
+        return None
+    if 'exp' in data and data['exp'] < time.time():
+        return None
+    return data
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+
+A small in-process LRU cache where every entry
+carries its own expiry time.
+"""
+
+import time
+import threading
+
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.items   = OrderedDict()
+        self.lock    = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return the value for key if present and not expired, moving it
+        to the most recently used position.
+        """
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is None:
+                return default
+            expires, value = item
+            if expires < time.time():
+                return default
+            self.items[key] = item
+            return value
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (time.time() + ttl, value)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            item = self.items.pop(key, None)
+        if item is None:
+            return default
+        return item[1]
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
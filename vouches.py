@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+
+The list of domains accepted as Vouch domains.
+
+The list is kept in memory as a dict of domain -> record and is only
+re-read when the modification time of the file changes. Each line of
+the file is a domain, optionally followed by a tab and a json record
+of why the domain was accepted.
+"""
+
+import os
+import json
+import time
+import fcntl
+import threading
+
+
+class VouchDomains(object):
+    def __init__(self, filename, checkInterval=5):
+        self.filename      = filename
+        self.checkInterval = checkInterval
+        self.domains       = {}
+        self.mtime         = None
+        self.checked       = 0
+        self.lock          = threading.Lock()
+
+    def parse(self, lines):
+        for line in lines:
+            line = line.strip()
+            if line:
+                if '\t' in line:
+                    domain, record = line.split('\t', 1)
+                    try:
+                        record = json.loads(record)
+                    except ValueError:
+                        record = {}
+                else:
+                    domain = line
+                    record = {}
+                self.domains[domain.lower()] = record
+
+    def load(self):
+        """Read the whole file, replacing the in-memory domain list
+        """
+        try:
+            mtime = os.stat(self.filename).st_mtime
+        except OSError:
+            mtime = None
+        with self.lock:
+            self.domains = {}
+            if mtime is not None:
+                with open(self.filename, 'r') as h:
+                    self.parse(h.readlines())
+            self.mtime   = mtime
+            self.checked = time.time()
+
+    def refresh(self):
+        """Reload the file if it has changed, checking at most once every
+        checkInterval seconds.
+        """
+        now = time.time()
+        if now - self.checked >= self.checkInterval:
+            self.checked = now
+            try:
+                mtime = os.stat(self.filename).st_mtime
+            except OSError:
+                mtime = None
+            if mtime != self.mtime:
+                self.load()
+
+    def __contains__(self, domain):
+        self.refresh()
+        return domain.lower() in self.domains
+
+    def __len__(self):
+        self.refresh()
+        return len(self.domains)
+
+    def reason(self, domain):
+        """Return the record of why the given domain was accepted
+        """
+        self.refresh()
+        return self.domains.get(domain.lower())
+
+    def add(self, domain, record=None):
+        """Append domain to the file while holding an exclusive lock so
+        that several workers can add domains without clobbering each other.
+        """
+        domain = domain.lower()
+        if record is None:
+            record = {}
+        record.setdefault('accepted', time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()))
+
+        with open(self.filename, 'a+') as h:
+            fcntl.flock(h, fcntl.LOCK_EX)
+            try:
+                # another worker may have added it since our last reload
+                h.seek(0)
+                lines = h.readlines()
+                with self.lock:
+                    self.domains = {}
+                    self.parse(lines)
+                if domain not in self.domains:
+                    if lines and not lines[-1].endswith('\n'):
+                        h.write('\n')
+                    h.write('%s\t%s\n' % (domain, json.dumps(record)))
+                    h.flush()
+                    self.domains[domain] = record
+            finally:
+                fcntl.flock(h, fcntl.LOCK_UN)
+        self.mtime   = os.stat(self.filename).st_mtime
+        self.checked = time.time()
@@ -1,123 +1,139 @@
-xmpp_handler.py
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
 """
-    SleekXMPP: The Sleek XMPP Library
-    Copyright (C) 2010  Nathanael C. Fritz
-    This file is part of SleekXMPP.
+:copyright: (c) 2013-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
 
-    See the file LICENSE for copying permission.
+XMPP component that delivers the app's notifications, see notify.py.
+
+A thread moves queued notifications from redis to the pending list of
+each recipient and every poll seconds the component sends each
+recipient whose digest is due one message. Nothing is sent while the
+component is disconnected, the notifications wait in redis and are sent
+as soon as the session starts again. Sending "status" to the component
+answers with the number of pending notifications.
 """
 
-import sys
+import time
 import logging
-import getpass
-from optparse import OptionParser
+import threading
 
-import sleekxmpp
+import redis
 from sleekxmpp.componentxmpp import ComponentXMPP
 
-# Python versions before 3.0 do not use UTF-8 encoding
-# by default. To ensure that Unicode is handled properly
-# throughout SleekXMPP, we will set the default encoding
-# ourselves to UTF-8.
-if sys.version_info < (3, 0):
-    reload(sys)
-    sys.setdefaultencoding('utf8')
-else:
-    raw_input = input
+import notify
 
 
-class EchoComponent(ComponentXMPP):
+log = logging.getLogger('indieweb.xmpp')
 
-    """
-    A simple SleekXMPP component that echoes messages.
-    """
 
-    def __init__(self, jid, secret, server, port):
-        ComponentXMPP.__init__(self, jid, secret, server, port)
+def initBridge(cfgXMPP):
+    if 'server' not in cfgXMPP:
+        cfgXMPP.server = '127.0.0.1'
+    if 'port' not in cfgXMPP:
+        cfgXMPP.port = 5347
+    if 'recipients' not in cfgXMPP:
+        cfgXMPP.recipients = []
+    if 'delay' not in cfgXMPP:
+        cfgXMPP.delay = 30
+    if 'interval' not in cfgXMPP:
+        cfgXMPP.interval = 300
+    if 'poll' not in cfgXMPP:
+        cfgXMPP.poll = 1
 
-        # You don't need a session_start handler, but that is
-        # where you would broadcast initial presence.
 
-        # The message event is triggered whenever a message
-        # stanza is received. Be aware that that includes
-        # MUC messages and error messages.
-        self.add_event_handler("message", self.message)
+class NotifyComponent(ComponentXMPP):
+    def __init__(self, jid, secret, server, port, outbox, poll=1):
+        ComponentXMPP.__init__(self, jid, secret, server, port)
+        self.outbox    = outbox
+        self.connected = False
+        # deliver() runs on the event thread at session start and on the
+        # scheduler thread, sending the same items twice would drop newer
+        # ones when sent() trims the pending list
+        self.lock      = threading.Lock()
+
+        self.add_event_handler('session_start', self.sessionStart)
+        self.add_event_handler('disconnected',  self.sessionEnd)
+        self.add_event_handler('message',       self.message)
+        self.schedule('deliver notifications', poll, self.deliver, repeat=True)
+
+    def sessionStart(self, event):
+        log.info('connected, %s', ', '.join(['%s has %d pending' % (jid, self.outbox.pending(jid)) for jid in self.outbox.recipients]))
+        self.connected = True
+        self.deliver(flush=True)
+
+    def sessionEnd(self, event):
+        log.info('disconnected, notifications are kept until the connection is back')
+        self.connected = False
+
+    def deliver(self, flush=False):
+        """Send a digest to every recipient that is due one
+        """
+        with self.lock:
+            if not self.connected:
+                return
+            now = time.time()
+            for jid in self.outbox.recipients:
+                try:
+                    items = self.outbox.due(jid, now, flush)
+                    if items:
+                        self.send_message(mto=jid, mfrom=self.boundjid.bare, mbody=notify.digest(items), mtype='chat')
+                        self.outbox.sent(jid, len(items), now)
+                        log.info('sent %d notifications to %s', len(items), jid)
+                except redis.RedisError:
+                    log.exception('unable to deliver the notifications of %s', jid)
 
     def message(self, msg):
-        """
-        Process incoming message stanzas. Be aware that this also
-        includes MUC messages and error messages. It is usually
-        a good idea to check the messages's type before processing
-        or sending replies.
-
-        Since a component may send messages from any number of JIDs,
-        it is best to always include a from JID.
-
-        Arguments:
-            msg -- The received message stanza. See the documentation
-                   for stanza objects and the Message stanza to see
-                   how it may be used.
-        """
-        # The reply method will use the messages 'to' JID as the
-        # outgoing reply's 'from' JID.
-        msg.reply("Thanks for sending\n%(body)s" % msg).send()
+        if msg['type'] in ('chat', 'normal') and msg['from'].bare in self.outbox.recipients:
+            if msg['body'].strip().lower() == 'status':
+                msg.reply('%d notifications pending' % self.outbox.pending(msg['from'].bare)).send()
+
+
+def fanoutLoop(outbox):
+    outbox.recover()
+    while True:
+        try:
+            outbox.fanout()
+        except redis.RedisError:
+            log.exception('unable to read the notification queue')
+            time.sleep(5)
 
 
 if __name__ == '__main__':
-    # Setup the command line arguments.
-    optp = OptionParser()
-
-    # Output verbosity options.
-    optp.add_option('-q', '--quiet', help='set logging to ERROR',
-                    action='store_const', dest='loglevel',
-                    const=logging.ERROR, default=logging.INFO)
-    optp.add_option('-d', '--debug', help='set logging to DEBUG',
-                    action='store_const', dest='loglevel',
-                    const=logging.DEBUG, default=logging.INFO)
-    optp.add_option('-v', '--verbose', help='set logging to COMM',
-                    action='store_const', dest='loglevel',
-                    const=5, default=logging.INFO)
-
-    # JID and password options.
-    optp.add_option("-j", "--jid", dest="jid",
-                    help="JID to use")
-    optp.add_option("-p", "--password", dest="password",
-                    help="password to use")
-    optp.add_option("-s", "--server", dest="server",
-                    help="server to connect to")
-    optp.add_option("-P", "--port", dest="port",
-                    help="port to connect to")
-
-    opts, args = optp.parse_args()
-
-    if opts.jid is None:
-        opts.jid = raw_input("Component JID: ")
-    if opts.password is None:
-        opts.password = getpass.getpass("Password: ")
-    if opts.server is None:
-        opts.server = raw_input("Server: ")
-    if opts.port is None:
-        opts.port = int(raw_input("Port: "))
-
-    # Setup logging.
-    logging.basicConfig(level=opts.loglevel,
-                        format='%(levelname)-8s %(message)s')
-
-    # Setup the EchoComponent and register plugins. Note that while plugins
-    # may have interdependencies, the order in which you register them does
-    # not matter.
-    xmpp = EchoComponent(opts.jid, opts.password, opts.server, opts.port)
+    import argparse
+
+    from bearlib.config import Config
+
+    parser = argparse.ArgumentParser(description='deliver the notifications of the app over XMPP')
+    parser.add_argument('--config', default='/etc/indieweb.cfg')
+    parser.add_argument('--debug',  action='store_true')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
+                        format='%(asctime)s %(levelname)-9s %(message)s')
+
+    cfg = Config()
+    cfg.fromJson(args.config)
+    notify.initNotify(cfg.notify)
+    initBridge(cfg.xmpp)
+
+    if 'jid' not in cfg.xmpp or 'redis' not in cfg:
+        parser.error('the bridge needs an xmpp jid and a redis configuration')
+
+    db     = redis.StrictRedis(host=cfg.redis.host or '127.0.0.1', port=cfg.redis.port or 6379, db=cfg.redis.db or 0)
+    outbox = notify.Outbox(db, cfg.xmpp.recipients, notify.key, cfg.xmpp.delay, cfg.xmpp.interval)
+
+    fanout = threading.Thread(target=fanoutLoop, args=(outbox,))
+    fanout.daemon = True
+    fanout.start()
+
+    xmpp = NotifyComponent(cfg.xmpp.jid, cfg.xmpp.secret, cfg.xmpp.server, cfg.xmpp.port, outbox, cfg.xmpp.poll)
     xmpp.registerPlugin('xep_0030') # Service Discovery
-    xmpp.registerPlugin('xep_0004') # Data Forms
-    xmpp.registerPlugin('xep_0060') # PubSub
     xmpp.registerPlugin('xep_0199') # XMPP Ping
 
-    # Connect to the XMPP server and start processing XMPP stanzas.
     if xmpp.connect():
         xmpp.process(block=True)
-        print("Done")
     else:
-        print("Unable to connect.")
\ No newline at end of file
+        print 'Unable to connect.'